@@ -1,2 +1,11 @@
-from ai.llm import LLMEngine
-from ai.vision import VisionEngine
\ No newline at end of file
+from ai.engines import EngineState, LazyEngine, llm_engine, vision_engine, engines
+
+def __getattr__(name: str):
+    # the engine classes pull in openai / google-cloud-vision, so they're only imported when asked for
+    if name == "LLMEngine":
+        from ai.llm import LLMEngine
+        return LLMEngine
+    if name == "VisionEngine":
+        from ai.vision import VisionEngine
+        return VisionEngine
+    raise AttributeError(f"module 'ai' has no attribute '{name}'")
\ No newline at end of file
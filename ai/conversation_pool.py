@@ -0,0 +1,119 @@
+import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from openai.types.beta import Thread
+import time
+from typing import AsyncIterator, Awaitable, Callable
+
+ConversationKey = tuple[int, int]
+""" (guild id, channel id) """
+
+class Conversation:
+    """ Class that encapsulates an Assistants thread used by a single channel """
+
+    def __init__(self, key: ConversationKey, thread: Thread) -> None:
+        self.key: ConversationKey = key
+        """ Guild and channel that the conversation belongs to """
+        self.thread: Thread = thread
+        """ OpenAI Assistants thread that holds the conversation """
+        self.lock: asyncio.Lock = asyncio.Lock()
+        """ Runs on a single thread can't overlap, so they're serialized per conversation """
+        self.last_used: float = time.monotonic()
+        """ Monotonic time of the last run on this conversation """
+        self.users: int = 0
+        """ Number of callers holding the conversation (waiting on or inside a run), it isn't dropped while above 0 """
+
+    def __str__(self) -> str:
+        idle = time.monotonic() - self.last_used
+        return f"Conversation: guild={self.key[0]}, channel={self.key[1]}, thread='{self.thread.id}', idle={idle:.0f}s, users={self.users}"
+
+class ConversationPool:
+    """ LRU pool of Assistants threads keyed by (guild, channel) so conversations
+        in different channels run in parallel. Idle threads expire after idle_ttl seconds """
+
+    def __init__(self, create_thread: Callable[[], Awaitable[Thread]],
+                 delete_thread: Callable[[str], Awaitable[object]],
+                 max_threads: int = 64, idle_ttl: float = 3600) -> None:
+        self.max_threads: int = max_threads
+        """ Most threads kept alive at once """
+        self.idle_ttl: float = idle_ttl
+        """ Seconds a conversation may sit idle before its thread is dropped """
+        self.__create_thread = create_thread
+        self.__delete_thread = delete_thread
+        self.__conversations: OrderedDict[ConversationKey, Conversation] = OrderedDict()
+        self.__creating: dict[ConversationKey, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self.__conversations)
+
+    def conversations(self) -> list[Conversation]:
+        return list(self.__conversations.values())
+
+    @asynccontextmanager
+    async def use(self, guild_id: int, channel_id: int) -> AsyncIterator[Conversation]:
+        """ Holds the conversation for the given channel (creating its thread if needed) for the
+            body of the with statement, so it can't expire or be evicted while in use """
+        conversation = await self.get(guild_id, channel_id)
+        try:
+            yield conversation
+        finally:
+            conversation.users -= 1
+            conversation.last_used = time.monotonic()
+
+    async def get(self, guild_id: int, channel_id: int) -> Conversation:
+        """ Returns the conversation for the given channel, creating its thread if needed. The
+            conversation is held for the caller, who must decrement users when done (see use).
+            Threads are created outside of any pool-wide lock, so a slow creation only makes
+            callers for the same channel wait """
+        key = (guild_id, channel_id)
+        while True:
+            self.__expire()
+            conversation = self.__conversations.get(key)
+            if conversation is not None:
+                break
+            pending = self.__creating.get(key)
+            if pending is not None:
+                # another caller is creating this channel's thread, look again once it's done (or failed)
+                await asyncio.shield(pending)
+                continue
+            pending = asyncio.get_running_loop().create_future()
+            self.__creating[key] = pending
+            try:
+                thread = await self.__create_thread()
+            finally:
+                del self.__creating[key]
+                pending.set_result(None)
+            conversation = Conversation(key, thread)
+            self.__conversations[key] = conversation
+            break
+        # nothing below awaits, so the conversation can't be dropped before it's held
+        self.__conversations.move_to_end(key)
+        conversation.last_used = time.monotonic()
+        conversation.users += 1
+        self.__evict() # after it's held, so the conversation just created is never the one evicted
+        return conversation
+
+    def __expire(self) -> None:
+        now = time.monotonic()
+        expired = [key for key, conversation in self.__conversations.items()
+                   if now - conversation.last_used > self.idle_ttl and conversation.users == 0]
+        for key in expired:
+            self.__drop(key)
+
+    def __evict(self) -> None:
+        # least recently used first, skipping conversations someone is holding
+        for key in list(self.__conversations.keys()):
+            if len(self.__conversations) <= self.max_threads:
+                return
+            if self.__conversations[key].users == 0:
+                self.__drop(key)
+
+    def __drop(self, key: ConversationKey) -> None:
+        conversation = self.__conversations.pop(key)
+        asyncio.get_running_loop().create_task(self.__delete_quietly(conversation.thread.id))
+
+    async def __delete_quietly(self, thread_id: str) -> None:
+        try:
+            await self.__delete_thread(thread_id)
+        except Exception:
+            pass
@@ -0,0 +1,83 @@
+import asyncio
+from enum import Enum
+import importlib
+from startup import startup_report
+import time
+from typing import Callable, Generic, TypeVar
+
+T = TypeVar("T")
+
+class EngineState(Enum):
+    """ Readiness of a lazily created engine """
+    IDLE = "idle"
+    STARTING = "starting"
+    READY = "ready"
+    FAILED = "failed"
+
+class LazyEngine(Generic[T]):
+    """ Class that creates an engine (and imports its heavy dependencies) on first use,
+        off the event loop, and tracks its readiness """
+
+    def __init__(self, name: str, factory: Callable[[], T]) -> None:
+        self.name: str = name
+        """ Name shown in the shell and the startup report """
+        self.state: EngineState = EngineState.IDLE
+        """ Readiness of the engine """
+        self.error: str | None = None
+        """ Why the last initialization failed (None if it didn't) """
+        self.init_seconds: float | None = None
+        """ How long the engine took to initialize """
+        self.__factory = factory
+        self.__engine: T | None = None
+        self.__lock: asyncio.Lock | None = None
+
+    def __str__(self) -> str:
+        details = ""
+        if self.state == EngineState.READY and self.init_seconds is not None:
+            details = f" (initialized in {self.init_seconds * 1000:.0f}ms)"
+        elif self.state == EngineState.FAILED:
+            details = f" ({self.error})"
+        return f"{self.name}: {self.state.value}{details}"
+
+    def is_ready(self) -> bool:
+        return self.state == EngineState.READY
+
+    async def get(self) -> T:
+        """ Returns the engine, creating it first if needed. Concurrent callers wait for the
+            same initialization, and a failed initialization is retried on the next call """
+        if self.__engine is not None:
+            return self.__engine
+        if self.__lock is None:
+            self.__lock = asyncio.Lock()
+        async with self.__lock:
+            if self.__engine is None:
+                self.state = EngineState.STARTING
+                start = time.perf_counter()
+                try:
+                    self.__engine = await asyncio.to_thread(self.__factory)
+                except Exception as ex:
+                    self.state = EngineState.FAILED
+                    self.error = str(ex)
+                    raise Exception(f"{self.name} failed to initialize: {str(ex)}")
+                self.init_seconds = time.perf_counter() - start
+                startup_report.record(f"init {self.name}", self.init_seconds, in_total=False)
+                self.state = EngineState.READY
+                self.error = None
+        return self.__engine
+
+
+def _create_llm_engine():
+    return importlib.import_module("ai.llm").LLMEngine()
+
+def _create_vision_engine():
+    return importlib.import_module("ai.vision").VisionEngine()
+
+
+llm_engine: LazyEngine = LazyEngine("LLMEngine", _create_llm_engine)
+""" Assistants engine behind Walarus' replies (imports openai on first use) """
+
+vision_engine: LazyEngine = LazyEngine("VisionEngine", _create_vision_engine)
+""" NSFW image classifier (imports google-cloud-vision on first use) """
+
+engines: list[LazyEngine] = [llm_engine, vision_engine]
+""" Every lazily created engine """
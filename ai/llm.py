@@ -1,46 +1,65 @@
-from openai import OpenAI
+import asyncio
+from ai.conversation_pool import ConversationPool
+from openai import AsyncOpenAI
 from openai.types.beta import Thread, thread_create_params
 import os
-from typing import List
-import time
+from typing import AsyncIterator, List
 
 
 class LLMEngine():
 
-    def __init__(self):
+    def __init__(self, max_concurrent_runs: int | None = None):
         model = os.getenv("OPENAI_MODEL")
         asst_id = os.getenv("OPENAI_ASST_ID")
 
         if model is None or asst_id is None:
             raise Exception("Trouble getting model selection or assistant ID")
+        if max_concurrent_runs is None:
+            max_concurrent_runs = int(os.getenv("LLM_MAX_CONCURRENT_RUNS", 4))
 
-        self.__CLIENT = OpenAI()
-        self.__WALARUS_ASST = self.__CLIENT.beta.assistants.retrieve(
-            assistant_id=asst_id)
+        self.__CLIENT = AsyncOpenAI()
+        self.__ASST_ID = asst_id
         self.__MODEL = model
-        self.__LLM_THREAD = self.create_new_thread()
-
-    def get_llm_response(self, input: str) -> str:
-        self.__CLIENT.beta.threads.messages.create(
-            thread_id=self.__LLM_THREAD.id,
-            role="user",
-            content=input
-        )
-        run = self.__CLIENT.beta.threads.runs.create(
-            thread_id=self.__LLM_THREAD.id,
-            assistant_id=self.__WALARUS_ASST.id
-        )
-
-        while run.status == "queued" or run.status == "in_progress":
-            run = self.__CLIENT.beta.threads.runs.retrieve(
-                thread_id=self.__LLM_THREAD.id, 
-                run_id=run.id
-            )
-            time.sleep(0.5)
-
-        messages = [message.content[0].text.value for message in self.__CLIENT.beta.threads.messages.list(
-            thread_id=self.__LLM_THREAD.id, run_id=run.id)]
-        return messages[0]
-
-    def create_new_thread(self, messages: List[thread_create_params.Message] = []) -> Thread:
-        return self.__CLIENT.beta.threads.create(messages=messages)
+        self.__RUN_SLOTS = asyncio.Semaphore(max_concurrent_runs)
+        """ Caps how many runs are in flight at once """
+        self.__CONTEXT_MESSAGES = int(os.getenv("LLM_CONTEXT_MESSAGES", 20))
+        """ Number of most recent thread messages the model sees on each run """
+        self.conversations = ConversationPool(create_thread=self.create_new_thread,
+                                              delete_thread=self.delete_thread,
+                                              max_threads=int(os.getenv("LLM_MAX_THREADS", 64)),
+                                              idle_ttl=float(os.getenv("LLM_THREAD_IDLE_TTL", 3600)))
+        """ Assistants threads keyed by (guild, channel) """
+
+    async def stream_llm_response(self, input: str, guild_id: int, channel_id: int) -> AsyncIterator[str]:
+        """ Posts the input to the channel's conversation thread and yields the reply's text as it streams in """
+        # the slot is taken once it's this conversation's turn, so runs queued behind
+        # another run on the same thread don't hold slots other channels could use
+        async with self.conversations.use(guild_id, channel_id) as conversation:
+            async with conversation.lock:
+                async with self.__RUN_SLOTS:
+                    await self.__CLIENT.beta.threads.messages.create(
+                        thread_id=conversation.thread.id,
+                        role="user",
+                        content=input
+                    )
+                    # only the tail of the thread is sent to the model so per-run latency stays flat
+                    async with self.__CLIENT.beta.threads.runs.stream(
+                        thread_id=conversation.thread.id,
+                        assistant_id=self.__ASST_ID,
+                        truncation_strategy={
+                            "type": "last_messages",
+                            "last_messages": self.__CONTEXT_MESSAGES
+                        }
+                    ) as stream:
+                        async for text in stream.text_deltas:
+                            yield text
+
+    async def get_llm_response(self, input: str, guild_id: int, channel_id: int) -> str:
+        """ Returns the full reply once the run has finished """
+        return "".join([text async for text in self.stream_llm_response(input, guild_id, channel_id)])
+
+    async def create_new_thread(self, messages: List[thread_create_params.Message] = []) -> Thread:
+        return await self.__CLIENT.beta.threads.create(messages=messages)
+
+    async def delete_thread(self, thread_id: str) -> None:
+        await self.__CLIENT.beta.threads.delete(thread_id)
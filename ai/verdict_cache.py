@@ -0,0 +1,193 @@
+from collections import OrderedDict
+import hashlib
+import io
+import os
+from PIL import Image
+import sqlite3
+import threading
+import time
+from typing import cast
+
+class Fingerprint:
+    """ Exact and perceptual hashes of an image """
+
+    def __init__(self, sha256: str, phash: int | None) -> None:
+        self.sha256: str = sha256
+        """ SHA-256 of the raw attachment bytes """
+        self.phash: int | None = phash
+        """ 64-bit difference hash, None if the bytes couldn't be decoded as an image """
+
+def fingerprint(image_bytes: bytes) -> Fingerprint:
+    """ Computes the exact and perceptual hash of the given image bytes """
+    sha = hashlib.sha256(image_bytes).hexdigest()
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            phash = difference_hash(image)
+    except Exception:
+        phash = None
+    return Fingerprint(sha, phash)
+
+def difference_hash(image: Image.Image, size: int = 8) -> int:
+    """ dHash: compares neighbouring pixels of a (size+1)x(size) grayscale thumbnail,
+        so re-encodes, resizes and small edits of the same image land a few bits apart """
+    small = image.convert("L").resize((size + 1, size), Image.Resampling.LANCZOS)
+    pixels = list(small.getdata())
+    result = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            result = (result << 1) | (1 if left > right else 0)
+    return result
+
+class VerdictCache:
+    """ Content-addressed cache of NSFW verdicts. Entries live in an in-memory LRU and
+        are persisted to a local SQLite store so they survive restarts. Near duplicates are
+        found through the bands of their perceptual hash: split into max_distance + 1 bands,
+        two hashes within max_distance bits of each other have at least one band in common """
+
+    def __init__(self, path: str, capacity: int = 10000, max_distance: int = 4) -> None:
+        self.path: str = path
+        """ Location of the SQLite store """
+        self.capacity: int = capacity
+        """ Most verdicts kept in memory """
+        self.max_distance: int = max_distance
+        """ Largest perceptual hash Hamming distance treated as the same image """
+        self.__entries: OrderedDict[str, tuple[int | None, bool]] = OrderedDict()
+        self.__bands: dict[tuple[int, int], set[str]] = {}
+        self.__conn: sqlite3.Connection | None = None
+        self.__lock = threading.Lock()
+        self.lookups: int = 0
+        """ Number of lookups """
+        self.exact_hits: int = 0
+        """ Lookups answered by an identical image """
+        self.near_hits: int = 0
+        """ Lookups answered by a near-duplicate image """
+
+    def __str__(self) -> str:
+        hits = self.exact_hits + self.near_hits
+        hit_rate = hits / self.lookups * 100 if self.lookups > 0 else 0.0
+        return (f"VerdictCache: {len(self.__entries)}/{self.capacity} in memory, lookups={self.lookups}, "
+                f"exact_hits={self.exact_hits}, near_hits={self.near_hits}, "
+                f"hit_rate={hit_rate:.1f}%, saved_calls={self.saved_calls()}")
+
+    def saved_calls(self) -> int:
+        """ Number of remote classification calls skipped thanks to the cache """
+        return self.exact_hits + self.near_hits
+
+    def lookup(self, fp: Fingerprint) -> bool | None:
+        """ Returns the cached verdict for the image, or None on a miss """
+        with self.__lock:
+            self.lookups += 1
+            self.__load()
+
+            entry = self.__entries.get(fp.sha256)
+            if entry is None:
+                entry = self.__read_store(fp.sha256)
+                if entry is not None:
+                    self.__remember(fp.sha256, entry)
+            if entry is not None:
+                self.__entries.move_to_end(fp.sha256)
+                self.exact_hits += 1
+                return entry[1]
+
+            if fp.phash is None:
+                return None
+            best: tuple[int, str] | None = None
+            for band in self.__bands_of(fp.phash):
+                for sha in self.__bands.get(band, ()):
+                    phash = self.__entries[sha][0]
+                    distance = (cast(int, phash) ^ fp.phash).bit_count()
+                    if distance <= self.max_distance and (best is None or distance < best[0]):
+                        best = (distance, sha)
+            if best is None:
+                return None
+            verdict = self.__entries[best[1]][1]
+            self.__entries.move_to_end(best[1])
+            self.near_hits += 1
+            # kept under this image's hash too, so its reposts are exact hits
+            self.__remember(fp.sha256, (fp.phash, verdict))
+            self.__persist(fp, verdict)
+            return verdict
+
+    def store(self, fp: Fingerprint, verdict: bool) -> None:
+        """ Records the verdict for the image in memory and in the local store """
+        with self.__lock:
+            self.__load()
+            self.__remember(fp.sha256, (fp.phash, verdict))
+            self.__persist(fp, verdict)
+
+    def __persist(self, fp: Fingerprint, verdict: bool) -> None:
+        conn = self.__connect()
+        conn.execute("INSERT OR REPLACE INTO verdicts (sha256, phash, nsfw, created_at) VALUES (?, ?, ?, ?)",
+                     (fp.sha256, _to_signed(fp.phash), int(verdict), time.time()))
+        conn.commit()
+
+    def __remember(self, sha: str, entry: tuple[int | None, bool]) -> None:
+        self.__forget(sha)
+        self.__entries[sha] = entry
+        if entry[0] is not None:
+            for band in self.__bands_of(entry[0]):
+                self.__bands.setdefault(band, set()).add(sha)
+        while len(self.__entries) > self.capacity:
+            self.__forget(next(iter(self.__entries)))
+
+    def __forget(self, sha: str) -> None:
+        entry = self.__entries.pop(sha, None)
+        if entry is None or entry[0] is None:
+            return
+        for band in self.__bands_of(entry[0]):
+            shas = self.__bands[band]
+            shas.discard(sha)
+            if len(shas) == 0:
+                del self.__bands[band]
+
+    def __bands_of(self, phash: int) -> list[tuple[int, int]]:
+        """ (band index, band bits) of each of the max_distance + 1 bands of a 64-bit hash """
+        count = self.max_distance + 1
+        width = 64 // count
+        bands = []
+        for i in range(count):
+            bits = width if i < count - 1 else 64 - width * i
+            bands.append((i, (phash >> (width * i)) & ((1 << bits) - 1)))
+        return bands
+
+    def __read_store(self, sha: str) -> tuple[int | None, bool] | None:
+        row = self.__connect().execute("SELECT phash, nsfw FROM verdicts WHERE sha256 = ?", (sha,)).fetchone()
+        if row is None:
+            return None
+        return (_to_unsigned(row[0]), bool(row[1]))
+
+    def __load(self) -> None:
+        """ Warms the in-memory LRU with the most recent verdicts on first use """
+        if self.__conn is not None:
+            return
+        rows = self.__connect().execute("SELECT sha256, phash, nsfw FROM verdicts ORDER BY created_at DESC LIMIT ?",
+                                        (self.capacity,)).fetchall()
+        for sha, phash, nsfw in reversed(rows):
+            self.__remember(sha, (_to_unsigned(phash), bool(nsfw)))
+
+    def __connect(self) -> sqlite3.Connection:
+        if self.__conn is None:
+            self.__conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.__conn.execute("CREATE TABLE IF NOT EXISTS verdicts "
+                                "(sha256 TEXT PRIMARY KEY, phash INTEGER, nsfw INTEGER NOT NULL, created_at REAL NOT NULL)")
+            self.__conn.commit()
+        return self.__conn
+
+def _to_signed(phash: int | None) -> int | None:
+    # SQLite integers are signed 64-bit
+    if phash is None:
+        return None
+    return phash - (1 << 64) if phash >= (1 << 63) else phash
+
+def _to_unsigned(phash: int | None) -> int | None:
+    if phash is None:
+        return None
+    return phash + (1 << 64) if phash < 0 else phash
+
+
+nsfw_verdict_cache = VerdictCache(path=os.getenv("NSFW_CACHE_PATH", "nsfw_cache.db"),
+                                  capacity=int(os.getenv("NSFW_CACHE_CAPACITY", 10000)),
+                                  max_distance=int(os.getenv("NSFW_CACHE_MAX_DISTANCE", 4)))
+""" Process-wide NSFW verdict cache used by VisionEngine """
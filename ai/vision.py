@@ -1,44 +1,116 @@
+import asyncio
+from ai.verdict_cache import Fingerprint, VerdictCache, fingerprint, nsfw_verdict_cache
 import discord
 import io
 from google.cloud import vision
 import os
+from PIL import Image
+from utilities import printlog
 
 class VisionEngine():
 
-    def __init__(self):        
+    BATCH_LIMIT = 16
+    """ Most images the Vision API accepts in one batch_annotate_images request """
+    MAX_ATTEMPTS = 2
+    """ Times an image whose result came back with an error is sent before it's left unclassified """
+
+    def __init__(self, cache: VerdictCache = nsfw_verdict_cache):
         self.__CLIENT = vision.ImageAnnotatorClient()
-        
+        self.cache: VerdictCache = cache
+        """ Verdicts of previously seen images, so reposts skip the remote call """
+        self.max_bytes: int = int(os.getenv("NSFW_MAX_IMAGE_BYTES", 10 * 1024 * 1024))
+        """ Images larger than this are not downloaded, the Vision API fetches them by URL instead """
+        self.max_side: int = int(os.getenv("NSFW_MAX_IMAGE_SIDE", 640))
+        """ Longest side (in pixels) images are downscaled to before classification """
+
     async def check_if_nsfw(self, msg: discord.Message) -> None:
-        if len(msg.attachments) <= 0:
+        images = [attachment for attachment in msg.attachments
+                  if attachment.content_type is not None
+                  and attachment.content_type.startswith("image")]
+        if len(images) <= 0:
+            return
+
+        # read all small images at once, then classify the whole message off the event loop
+        small = [image for image in images if image.size <= self.max_bytes]
+        contents = await asyncio.gather(*[image.read() for image in small], return_exceptions=True)
+        read_images = {image.id: content for image, content in zip(small, contents)
+                       if isinstance(content, bytes)}
+        sources: dict[int, bytes | str] = {**read_images,
+                                           **{image.id: image.url for image in images if image.size > self.max_bytes}}
+        verdicts = await asyncio.to_thread(self.__classify, list(sources.values()))
+        flagged = {attachment_id for attachment_id, verdict in zip(sources.keys(), verdicts) if verdict}
+        if len(flagged) <= 0:
             return
-        
-        # collect the message attachments and mark any 
-        # NSFW images as spoilers
-        resend_attachments = []
-        has_nsfw_content = False
-        for attachment in msg.attachments: 
-            if attachment.content_type is None:
-                continue
-            
-            extension = attachment.content_type.split("/")[-1]
-            attachment_bytes = await attachment.read()
-            new_file = discord.File(fp=io.BytesIO(attachment_bytes), filename=f"bruh.{extension}")
-
-            if attachment.content_type.startswith("image"):
-                image = vision.Image(content=attachment_bytes)
-                if self.__is_nsfw(image):
-                    has_nsfw_content = True
-                    new_file = discord.File(fp=io.BytesIO(image.content), filename=f"bruh.{extension}", spoiler=True) 
-
-            resend_attachments.append(new_file)
-
-        if has_nsfw_content:
-            new_msg_content = (f"**Blurring possible NSFW content in message from {msg.author.mention}**\n"
-                            f"*Original message content:* {msg.content}")
-            await msg.delete()
-            await msg.channel.send(content=new_msg_content, files=resend_attachments)
-
-    def __is_nsfw(self, image: vision.Image) -> bool:
+
+        # only now rebuild the attachments, marking any NSFW images as spoilers
+        resend_attachments = await asyncio.gather(*[self.__to_file(attachment, read_images.get(attachment.id),
+                                                                   attachment.id in flagged)
+                                                    for attachment in msg.attachments])
+        new_msg_content = (f"**Blurring possible NSFW content in message from {msg.author.mention}**\n"
+                        f"*Original message content:* {msg.content}")
+        await msg.delete()
+        await msg.channel.send(content=new_msg_content, files=list(resend_attachments))
+
+    async def __to_file(self, attachment: discord.Attachment, content: bytes | None, spoiler: bool) -> discord.File:
+        if content is None or attachment.content_type is None:
+            return await attachment.to_file(spoiler=spoiler)
+        extension = attachment.content_type.split("/")[-1]
+        return discord.File(fp=io.BytesIO(content), filename=f"bruh.{extension}", spoiler=spoiler)
+
+    def __classify(self, images: list[bytes | str]) -> list[bool]:
+        """ Returns an NSFW verdict per image (given as its bytes, or its URL if it's too large to
+            download). Cached verdicts are reused and the rest are sent, downscaled, in as few batch
+            requests as possible. Images the API keeps failing on are logged and left unflagged """
+        fingerprints: list[Fingerprint | None] = [fingerprint(image) if isinstance(image, bytes) else None
+                                                  for image in images]
+        verdicts: list[bool | None] = [None if fp is None else self.cache.lookup(fp) for fp in fingerprints]
+        misses = [i for i, verdict in enumerate(verdicts) if verdict is None]
+
+        for attempt in range(1, self.MAX_ATTEMPTS + 1):
+            failed = []
+            for start in range(0, len(misses), self.BATCH_LIMIT):
+                chunk = misses[start:start + self.BATCH_LIMIT]
+                requests = [vision.AnnotateImageRequest(
+                                image=self.__to_image(images[i]),
+                                features=[vision.Feature(type_=vision.Feature.Type.SAFE_SEARCH_DETECTION)])
+                            for i in chunk]
+                response = self.__CLIENT.batch_annotate_images(requests=requests)
+                for i, result in zip(chunk, response.responses):
+                    if result.error.message:
+                        failed.append(i)
+                        if attempt == self.MAX_ATTEMPTS:
+                            printlog(f"Couldn't classify image: {result.error.message}")
+                        continue
+                    verdict = self.__is_nsfw(result.safe_search_annotation)
+                    verdicts[i] = verdict
+                    fp = fingerprints[i]
+                    if fp is not None:
+                        self.cache.store(fp, verdict)
+            misses = failed
+            if len(misses) == 0:
+                break
+
+        return [bool(verdict) for verdict in verdicts]
+
+    def __to_image(self, image: bytes | str) -> vision.Image:
+        if isinstance(image, str):
+            return vision.Image(source=vision.ImageSource(image_uri=image))
+        return vision.Image(content=self.__downscale(image))
+
+    def __downscale(self, image_bytes: bytes) -> bytes:
+        """ Shrinks the image so that its longest side is at most max_side and re-encodes it as JPEG """
+        try:
+            with Image.open(io.BytesIO(image_bytes)) as image:
+                if max(image.size) <= self.max_side:
+                    return image_bytes
+                image.thumbnail((self.max_side, self.max_side))
+                output = io.BytesIO()
+                image.convert("RGB").save(output, format="JPEG", quality=85)
+                return output.getvalue()
+        except Exception:
+            return image_bytes
+
+    def __is_nsfw(self, safe_search: vision.SafeSearchAnnotation) -> bool:
         LIKELIHOOD_NAMES = (
             "UNKNOWN",
             "VERY_UNLIKELY",
@@ -48,8 +120,6 @@ class VisionEngine():
             "VERY_LIKELY",
         )
         UNSAFE_SEARCH_INDICATORS = ['UNKNOWN', 'POSSIBLE', 'LIKELY', 'VERY_LIKELY']
-        response = self.__CLIENT.safe_search_detection(image=image)
-        safe_search = response.safe_search_annotation
 
-        return (LIKELIHOOD_NAMES[safe_search.racy] in UNSAFE_SEARCH_INDICATORS or 
-                LIKELIHOOD_NAMES[safe_search.adult] in UNSAFE_SEARCH_INDICATORS)
\ No newline at end of file
+        return (LIKELIHOOD_NAMES[safe_search.racy] in UNSAFE_SEARCH_INDICATORS or
+                LIKELIHOOD_NAMES[safe_search.adult] in UNSAFE_SEARCH_INDICATORS)
@@ -0,0 +1,4 @@
+from archive.store import ArchiveStore, LocalArchiveStore
+from archive.exporter import ChannelExport, ChannelExporter, channel_exporter, read_export, serialize_message
+from archive.search import SearchHit, SearchIndex, search_index
+from archive.attachments import AttachmentReport, AttachmentStore, BandwidthBudget, attachment_store
\ No newline at end of file
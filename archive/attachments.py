@@ -0,0 +1,286 @@
+import aiohttp
+import asyncio
+from archive.exporter import read_export
+from archive.store import ArchiveStore
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from utilities import printlog
+
+class BandwidthBudget:
+    """ Token bucket shared by every download, caps the bytes per second pulled from Discord's CDN """
+
+    def __init__(self, bytes_per_second: float, burst_seconds: float = 1.0) -> None:
+        self.bytes_per_second: float = bytes_per_second
+        """ Sustained download rate (0 or less means unlimited) """
+        self.burst_seconds: float = burst_seconds
+        """ Seconds worth of unused budget that can be spent at once """
+        self.__available_at: float = time.monotonic()
+
+    def __str__(self) -> str:
+        if self.bytes_per_second <= 0:
+            return "BandwidthBudget: unlimited"
+        return f"BandwidthBudget: {self.bytes_per_second / 1024 / 1024:.1f} MiB/s"
+
+    async def consume(self, amount: int) -> None:
+        """ Waits until the given number of bytes fits in the budget """
+        if self.bytes_per_second <= 0:
+            return
+        now = time.monotonic()
+        self.__available_at = max(self.__available_at, now - self.burst_seconds) + amount / self.bytes_per_second
+        delay = self.__available_at - now
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+class AttachmentReport:
+    """ Class that records what archiving a channel's attachments stored and saved """
+
+    def __init__(self) -> None:
+        self.attachments: int = 0
+        """ Number of attachments in the export """
+        self.downloaded_bytes: int = 0
+        """ Bytes pulled from the CDN """
+        self.stored_bytes: int = 0
+        """ Bytes of new blobs written to the store """
+        self.deduplicated_bytes: int = 0
+        """ Bytes of attachments whose blob was already in the store (storage saved) """
+        self.failed: int = 0
+        """ Number of attachments that couldn't be downloaded """
+
+    def __str__(self) -> str:
+        return (f"AttachmentReport: {self.attachments} attachment(s), downloaded {_mib(self.downloaded_bytes)}, "
+                f"stored {_mib(self.stored_bytes)}, storage saved {_mib(self.deduplicated_bytes)}, {self.failed} failed")
+
+    def add(self, other: "AttachmentReport") -> None:
+        """ Folds another report into this one (used for archive run totals) """
+        self.attachments += other.attachments
+        self.downloaded_bytes += other.downloaded_bytes
+        self.stored_bytes += other.stored_bytes
+        self.deduplicated_bytes += other.deduplicated_bytes
+        self.failed += other.failed
+
+class AttachmentStore:
+    """ Content-addressed store of archived attachments. Each distinct file is kept once
+        as a blob named by its SHA-256, and a local SQLite index records which manifest
+        references which blob for each attachment and counts the references per blob """
+
+    CHUNK_SIZE = 64 * 1024
+    """ Bytes read from a download at a time """
+
+    def __init__(self, root: str, budget: BandwidthBudget, concurrency: int = 8, max_bytes: int = 25 * 1024 * 1024) -> None:
+        self.root: str = root
+        """ Directory blobs (and the SQLite index) are kept in """
+        self.budget: BandwidthBudget = budget
+        """ Download rate shared by every archive run """
+        self.concurrency: int = concurrency
+        """ Most downloads in flight per channel """
+        self.max_bytes: int = max_bytes
+        """ Attachments larger than this are not archived """
+        self.__conn: sqlite3.Connection | None = None
+        self.__lock = threading.Lock()
+
+    def __str__(self) -> str:
+        blobs, size, references = self.stats()
+        return (f"AttachmentStore: '{self.root}', {blobs} blob(s) ({_mib(size)}) "
+                f"for {references} attachment(s), {str(self.budget)}")
+
+    def stats(self) -> tuple[int, int, int]:
+        """ Returns the number of blobs, their total size and the number of attachments referencing them """
+        with self.__lock:
+            row = self.__connect().execute("SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(refs), 0) FROM blobs").fetchone()
+        return row[0], row[1], row[2]
+
+    def blob_path(self, sha256: str) -> str:
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    async def archive(self, export_store: ArchiveStore, prefix: str) -> AttachmentReport:
+        """ Stores every attachment of a finished channel export and writes its manifest
+            (attachment ID -> blob) next to the export. Running it again only fetches
+            what's missing, so it resumes after an interruption """
+        report = AttachmentReport()
+        manifest_key = f"{prefix}/attachments.json"
+        records = await asyncio.to_thread(self.__collect, export_store, prefix)
+        report.attachments = len(records)
+        if len(records) == 0:
+            return report
+
+        known = await asyncio.to_thread(self.__known, manifest_key, [record["id"] for record in records])
+        manifest: dict[str, dict] = {}
+        missing = []
+        for record in records:
+            if record["id"] in known:
+                sha, referenced = known[record["id"]]
+                if not referenced: # another manifest holds it, this one takes its own reference
+                    await asyncio.to_thread(self.__reference, manifest_key, record["id"], sha)
+                    report.deduplicated_bytes += record["size"] or 0
+                manifest[str(record["id"])] = self.__manifest_entry(record, sha)
+            elif (record["size"] or 0) <= self.max_bytes:
+                missing.append(record)
+            else:
+                report.failed += 1
+
+        pool = asyncio.Semaphore(self.concurrency)
+        async with aiohttp.ClientSession() as session:
+            async def fetch(record: dict) -> None:
+                async with pool:
+                    try:
+                        sha, size, temp_path = await self.__download(session, record["url"])
+                    except Exception as ex:
+                        printlog(f"Couldn't archive attachment {record['id']} ({record['filename']}): {str(ex)}")
+                        report.failed += 1
+                        return
+                report.downloaded_bytes += size
+                created = await asyncio.to_thread(self.__add, record["id"], sha, size, temp_path, manifest_key)
+                if created:
+                    report.stored_bytes += size
+                else:
+                    report.deduplicated_bytes += size
+                manifest[str(record["id"])] = self.__manifest_entry(record, sha)
+
+            await asyncio.gather(*[fetch(record) for record in missing])
+
+        await asyncio.to_thread(export_store.write, manifest_key, json.dumps(manifest).encode())
+        return report
+
+    def release(self, export_store: ArchiveStore, prefix: str) -> int:
+        """ Drops the references a channel's manifest holds and deletes blobs nobody references
+            anymore, returns the number of blobs deleted """
+        manifest_key = f"{prefix}/attachments.json"
+        with self.__lock:
+            conn = self.__connect()
+            rows = conn.execute("SELECT sha256 FROM refs WHERE manifest = ?", (manifest_key,)).fetchall()
+            conn.execute("DELETE FROM refs WHERE manifest = ?", (manifest_key,))
+            for (sha,) in rows:
+                conn.execute("UPDATE blobs SET refs = refs - 1 WHERE sha256 = ?", (sha,))
+            orphans = [sha for (sha,) in conn.execute("SELECT sha256 FROM blobs WHERE refs <= 0").fetchall()]
+            conn.execute("DELETE FROM blobs WHERE refs <= 0")
+            conn.commit()
+        for sha in orphans:
+            try:
+                os.remove(self.blob_path(sha))
+            except FileNotFoundError:
+                pass
+        export_store.delete(manifest_key)
+        return len(orphans)
+
+    async def __download(self, session: aiohttp.ClientSession, url: str) -> tuple[str, int, str]:
+        """ Streams a download to a temporary file within the budget, hashing it on the way.
+            Returns its SHA-256, size and the temporary file's path """
+        temp_dir = os.path.join(self.root, "tmp")
+        os.makedirs(temp_dir, exist_ok=True)
+        temp_path = os.path.join(temp_dir, uuid.uuid4().hex)
+        sha = hashlib.sha256()
+        size = 0
+        try:
+            async with session.get(url) as response:
+                response.raise_for_status()
+                with open(temp_path, "wb") as file:
+                    async for chunk in response.content.iter_chunked(AttachmentStore.CHUNK_SIZE):
+                        await self.budget.consume(len(chunk))
+                        sha.update(chunk)
+                        file.write(chunk)
+                        size += len(chunk)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        return sha.hexdigest(), size, temp_path
+
+    def __add(self, attachment_id: int, sha: str, size: int, temp_path: str, manifest_key: str) -> bool:
+        """ Moves a download into the store (or drops it if the blob already exists) and
+            references the blob from the manifest. Returns whether a new blob was written """
+        with self.__lock:
+            conn = self.__connect()
+            created = conn.execute("SELECT 1 FROM blobs WHERE sha256 = ?", (sha,)).fetchone() is None
+            path = self.blob_path(sha)
+            if created or not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(temp_path, path)
+            else:
+                os.remove(temp_path)
+            conn.execute("INSERT INTO blobs (sha256, size, refs) VALUES (?, ?, 0) ON CONFLICT(sha256) DO NOTHING", (sha, size))
+            self.__add_reference(conn, manifest_key, attachment_id, sha)
+            conn.commit()
+        return created
+
+    def __reference(self, manifest_key: str, attachment_id: int, sha: str) -> None:
+        """ References a blob the store already has from the manifest """
+        with self.__lock:
+            conn = self.__connect()
+            self.__add_reference(conn, manifest_key, attachment_id, sha)
+            conn.commit()
+
+    @staticmethod
+    def __add_reference(conn: sqlite3.Connection, manifest_key: str, attachment_id: int, sha: str) -> None:
+        # a manifest only ever holds one reference per attachment
+        if conn.execute("INSERT OR IGNORE INTO refs (manifest, attachment_id, sha256) VALUES (?, ?, ?)",
+                        (manifest_key, attachment_id, sha)).rowcount > 0:
+            conn.execute("UPDATE blobs SET refs = refs + 1 WHERE sha256 = ?", (sha,))
+
+    def __known(self, manifest_key: str, attachment_ids: list[int]) -> dict[int, tuple[str, bool]]:
+        """ (blob, whether the manifest already references it) of the attachments the store
+            already has, keyed by attachment ID """
+        result = {}
+        with self.__lock:
+            conn = self.__connect()
+            for start in range(0, len(attachment_ids), 500):
+                batch = attachment_ids[start:start + 500]
+                placeholders = ", ".join(["?"] * len(batch))
+                rows = conn.execute(f"SELECT attachment_id, sha256, manifest FROM refs "
+                                    f"WHERE attachment_id IN ({placeholders})", batch).fetchall()
+                for attachment_id, sha, manifest in rows:
+                    referenced = manifest == manifest_key or result.get(attachment_id, (sha, False))[1]
+                    result[attachment_id] = (sha, referenced)
+        return result
+
+    @staticmethod
+    def __collect(export_store: ArchiveStore, prefix: str) -> list[dict]:
+        records = []
+        for message in read_export(export_store, prefix):
+            for attachment in message["attachments"]:
+                attachment["message_id"] = message["id"]
+                records.append(attachment)
+        return records
+
+    @staticmethod
+    def __manifest_entry(record: dict, sha: str) -> dict:
+        return {
+            "sha256": sha,
+            "message_id": record["message_id"],
+            "filename": record["filename"],
+            "size": record["size"],
+            "content_type": record["content_type"]
+        }
+
+    def __connect(self) -> sqlite3.Connection:
+        if self.__conn is None:
+            os.makedirs(self.root, exist_ok=True)
+            self.__conn = sqlite3.connect(os.path.join(self.root, "index.db"), check_same_thread=False)
+            self.__conn.execute("CREATE TABLE IF NOT EXISTS blobs "
+                                "(sha256 TEXT PRIMARY KEY, size INTEGER NOT NULL, refs INTEGER NOT NULL)")
+            self.__conn.execute("CREATE TABLE IF NOT EXISTS refs (manifest TEXT NOT NULL, attachment_id INTEGER NOT NULL, "
+                                "sha256 TEXT NOT NULL, PRIMARY KEY (manifest, attachment_id))")
+            self.__conn.execute("CREATE INDEX IF NOT EXISTS refs_attachment ON refs (attachment_id)")
+            # stores created before references were per manifest kept a single owner per attachment
+            if self.__conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'attachments'").fetchone():
+                self.__conn.execute("INSERT OR IGNORE INTO refs (manifest, attachment_id, sha256) "
+                                    "SELECT manifest, attachment_id, sha256 FROM attachments")
+                self.__conn.execute("DROP TABLE attachments")
+            self.__conn.commit()
+        return self.__conn
+
+def _mib(size: int) -> str:
+    return f"{size / 1024 / 1024:.1f} MiB"
+
+
+attachment_store: AttachmentStore = AttachmentStore(
+    root=os.getenv("ARCHIVE_ATTACHMENT_DIR", "archives/blobs"),
+    budget=BandwidthBudget(float(os.getenv("ARCHIVE_ATTACHMENT_BYTES_PER_SECOND", 8 * 1024 * 1024))),
+    concurrency=int(os.getenv("ARCHIVE_ATTACHMENT_CONCURRENCY", 8)),
+    max_bytes=int(os.getenv("ARCHIVE_ATTACHMENT_MAX_BYTES", 25 * 1024 * 1024))
+)
+""" Attachment store used by the archive run """
@@ -0,0 +1,251 @@
+import asyncio
+from archive.store import ArchiveStore, LocalArchiveStore
+from datetime import datetime, timedelta, UTC
+import discord
+import gzip
+import json
+import os
+import time
+from typing import Iterator
+from utilities import printlog
+
+def serialize_message(message: discord.Message) -> dict:
+    """ JSON-ready record of a message as it's written to an export """
+    return {
+        "id": message.id,
+        "created_at": message.created_at.isoformat(),
+        "edited_at": None if message.edited_at is None else message.edited_at.isoformat(),
+        "author_id": message.author.id,
+        "author_name": message.author.name,
+        "content": message.content,
+        "attachments": [{
+            "id": attachment.id,
+            "filename": attachment.filename,
+            "url": attachment.url,
+            "size": attachment.size,
+            "content_type": attachment.content_type
+        } for attachment in message.attachments],
+        "embeds": len(message.embeds),
+        "reply_to": None if message.reference is None else message.reference.message_id,
+        "pinned": message.pinned
+    }
+
+def read_export(store: ArchiveStore, prefix: str) -> Iterator[dict]:
+    """ Yields every message record of a finished export, oldest first, one part in memory at a time """
+    for key in store.keys(prefix):
+        if not key.endswith(".jsonl.gz"):
+            continue
+        data = store.read(key)
+        if data is None:
+            continue
+        for line in gzip.decompress(data).splitlines():
+            if len(line) > 0:
+                yield json.loads(line)
+
+class ChannelExport:
+    """ Class that records how a channel's history export went """
+
+    def __init__(self, channel: discord.TextChannel, prefix: str) -> None:
+        self.channel: discord.TextChannel = channel
+        """ Pycord TextChannel object that was exported """
+        self.prefix: str = prefix
+        """ Store key prefix the export's parts, checkpoint and manifest live under """
+        self.messages: int = 0
+        """ Number of messages in the export """
+        self.bytes: int = 0
+        """ Compressed size of the export """
+        self.windows: int = 0
+        """ Number of time windows the history was split into """
+        self.resumed_windows: int = 0
+        """ Windows finished by an earlier, interrupted export """
+        self.seconds: float = 0.0
+        """ Time spent exporting """
+
+    def __str__(self) -> str:
+        resumed = f", resumed {self.resumed_windows}" if self.resumed_windows > 0 else ""
+        return (f"ChannelExport: '{self.channel.name}' {self.messages} message(s), "
+                f"{self.bytes / 1024:.0f} KiB in {self.windows} window(s){resumed}, {self.seconds:.1f}s")
+
+class ChannelExporter:
+    """ Class that streams a channel's full message history into gzipped JSON-lines parts.\n
+        The history is split into time windows that are fetched concurrently, each window is
+        written one page at a time as its own part, and finished windows are checkpointed so
+        an interrupted export picks up where it stopped """
+
+    PAGE_SIZE = 100
+    """ Messages per history request (Discord's maximum), also the write batch size """
+    MAX_WINDOW_ATTEMPTS = 3
+    """ Attempts per window before the export gives up (finished windows are kept) """
+
+    def __init__(self, store: ArchiveStore, concurrency: int = 4, window: timedelta = timedelta(days=7)) -> None:
+        self.store: ArchiveStore = store
+        """ Where exports are written """
+        self.concurrency: int = concurrency
+        """ Most windows fetched at once """
+        self.window: timedelta = window
+        """ Span of history each window covers """
+
+    def __str__(self) -> str:
+        return f"ChannelExporter: {str(self.store)}, {self.concurrency} concurrent window(s) of {self.window.days} day(s)"
+
+    @staticmethod
+    def prefix(channel: discord.TextChannel) -> str:
+        return ChannelExporter.key_prefix(channel.guild.id, channel.id)
+
+    @staticmethod
+    def key_prefix(guild_id: int, channel_id: int) -> str:
+        return f"{guild_id}/{channel_id}"
+
+    def exported_channels(self, guild_id: int) -> list[int]:
+        """ IDs of the guild's channels that have an export (finished or not) in the store """
+        channel_ids = {int(key.split("/")[1]) for key in self.store.keys(str(guild_id)) if key.count("/") >= 2}
+        return sorted(channel_ids)
+
+    def delete(self, prefix: str) -> int:
+        """ Deletes every object of an export, returns the number deleted """
+        keys = self.store.keys(prefix)
+        for key in keys:
+            self.store.delete(key)
+        return len(keys)
+
+    async def export(self, channel: discord.TextChannel) -> ChannelExport:
+        """ Exports the channel's history up to now. An interrupted export is resumed first, and
+            a finished one is extended with the messages sent since it finished, so a channel
+            archived after its export (e.g. once a postponed archive is retried) is exported in full """
+        prefix = ChannelExporter.prefix(channel)
+        result = ChannelExport(channel, prefix)
+        start = time.perf_counter()
+
+        checkpoint = await asyncio.to_thread(self.__read_json, f"{prefix}/checkpoint.json")
+        if checkpoint is None:
+            manifest = await asyncio.to_thread(self.__read_json, f"{prefix}/manifest.json")
+            now = datetime.now(tz=UTC)
+            if manifest is None:
+                checkpoint = self.__new_checkpoint(channel.id, now, channel.id, 0, { "messages": 0, "bytes": 0, "parts": [] })
+            else:
+                # picks up right where the finished export's last window stopped
+                base = { "messages": manifest["messages"], "bytes": manifest["bytes"], "parts": manifest["parts"] }
+                checkpoint = self.__new_checkpoint(channel.id, now, discord.utils.time_snowflake(
+                    datetime.fromisoformat(manifest["until"])), manifest["windows"], base)
+        until = datetime.fromisoformat(checkpoint["until"])
+        window = timedelta(seconds=checkpoint["window_seconds"])
+        first_index = checkpoint.get("first_index", 0)
+        base = checkpoint.get("base", { "messages": 0, "bytes": 0, "parts": [] })
+        windows = self.__windows(checkpoint.get("first_id", channel.id), until, window)
+        result.windows = first_index + len(windows)
+        result.resumed_windows = first_index + len(checkpoint["done"])
+
+        pool = asyncio.Semaphore(self.concurrency)
+        checkpoint_lock = asyncio.Lock()
+
+        async def export_window(index: int, after: int, before: int) -> None:
+            if str(index) in checkpoint["done"]:
+                return
+            async with pool:
+                for attempt in range(1, ChannelExporter.MAX_WINDOW_ATTEMPTS + 1):
+                    try:
+                        messages, size = await self.__export_window(channel, f"{prefix}/part-{index:05d}.jsonl.gz",
+                                                                    after, before)
+                        break
+                    except discord.HTTPException as ex:
+                        if attempt == ChannelExporter.MAX_WINDOW_ATTEMPTS:
+                            raise
+                        printlog(f"Export of '{channel.name}' window {index} failed (attempt {attempt}): {str(ex)}")
+                        await asyncio.sleep(2 ** attempt)
+            async with checkpoint_lock:
+                checkpoint["done"][str(index)] = { "messages": messages, "bytes": size }
+                await asyncio.to_thread(self.__write_json, f"{prefix}/checkpoint.json", checkpoint)
+
+        # a failing window cancels the rest, so nothing keeps writing to the store after export() raised
+        try:
+            async with asyncio.TaskGroup() as group:
+                for index, (after, before) in enumerate(windows, start=first_index):
+                    group.create_task(export_window(index, after, before))
+        except ExceptionGroup as ex:
+            raise ex.exceptions[0]
+
+        result.messages = base["messages"] + sum([part["messages"] for part in checkpoint["done"].values()])
+        result.bytes = base["bytes"] + sum([part["bytes"] for part in checkpoint["done"].values()])
+        manifest = {
+            "guild_id": channel.guild.id,
+            "channel_id": channel.id,
+            "channel_name": channel.name,
+            "created_at": channel.created_at.isoformat(),
+            "until": checkpoint["until"],
+            "windows": result.windows,
+            "messages": result.messages,
+            "bytes": result.bytes,
+            "parts": base["parts"] + [f"part-{int(index):05d}.jsonl.gz" 
+                                      for index, part in sorted(checkpoint["done"].items(), key=lambda item: int(item[0]))
+                                      if part["messages"] > 0]
+        }
+        await asyncio.to_thread(self.__write_json, f"{prefix}/manifest.json", manifest)
+        await asyncio.to_thread(self.store.delete, f"{prefix}/checkpoint.json")
+        result.seconds = time.perf_counter() - start
+        return result
+
+    def __new_checkpoint(self, channel_id: int, until: datetime, first_id: int, first_index: int, base: dict) -> dict:
+        """ Checkpoint of an export covering IDs from first_id up to until. first_index and base
+            carry the window count and totals of the finished export it extends (if any) """
+        return {
+            "channel_id": channel_id,
+            "until": until.isoformat(),
+            "window_seconds": self.window.total_seconds(),
+            "first_id": first_id,
+            "first_index": first_index,
+            "base": base,
+            "done": {}
+        }
+
+    async def __export_window(self, channel: discord.TextChannel, key: str,
+                              after: int, before: int) -> tuple[int, int]:
+        """ Streams one window of history into its part, a page at a time.
+            Returns the number of messages and the compressed size """
+        count = 0
+        page: list[bytes] = []
+        with self.store.writer(key) as raw:
+            compressed = gzip.GzipFile(fileobj=raw, mode="wb")
+            async for message in channel.history(limit=None, after=discord.Object(id=after),
+                                                  before=discord.Object(id=before), oldest_first=True):
+                page.append(json.dumps(serialize_message(message)).encode() + b"\n")
+                if len(page) >= ChannelExporter.PAGE_SIZE:
+                    await asyncio.to_thread(compressed.write, b"".join(page))
+                    count += len(page)
+                    page = []
+            if len(page) > 0:
+                await asyncio.to_thread(compressed.write, b"".join(page))
+                count += len(page)
+            compressed.close()
+            size = raw.tell()
+        if count == 0:
+            self.store.delete(key) # nothing to keep, the checkpoint still marks the window done
+            size = 0
+        return count, size
+
+    @staticmethod
+    def __windows(first_id: int, until: datetime, window: timedelta) -> list[tuple[int, int]]:
+        """ Splits the history into (after, before) snowflake bounds. Both bounds are exclusive,
+            so window i covers IDs [boundary i, boundary i+1) with no gaps or overlaps """
+        boundaries = [first_id]
+        last = discord.utils.time_snowflake(until)
+        step = discord.utils.time_snowflake(discord.utils.snowflake_time(first_id) + window) - first_id
+        while boundaries[-1] < last:
+            boundaries.append(min(boundaries[-1] + max(step, 1), last))
+        if len(boundaries) == 1:
+            boundaries.append(last + 1)
+        return [(after - 1, before) for after, before in zip(boundaries, boundaries[1:])]
+
+    def __read_json(self, key: str) -> dict | None:
+        data = self.store.read(key)
+        return None if data is None else json.loads(data)
+
+    def __write_json(self, key: str, data: dict) -> None:
+        self.store.write(key, json.dumps(data).encode())
+
+
+channel_exporter: ChannelExporter = ChannelExporter(
+    store=LocalArchiveStore(os.getenv("ARCHIVE_EXPORT_DIR", "archives")),
+    concurrency=int(os.getenv("ARCHIVE_EXPORT_CONCURRENCY", 4)),
+    window=timedelta(days=float(os.getenv("ARCHIVE_EXPORT_WINDOW_DAYS", 7)))
+)
+""" Exporter used by the archive run """
@@ -0,0 +1,197 @@
+from archive.exporter import read_export
+from archive.store import ArchiveStore
+from datetime import datetime
+import discord
+import json
+import os
+import sqlite3
+import threading
+import time
+
+class SearchHit:
+    """ A message matched by a search """
+
+    def __init__(self, row: tuple) -> None:
+        self.message_id: int = row[0]
+        """ ID of the matched message """
+        self.guild_id: int = row[1]
+        """ ID of the guild the message was sent in """
+        self.channel_id: int = row[2]
+        """ ID of the channel the message was sent in """
+        self.author_name: str = row[3]
+        """ Username of the author when the message was indexed """
+        self.created_at: datetime = datetime.fromtimestamp(row[4])
+        """ When the message was sent """
+        self.snippet: str = row[5]
+        """ Part of the message around the matched terms, with the terms in bold """
+
+    def jump_url(self) -> str:
+        return f"https://discord.com/channels/{self.guild_id}/{self.channel_id}/{self.message_id}"
+
+class SearchIndex:
+    """ Local full-text index of messages (SQLite FTS5). Filled from finished channel exports
+        and from live messages, which are buffered and written in batches """
+
+    def __init__(self, path: str, max_pending: int = 200, max_age: float = 5.0) -> None:
+        self.path: str = path
+        """ Location of the SQLite index """
+        self.max_pending: int = max_pending
+        """ Buffered live messages that trigger a flush """
+        self.max_age: float = max_age
+        """ Seconds a live message can wait in the buffer before a flush is due """
+        self.searches: int = 0
+        """ Number of searches run """
+        self.last_search_ms: float = 0.0
+        """ Duration of the last search """
+        self.__pending: dict[int, tuple] = {}
+        self.__oldest: float | None = None
+        self.__conn: sqlite3.Connection | None = None
+        self.__lock = threading.Lock()
+        self.__pending_lock = threading.Lock()
+
+    def __str__(self) -> str:
+        with self.__lock:
+            conn = self.__connect()
+            messages = conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+            exports = conn.execute("SELECT COUNT(*) FROM indexed_exports").fetchone()[0]
+        return (f"SearchIndex: '{self.path}', {messages} message(s) from {exports} export(s) and live traffic, "
+                f"{len(self.__pending)} pending, searches={self.searches}, last_search={self.last_search_ms:.1f}ms")
+
+    def buffer(self, message: discord.Message) -> bool:
+        """ Queues a live message for indexing, returns whether a flush is due """
+        if message.guild is None or len(message.content) == 0:
+            return False
+        with self.__pending_lock:
+            self.__pending[message.id] = (message.id, message.guild.id, message.channel.id, message.author.id,
+                                          message.author.name, message.created_at.timestamp(), message.content)
+            if self.__oldest is None:
+                self.__oldest = time.monotonic()
+        return self.is_due()
+
+    def is_due(self) -> bool:
+        return len(self.__pending) >= self.max_pending or (
+            self.__oldest is not None and time.monotonic() - self.__oldest >= self.max_age)
+
+    def flush(self) -> int:
+        """ Writes buffered live messages, returns the number written """
+        with self.__pending_lock:
+            rows = list(self.__pending.values())
+            self.__pending = {}
+            self.__oldest = None
+        if len(rows) > 0:
+            self.__write(rows)
+        return len(rows)
+
+    def index_export(self, store: ArchiveStore, prefix: str, batch_size: int = 5000) -> int:
+        """ Indexes a finished channel export, returns the number of messages indexed. An export is
+            only indexed again once it has been extended past when it was last indexed """
+        data = store.read(f"{prefix}/manifest.json")
+        if data is None:
+            raise Exception(f"Export '{prefix}' isn't finished")
+        manifest = json.loads(data)
+        with self.__lock:
+            row = self.__connect().execute("SELECT indexed_at FROM indexed_exports WHERE prefix = ?", (prefix,)).fetchone()
+        if row is not None and row[0] >= datetime.fromisoformat(manifest["until"]).timestamp():
+            return 0
+
+        count = 0
+        batch = []
+        for message in read_export(store, prefix):
+            if len(message["content"]) == 0:
+                continue
+            batch.append((message["id"], manifest["guild_id"], manifest["channel_id"], message["author_id"],
+                          message["author_name"], datetime.fromisoformat(message["created_at"]).timestamp(),
+                          message["content"]))
+            if len(batch) >= batch_size:
+                count += self.__write(batch)
+                batch = []
+        if len(batch) > 0:
+            count += self.__write(batch)
+        with self.__lock:
+            conn = self.__connect()
+            conn.execute("INSERT OR REPLACE INTO indexed_exports (prefix, messages, indexed_at) VALUES (?, ?, ?)",
+                         (prefix, count, time.time()))
+            conn.commit()
+        return count
+
+    def remove_channel(self, prefix: str, channel_id: int) -> int:
+        """ Drops a channel's messages (and the record of its export being indexed), returns the number dropped """
+        with self.__lock:
+            conn = self.__connect()
+            conn.execute("DELETE FROM messages_fts WHERE rowid IN (SELECT id FROM messages WHERE channel_id = ?)", (channel_id,))
+            removed = conn.execute("DELETE FROM messages WHERE channel_id = ?", (channel_id,)).rowcount
+            conn.execute("DELETE FROM indexed_exports WHERE prefix = ?", (prefix,))
+            conn.commit()
+        return removed
+
+    def search(self, guild_id: int, terms: list[str], readable_channel_ids: list[int], author_id: int | None = None, 
+               channel_id: int | None = None, after: datetime | None = None, before: datetime | None = None, 
+               limit: int = 10) -> list[SearchHit]:
+        """ Best matches (BM25) for every term in the guild's messages from the channels the searcher
+            can read, optionally narrowed down by author, channel and date. Terms are quoted so user
+            input can't break the query """
+        if len(readable_channel_ids) == 0:
+            return []
+        start = time.perf_counter()
+        query = " ".join(['"' + term.replace('"', '""') + '"' for term in terms if len(term) > 0])
+        sql = ("SELECT m.id, m.guild_id, m.channel_id, m.author_name, m.created_at, "
+               "snippet(messages_fts, 0, '**', '**', '...', 16) "
+               "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+               "WHERE messages_fts MATCH ? AND m.guild_id = ?")
+        sql += f" AND m.channel_id IN ({', '.join(['?'] * len(readable_channel_ids))})"
+        params: list = [query, guild_id, *readable_channel_ids]
+        if author_id is not None:
+            sql += " AND m.author_id = ?"
+            params.append(author_id)
+        if channel_id is not None:
+            sql += " AND m.channel_id = ?"
+            params.append(channel_id)
+        if after is not None:
+            sql += " AND m.created_at >= ?"
+            params.append(after.timestamp())
+        if before is not None:
+            sql += " AND m.created_at < ?"
+            params.append(before.timestamp())
+        sql += " ORDER BY bm25(messages_fts) LIMIT ?"
+        params.append(limit)
+        with self.__lock:
+            rows = self.__connect().execute(sql, params).fetchall()
+        self.searches += 1
+        self.last_search_ms = (time.perf_counter() - start) * 1000
+        return [SearchHit(row) for row in rows]
+
+    def __write(self, rows: list[tuple]) -> int:
+        """ Upserts messages, re-indexed messages (e.g. live ones that later show up
+            in an export) replace their old entry """
+        with self.__lock:
+            conn = self.__connect()
+            ids = [(row[0],) for row in rows]
+            conn.executemany("DELETE FROM messages_fts WHERE rowid = ?", ids)
+            conn.executemany("INSERT OR REPLACE INTO messages (id, guild_id, channel_id, author_id, author_name, created_at) "
+                             "VALUES (?, ?, ?, ?, ?, ?)", [row[:6] for row in rows])
+            conn.executemany("INSERT INTO messages_fts (rowid, content) VALUES (?, ?)", [(row[0], row[6]) for row in rows])
+            conn.commit()
+        return len(rows)
+
+    def __connect(self) -> sqlite3.Connection:
+        if self.__conn is None:
+            directory = os.path.dirname(self.path)
+            if len(directory) > 0:
+                os.makedirs(directory, exist_ok=True)
+            self.__conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.__conn.execute("PRAGMA journal_mode=WAL")
+            self.__conn.execute("CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, guild_id INTEGER NOT NULL, "
+                                "channel_id INTEGER NOT NULL, author_id INTEGER NOT NULL, author_name TEXT NOT NULL, "
+                                "created_at REAL NOT NULL)")
+            self.__conn.execute("CREATE INDEX IF NOT EXISTS messages_guild_created ON messages (guild_id, created_at)")
+            self.__conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(content, tokenize='unicode61')")
+            self.__conn.execute("CREATE TABLE IF NOT EXISTS indexed_exports "
+                                "(prefix TEXT PRIMARY KEY, messages INTEGER NOT NULL, indexed_at REAL NOT NULL)")
+            self.__conn.commit()
+        return self.__conn
+
+
+search_index: SearchIndex = SearchIndex(path=os.getenv("SEARCH_INDEX_PATH", "archives/search.db"),
+                                        max_pending=int(os.getenv("SEARCH_INDEX_MAX_PENDING", 200)),
+                                        max_age=float(os.getenv("SEARCH_INDEX_MAX_AGE", 5.0)))
+""" Search index behind the search command """
@@ -0,0 +1,91 @@
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+import os
+from typing import BinaryIO, Iterator
+
+class ArchiveStore(ABC):
+    """ Where archive exports are written. Keys are '/'-separated paths and, like an object
+        store, an object only becomes visible once it has been written in full """
+
+    @abstractmethod
+    def writer(self, key: str):
+        """ Context manager yielding a binary file, the object is committed when it exits cleanly """
+        raise NotImplementedError
+
+    @abstractmethod
+    def read(self, key: str) -> bytes | None:
+        """ Returns the object's bytes, None if it doesn't exist """
+        raise NotImplementedError
+
+    def write(self, key: str, data: bytes) -> None:
+        with self.writer(key) as file:
+            file.write(data)
+
+    @abstractmethod
+    def exists(self, key: str) -> bool:
+        raise NotImplementedError
+
+    @abstractmethod
+    def keys(self, prefix: str) -> list[str]:
+        """ Keys of every committed object under the prefix """
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+class LocalArchiveStore(ArchiveStore):
+    """ ArchiveStore backed by a directory on local disk. Writes go to a temporary file
+        that's renamed into place, so interrupted writes never leave a partial object """
+
+    def __init__(self, root: str) -> None:
+        self.root: str = root
+        """ Directory every object is stored under """
+
+    def __str__(self) -> str:
+        return f"LocalArchiveStore: '{self.root}'"
+
+    @contextmanager
+    def writer(self, key: str) -> Iterator[BinaryIO]:
+        path = self.__path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.tmp"
+        try:
+            with open(temp_path, "wb") as file:
+                yield file
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def read(self, key: str) -> bytes | None:
+        try:
+            with open(self.__path(key), "rb") as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def exists(self, key: str) -> bool:
+        return os.path.isfile(self.__path(key))
+
+    def keys(self, prefix: str) -> list[str]:
+        directory = self.__path(prefix)
+        if not os.path.isdir(directory):
+            return []
+        result = []
+        for folder, _, files in os.walk(directory):
+            for name in files:
+                if not name.endswith(".tmp"):
+                    relative = os.path.relpath(os.path.join(folder, name), self.root)
+                    result.append(relative.replace(os.sep, "/"))
+        return sorted(result)
+
+    def delete(self, key: str) -> None:
+        try:
+            os.remove(self.__path(key))
+        except FileNotFoundError:
+            pass
+
+    def __path(self, key: str) -> str:
+        parts = [part for part in key.split("/") if part not in ("", ".", "..")]
+        return os.path.join(self.root, *parts)
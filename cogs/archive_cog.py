@@ -3,17 +3,51 @@ import discord
 from discord.ext.commands import Cog
 from discord.ext import commands
 import discord.utils
-import database as db
-from datetime import timedelta, datetime
-from pytz import timezone
+from database import aio as adb
+from archive import AttachmentStore, ChannelExporter, SearchIndex, attachment_store, channel_exporter, search_index
+from database import ServerSettings
+from datetime import timedelta, datetime, UTC
+from globals import servers
+from models import ArchiveResult, ArchiveRun, ArchiveSchedule
+import os
+from pytz import all_timezones_set, timezone
+import random
+import re
+import time
 from typing import cast
 from utilities import printlog
 
 class ArchiveCog(Cog, name="Archive"):
     """ Class containing commands pertaining to archiving general chat """
    
-    def __init__(self, bot: discord.Bot) -> None:
+    CONCURRENCY = int(os.getenv("ARCHIVE_CONCURRENCY", 8))
+    """ Most guilds archived at once """
+    MAX_ATTEMPTS = int(os.getenv("ARCHIVE_MAX_ATTEMPTS", 5))
+    """ Attempts per guild before it's recorded as failed """
+    BASE_BACKOFF = 2.0
+    """ Seconds waited before the first retry (doubles every attempt) """
+    MAX_BACKOFF = 60.0
+    """ Longest wait between attempts """
+    EXPORT_RETRY = timedelta(minutes=float(os.getenv("ARCHIVE_EXPORT_RETRY_MINUTES", 60)))
+    """ How long an archive is postponed when the history export didn't finish """
+
+    def __init__(self, bot: discord.Bot, exporter: ChannelExporter = channel_exporter, 
+                 attachments: AttachmentStore = attachment_store, search: SearchIndex = search_index) -> None:
         self.bot = bot
+        self.exporter: ChannelExporter = exporter
+        """ Streams general chat's history to the archive store before it's archived """
+        self.attachments: AttachmentStore = attachments
+        """ Deduplicated store the exported attachments are kept in """
+        self.search: SearchIndex = search
+        """ Full-text index exports (and live messages) are added to """
+        self.last_run: ArchiveRun | None = None
+        """ Outcome of the most recent archive run """
+        self.schedule: ArchiveSchedule = ArchiveSchedule()
+        """ Next archive date of every guild, loaded once at startup """
+        self.__wake: asyncio.Event = asyncio.Event()
+        self.__postponed: dict[int, datetime] = {}
+        self.__pool: asyncio.Semaphore = asyncio.Semaphore(ArchiveCog.CONCURRENCY)
+        self.__runs: set[asyncio.Task] = set()
     
     #region Commands
     
@@ -23,77 +57,340 @@ class ArchiveCog(Cog, name="Archive"):
         if ctx.guild is None: 
             raise Exception("ctx.guild is None")
         if ctx.author.id == ctx.guild.owner_id:
-            await self.archive_general(ctx.guild)
+            result = await self.archive_general(ctx.guild, self.schedule.next_runs.get(ctx.guild.id))
+            printlog(f"general {str(result)}")
+            if not result.success:
+                export_error = "" if result.export_error is None else f" ({result.export_error})"
+                await ctx.send(f"Couldn't archive general: {result.error}{export_error}")
         else:
             await ctx.send("Only the owner can use this command")
             
     @commands.command(name="nextarchivedate", aliases=["nextarchive"])
     async def next_archive_date_command(self, ctx: commands.Context) -> None:
-        """ Command that sends the date of the next general chat archive. 
-            Assumes global archive date """
+        """ Command that sends the date of the next general chat archive in this server """
         if ctx.guild is None: 
             raise Exception("ctx.guild is None")
-        eastern = timezone("US/Eastern")
-        date = db.get_next_archive_date()
+        when = self.schedule.next_runs.get(ctx.guild.id)
+        if when is None:
+            await ctx.send("General chat isn't scheduled to be archived")
+            return
+        settings = await adb.get_server_settings(ctx.guild)
+        date = when.astimezone(timezone(settings.timezone))
         hour = date.hour % 12
         if date.hour == 12 or date.hour == 0:
             hour = "12"
         meridiem = "AM" if date.hour < 12 else "PM"
         dt_str = (f"{date.month}/{date.day}/{date.year} {hour}:{date.minute:<02} "
-                  f"{meridiem} EST")
+                  f"{meridiem} {date.strftime('%Z')}")
         await ctx.send(f"Next archive date: {dt_str}")
+
+    @commands.command(name="archiveschedule", aliases=["archiveinterval"])
+    async def archive_schedule_command(self, ctx: commands.Context, weeks: int, tz: str | None = None) -> None:
+        """ Command that sets how often (in weeks) general chat gets archived, and optionally
+            the timezone the schedule follows. The next archive keeps its local time of day """
+        if ctx.guild is None: 
+            raise Exception("ctx.guild is None")
+        if ctx.author.id != ctx.guild.owner_id:
+            await ctx.send("Only the owner can use this command")
+            return
+        settings = await adb.get_server_settings(ctx.guild)
+        tz = settings.timezone if tz is None else tz
+        if weeks < 1:
+            await ctx.send("The archive interval has to be at least 1 week")
+            return
+        if tz not in all_timezones_set:
+            await ctx.send(f"'{tz}' isn't a timezone I know (try something like US/Eastern)")
+            return
+
+        now = datetime.now(tz=UTC)
+        current = self.schedule.next_runs.get(ctx.guild.id)
+        if current is None:
+            next_archive = now + timedelta(weeks=weeks)
+        else:
+            wall_clock = current.astimezone(timezone(settings.timezone)).replace(tzinfo=None)
+            next_archive = ArchiveSchedule.following(timezone(tz).localize(wall_clock).astimezone(UTC), 
+                                                     weeks, tz, now)
+        await adb.set_archive_schedule(ctx.guild, weeks, tz, next_archive)
+        server = servers.get(ctx.guild)
+        if server is not None:
+            server.reload_settings(await adb.get_server_settings(ctx.guild))
+        self.schedule.set(ctx.guild.id, next_archive)
+        self.__wake.set()
+        await ctx.send(f"General chat will be archived every {weeks} week(s) ({tz})")
+        
+    @commands.command(name="deletearchive", aliases=["deleteexport"])
+    async def delete_archive_command(self, ctx: commands.Context, channel_id: int) -> None:
+        """ Command that deletes a channel's history export, its search entries and the attachments
+            nothing else references """
+        if ctx.guild is None: 
+            raise Exception("ctx.guild is None")
+        if ctx.author.id != ctx.guild.owner_id:
+            await ctx.send("Only the owner can use this command")
+            return
+        if channel_id not in await asyncio.to_thread(self.exporter.exported_channels, ctx.guild.id):
+            await ctx.send("That channel hasn't been exported")
+            return
+        objects, blobs = await self.remove_export(ctx.guild.id, channel_id)
+        await ctx.send(f"Deleted the export ({objects} object(s)) and {blobs} attachment(s) nothing else used")
+
+    @commands.command(name="search", aliases=["find"])
+    async def search_command(self, ctx: commands.Context, *words: str) -> None:
+        """ Command that searches this server's archived (and recent) messages. Narrow it down
+            with from:@user, in:#channel, after:YYYY-MM-DD and before:YYYY-MM-DD """
+        if ctx.guild is None: 
+            raise Exception("ctx.guild is None")
+        settings = await adb.get_server_settings(ctx.guild)
+        zone = timezone(settings.timezone)
+        terms: list[str] = []
+        filters: dict = {}
+        try:
+            for word in words:
+                key, _, value = word.partition(":")
+                if key == "from" and len(value) > 0:
+                    filters["author_id"] = int(re.sub(r"\D", "", value))
+                elif key == "in" and len(value) > 0:
+                    filters["channel_id"] = int(re.sub(r"\D", "", value))
+                elif key in ("after", "before") and len(value) > 0:
+                    filters[key] = zone.localize(datetime.strptime(value, "%Y-%m-%d"))
+                else:
+                    terms.append(word)
+        except ValueError:
+            await ctx.send("Usage: search <words> [from:@user] [in:#channel] [after:YYYY-MM-DD] [before:YYYY-MM-DD]")
+            return
+        if len(terms) == 0:
+            await ctx.send("What am I searching for?")
+            return
+
+        # only channels the searcher could read the history of themselves
+        member = cast(discord.Member, ctx.author)
+        readable = [channel.id for channel in ctx.guild.text_channels
+                    if channel.permissions_for(member).read_message_history]
+        await asyncio.to_thread(self.search.flush) # so messages from just now are searchable
+        hits = await asyncio.to_thread(self.search.search, ctx.guild.id, terms, readable, **filters)
+        if len(hits) == 0:
+            await ctx.send("Found nothing")
+            return
+        lines = []
+        for hit in hits:
+            snippet = hit.snippet.replace("\n", " ")
+            snippet = snippet if len(snippet) <= 120 else snippet[:117] + "..."
+            date = hit.created_at.astimezone(zone)
+            lines.append(f"`{date.month}/{date.day}/{date.year}` <#{hit.channel_id}> **{hit.author_name}**: "
+                         f"{snippet} (<{hit.jump_url()}>)")
+        await ctx.send("\n".join(lines)[:2000])
         
     #endregion
     
     #region Helper Functions
         
-    async def archive_general(self, guild: discord.Guild, freq=2, try_time=0) -> None:
-        """ Houses the actual logic of archiving general chat """
-        if try_time == 3: # recursive base case for protection
-            return
-        
-        archive_cat_name = db.get_archive_category(guild)
-        name = db.get_chat_to_archive(guild)
-        new_name = db.get_archived_name(name)
-        archive_category = await self.get_channel_category(guild, archive_cat_name, False)
+    async def archive_general(self, guild: discord.Guild, date: datetime | None = None) -> ArchiveResult:
+        """ Houses the actual logic of archiving general chat, the archived channel is named
+            after the given date (now if none). Each step is only done once, so a retry after
+            a transient failure picks up where the last attempt stopped """
+        result = ArchiveResult(guild)
+        start = time.perf_counter()
         try:
+            settings = await adb.get_server_settings(guild)
+            if settings.archive_category is None or settings.chat_to_archive is None:
+                result.error = "archiving isn't set up (no archive category or chat to archive)"
+                return result
+            archive_cat_name = settings.archive_category
+            name = settings.chat_to_archive
+            date = datetime.now(tz=UTC) if date is None else date
+            new_name = await adb.get_archived_name(name, date.astimezone(timezone(settings.timezone)))
+            archive_category = await self.get_channel_category(guild, archive_cat_name, False)
             chat_to_archive, general_category = self.get_channel_to_archive(guild, name, False)
-            await chat_to_archive.move(beginning=True, category=archive_category, sync_permissions=True)
-            await chat_to_archive.edit(name=new_name)
-            new_channel = await guild.create_text_channel(name, category=general_category)
-            await new_channel.send("good morning @everyone")   
-        except discord.HTTPException as ex:
-            if ex.code == 50035: # too many channels in category, make new archive category
-                printlog((f"Channel category '{archive_cat_name}' reached limit of "
-                          f"50 channels in '{guild.name}' (id: {guild.id})"))
-                await guild.create_category_channel(archive_cat_name, position=archive_category.position-1)
-                await self.archive_general(guild, try_time=try_time+1)
-            else:
-                printlog(str(ex))
         except Exception as ex:
-            printlog(str(ex))
+            result.attempts = 1
+            result.error = str(ex)
+            result.seconds = time.perf_counter() - start
+            return result
+
+        # the channel is only archived once its history is safely exported, indexed and its attachments
+        # stored. Otherwise it stays put, and the retry resumes the export from its checkpoint (an
+        # archived channel would never be exported again, since the next archive exports the new one)
+        try:
+            export = await self.exporter.export(chat_to_archive)
+            result.exported = export.messages
+            printlog(f"{str(export)} ('{guild.name}', id: {guild.id})")
+            indexed = await asyncio.to_thread(self.search.index_export, self.exporter.store, export.prefix)
+            printlog(f"Indexed {indexed} message(s) for search ('{guild.name}', id: {guild.id})")
+            result.attachments = await self.attachments.archive(self.exporter.store, export.prefix)
+            printlog(f"{str(result.attachments)} ('{guild.name}', id: {guild.id})")
+        except Exception as ex:
+            result.attempts = 1
+            result.export_error = str(ex)
+            result.error = "postponed until the history export finishes"
+            result.seconds = time.perf_counter() - start
+            return result
+
+        new_channel: discord.TextChannel | None = None
+        done: set[str] = set()
+        while result.attempts < ArchiveCog.MAX_ATTEMPTS:
+            result.attempts += 1
+            try:
+                if "move" not in done:
+                    await chat_to_archive.move(beginning=True, category=archive_category, sync_permissions=True)
+                    done.add("move")
+                if "rename" not in done:
+                    await chat_to_archive.edit(name=new_name)
+                    done.add("rename")
+                if new_channel is None:
+                    new_channel = await guild.create_text_channel(name, category=general_category)
+                await new_channel.send("good morning @everyone")
+                result.success = True
+                result.error = None
+                break
+            except discord.HTTPException as ex:
+                result.error = str(ex)
+                if ex.code == 50035: # too many channels in category, make new archive category
+                    printlog((f"Channel category '{archive_cat_name}' reached limit of "
+                              f"50 channels in '{guild.name}' (id: {guild.id})"))
+                    archive_category = await guild.create_category_channel(archive_cat_name, 
+                                                                           position=archive_category.position-1)
+                elif ex.status == 429 or ex.status >= 500:
+                    await asyncio.sleep(ArchiveCog.backoff(result.attempts, ex))
+                else:
+                    break
+            except Exception as ex:
+                result.error = str(ex)
+                break
+        result.seconds = time.perf_counter() - start
+        return result
+
+    async def archive_guilds(self, due: list[tuple[discord.Guild, datetime]]) -> ArchiveRun:
+        """ Archives general chat in every (guild, date) pair and reschedules each guild as soon as 
+            it's done. Guilds share a bounded pool across runs. Pycord queues requests per rate-limit 
+            bucket, and buckets are per guild/channel, so the pool size mostly keeps archiving under 
+            the global request limit """
+        run = ArchiveRun(ArchiveCog.CONCURRENCY)
+        start = time.perf_counter()
+
+        async def archive(guild: discord.Guild, date: datetime) -> None:
+            async with self.__pool:
+                try:
+                    result = await self.archive_general(guild, date)
+                except Exception as ex: # e.g. making a new archive category failed
+                    result = ArchiveResult(guild)
+                    result.error = str(ex)
+            run.results.append(result)
+            printlog(f"{run.started}: general {str(result)}")
+            try:
+                await self.reschedule(guild, date, result)
+            except Exception as ex:
+                printlog(f"Couldn't reschedule the archive of '{guild.name}' (id: {guild.id}): {str(ex)}")
+
+        await asyncio.gather(*[archive(guild, date) for guild, date in due])
+        run.seconds = time.perf_counter() - start
+        self.last_run = run
+        return run
+
+    async def reschedule(self, guild: discord.Guild, when: datetime, result: ArchiveResult) -> None:
+        """ Schedules a guild's next archive after the one due at the given date, a postponed 
+            archive is retried soon and keeps its original date """
+        now = datetime.now(tz=UTC)
+        if result.export_error is not None:
+            self.__postponed[guild.id] = when
+            next_archive = now + ArchiveCog.EXPORT_RETRY
+        else:
+            settings = await adb.get_server_settings(guild)
+            next_archive = ArchiveSchedule.following(when, settings.archive_int, settings.timezone, now)
+        self.schedule.set(guild.id, next_archive)
+        self.__wake.set()
+        await adb.set_next_archive(guild, next_archive)
+
+    @staticmethod
+    def backoff(attempt: int, ex: discord.HTTPException) -> float:
+        """ Seconds to wait before retrying: Discord's Retry-After when it sent one,
+            otherwise exponential backoff with jitter """
+        response = getattr(ex, "response", None)
+        retry_after = None if response is None else response.headers.get("Retry-After")
+        if retry_after is not None:
+            return float(retry_after)
+        delay = min(ArchiveCog.MAX_BACKOFF, ArchiveCog.BASE_BACKOFF * 2 ** (attempt - 1))
+        return delay + random.uniform(0, delay / 2)
             
-    async def repeat_archive(self, freq: timedelta) -> None:
-        """ Handles repeatedly archiving general chat """
-        await self.sleep_until_archive()
+    async def repeat_archive(self) -> None:
+        """ Handles repeatedly archiving general chat. Due guilds are archived in the background,
+            so the loop only ever waits on the schedule and a guild that becomes due while others
+            are still exporting starts right away """
+        await self.load_schedule()
         while True:
-            for guild in self.bot.guilds:
-                now = datetime.now()
-                try:
-                    await self.archive_general(guild=guild)
-                    printlog(str(now) + f": general archived in '{guild.name}' (id: {guild.id})")
-                except Exception as ex:
-                    printlog(str(now) + f": there was an error archiving general in '{guild.name}' (id: {guild.id}): {str(ex)}")
-            db.update_next_archive_date(freq)
             await self.sleep_until_archive()
+            now = datetime.now(tz=UTC)
+            due = []
+            for server_id, when in self.schedule.pop_due(now):
+                guild = self.bot.get_guild(server_id)
+                if guild is not None:
+                    # a postponed archive keeps the date it was originally due on
+                    due.append((guild, self.__postponed.pop(server_id, when)))
+            if len(due) == 0:
+                continue
+            task = asyncio.create_task(self.__run_archive(due))
+            self.__runs.add(task)
+            task.add_done_callback(self.__runs.discard)
+
+    async def __run_archive(self, due: list[tuple[discord.Guild, datetime]]) -> None:
+        printlog(str(await self.archive_guilds(due)))
 
     async def sleep_until_archive(self) -> None:
-        """ Handles waiting for the next archive date """
-        now = datetime.now(tz=timezone("US/Eastern"))
-        then = db.get_next_archive_date()
-        wait_time = (then - now).total_seconds()
-        await asyncio.sleep(wait_time)
+        """ Waits until the earliest scheduled archive, re-checking whenever the schedule changes """
+        while True:
+            earliest = self.schedule.peek()
+            timeout = None if earliest is None else (earliest[0] - datetime.now(tz=UTC)).total_seconds()
+            if timeout is not None and timeout <= 0:
+                return
+            self.__wake.clear()
+            try:
+                await asyncio.wait_for(self.__wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                return
+
+    async def load_schedule(self) -> None:
+        """ Builds the schedule from the settings fetched at startup (no extra reads) """
+        for guild, server in list(servers.items()):
+            await self.schedule_guild(guild, server.settings)
+        printlog(str(self.schedule))
+
+    async def schedule_guild(self, guild: discord.Guild, settings: ServerSettings | None = None) -> None:
+        """ Adds a guild to the schedule. Guilds that were never scheduled start at the same
+            local time as the old global archive date (or one interval from now without it) """
+        settings = await adb.get_server_settings(guild) if settings is None else settings
+        when = settings.next_archive
+        if when is None:
+            now = datetime.now(tz=UTC)
+            try:
+                legacy = await adb.get_next_archive_date()
+                legacy_local = timezone(settings.timezone).localize(legacy.replace(tzinfo=None))
+                when = ArchiveSchedule.following(legacy_local.astimezone(UTC), settings.archive_int, 
+                                                 settings.timezone, now)
+            except Exception:
+                when = now + timedelta(weeks=settings.archive_int)
+            await adb.set_next_archive(guild, when)
+        self.schedule.set(guild.id, when)
+        self.__wake.set()
+
+    def unschedule_guild(self, guild: discord.Guild) -> None:
+        self.schedule.remove(guild.id)
+        self.__wake.set()
         
+    async def remove_export(self, guild_id: int, channel_id: int) -> tuple[int, int]:
+        """ Deletes a channel's export, releasing its attachments and dropping its messages
+            from the search index. Returns the number of export objects and blobs deleted """
+        prefix = ChannelExporter.key_prefix(guild_id, channel_id)
+        blobs = await asyncio.to_thread(self.attachments.release, self.exporter.store, prefix)
+        await asyncio.to_thread(self.search.remove_channel, prefix, channel_id)
+        objects = await asyncio.to_thread(self.exporter.delete, prefix)
+        return objects, blobs
+
+    async def remove_exports(self, guild_id: int) -> None:
+        """ Deletes every export of a guild (e.g. when General Walarus leaves it) """
+        for channel_id in await asyncio.to_thread(self.exporter.exported_channels, guild_id):
+            try:
+                await self.remove_export(guild_id, channel_id)
+            except Exception as ex:
+                printlog(f"Couldn't delete the export of channel {channel_id} in guild {guild_id}: {str(ex)}")
+
     async def get_channel_category(self, guild: discord.Guild, name: str, 
                                    case_sens: bool) -> discord.CategoryChannel:
         """ Returns the discord.CategoryChannel of the first channel category 
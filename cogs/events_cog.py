@@ -1,34 +1,67 @@
+import asyncio
 from datetime import datetime, timedelta
+import time
 import discord
 from discord.ext.commands import Cog
 from discord.ext import commands
 import discord.utils as utils
 import database as db
+from database import aio as adb
 from datetime import timedelta
-from ai import LLMEngine, VisionEngine
-from typing import cast
-from models import Server, VCConnection, WSESession
-from globals import servers, start_mutex, vc_connections, live_wse_sessions
-from utilities import printlog, send_message
+from ai import LazyEngine
+from archive import search_index
+from startup import startup_report
+from typing import cast, TYPE_CHECKING
+from models import Server, VCConnection, WSESession, VoiceTracker
+from globals import servers, start_mutex, vc_connections, live_wse_sessions, voice_trackers, wse_scheduler
+from utilities import printlog, stream_message
+
+if TYPE_CHECKING:
+    from ai import LLMEngine, VisionEngine
 
 class EventsCog(Cog, name="Events"):
     """ Class containing implementations for Discord bot events """
     
-    def __init__(self, bot: discord.Bot, llm_engine: LLMEngine, vision_engine: VisionEngine):
+    def __init__(self, bot: discord.Bot, llm_engine: "LazyEngine[LLMEngine]", vision_engine: "LazyEngine[VisionEngine]"):
         self.bot = bot
         self.llm_engine = llm_engine
         self.vision_engine = vision_engine
+        self.__started: bool = False
 
     #region Events
 
     @commands.Cog.listener()
     async def on_ready(self) -> None:
         """ Event that runs once General Walarus is up and running """
-        EventsCog.initialize_servers(self.bot)
-        EventsCog.initialize_wse_sessions(self.bot)
-        print(f"General Walarus active in {len(servers)} server(s)")
+        timings: dict[str, float] = {}
+        started = time.perf_counter()
+        guilds_by_id = { guild.id: guild for guild in self.bot.guilds }
+
+        # settings for every guild come back in one query while the schema is being prepared
+        settings, _ = await asyncio.gather(
+            EventsCog.timed(timings, "settings", adb.get_servers_settings(list(guilds_by_id.keys()))),
+            EventsCog.timed(timings, "schema", EventsCog.prepare_database())
+        )
+        phase_start = time.perf_counter()
+        EventsCog.initialize_servers(guilds_by_id, settings)
+        EventsCog.initialize_voice_trackers(self.bot)
+        timings["servers"] = time.perf_counter() - phase_start
+        await EventsCog.timed(timings, "wse", EventsCog.initialize_wse_sessions(guilds_by_id, settings))
+        self.bot.loop.create_task(EventsCog.prepare_leaderboards())
+
+        timings["total"] = time.perf_counter() - started
+        for phase, seconds in timings.items():
+            startup_report.record(f"on_ready {phase}", seconds)
+        report = ", ".join([f"{phase}={seconds * 1000:.0f}ms" for phase, seconds in timings.items()])
+        printlog(f"Initialized {len(servers)} server(s): {report}")
+        print(f"General Walarus active in {len(servers)} server(s) ({report})")
+        if self.__started: # on_ready fires again after a reconnect, the background loops are already running
+            return
+        self.__started = True
+        self.bot.loop.create_task(self.flush_stats_periodically())
+        self.bot.loop.create_task(self.checkpoint_voice_periodically())
         start_mutex.release()
-        await self.bot.get_cog("Archive").repeat_archive(timedelta(weeks=2)) # type: ignore
+        await self.bot.get_cog("Archive").repeat_archive() # type: ignore
         
 
     @commands.Cog.listener()
@@ -43,25 +76,30 @@ class EventsCog(Cog, name="Events"):
         
         # Walarus responds if mentioned
         if self.bot.user in message.mentions:
-            channel = message.channel
-            response: str | None
-            async with channel.typing():
-                user_mention = f"@{self.bot.user.id}"
-                msg_to_bot = message.content.replace(user_mention, "").replace("<>", "").strip()
-                response = self.llm_engine.get_llm_response(f"do not indicate that you are an AI model or LLM, but respond to this: {msg_to_bot}")
-            await send_message(message.channel, response)
-
-        # updating user stats in DB
-        db.inc_user_stat(message.guild, cast(discord.User, message.author), "sent_messages")
+            self.bot.loop.create_task(self.reply_with_llm(message))
+
+        # updating user stats in DB (buffered, written in batches)
+        flush_due = db.buffer_user_stat(message.guild, cast(discord.User, message.author), "sent_messages")
         for user in message.mentions:
             user_mentioned_self = user.id == message.author.id
             bot_mentioned_user = bot_sent
             if not user_mentioned_self and not bot_mentioned_user:
-                db.inc_user_stat(message.guild, cast(discord.User, user), "mentioned")
+                flush_due = db.buffer_user_stat(message.guild, cast(discord.User, user), "mentioned")
+        if flush_due:
+            self.bot.loop.create_task(self.flush_stats())
+
+        # indexing for the search command (buffered, written in batches)
+        if not bot_sent and search_index.buffer(message):
+            self.bot.loop.create_task(self.flush_search())
 
         # if NSFW image sent, delete and resend with blur
-        if not bot_sent:
-            await self.vision_engine.check_if_nsfw(message)
+        if not bot_sent and len(message.attachments) > 0:
+            try:
+                vision_engine = await self.vision_engine.get()
+            except Exception as ex:
+                printlog(str(ex))
+                return
+            await vision_engine.check_if_nsfw(message)
  
 
     @commands.Cog.listener()
@@ -69,8 +107,9 @@ class EventsCog(Cog, name="Events"):
         """ Event that runs whenever General Walarus joins a new server\n 
             Servers information is added to the database """
         printlog(f"General Walarus joined guild '{guild.name}' (id: {guild.id})")
-        servers[guild] = Server(guild)
-        db.log_server(guild)
+        await adb.log_server(guild)
+        servers[guild] = Server(guild, await adb.get_server_settings(guild))
+        await self.bot.get_cog("Archive").schedule_guild(guild) # type: ignore
 
 
     @commands.Cog.listener()
@@ -78,15 +117,17 @@ class EventsCog(Cog, name="Events"):
         """ Event that runs when General Walarus gets removed from a server.\n
             Server information is deleted from database """
         del servers[guild]
+        self.bot.get_cog("Archive").unschedule_guild(guild) # type: ignore
+        await self.bot.get_cog("Archive").remove_exports(guild.id) # type: ignore
         printlog(f"General Walarus has been removed from guild '{guild.name}' (id: {guild.id})")
-        printlog(f"{db.remove_discord_server(guild)} documents removed from database")
+        printlog(f"{await adb.remove_discord_server(guild)} documents removed from database")
 
 
     @commands.Cog.listener()
     async def on_guild_update(self, before: discord.Guild, after: discord.Guild):
         """ Event that runs when a server's information gets updated.\n
             Server information gets updated in the database """
-        db.log_server(after)
+        await adb.log_server(after)
         printlog(f"Server {before.id} was updated")
 
 
@@ -94,16 +135,51 @@ class EventsCog(Cog, name="Events"):
     async def on_member_join(self, member: discord.Member) -> None:
         """ Event that runs when a user joins a guild """
         guild = member.guild
-        db.create_user(guild, member)
-        MAGIC_USER = live_wse_sessions[guild].user_id
-        if member.id == MAGIC_USER:
-            db.set_current_wse_price(member.guild, 0)
+        await adb.create_user(guild, member)
+        await self.add_to_shuffle(guild, "ushuffle", member.name)
+        session = live_wse_sessions.get(guild)
+        if session is not None and member.id == session.user_id:
+            await session.set_price(0)
             general: discord.TextChannel | None 
             general = utils.find(lambda channel: channel.name == "general", guild.text_channels)
             if general is not None:
                 await general.send("@everyone the WSE has crashed!!")
         
 
+    @commands.Cog.listener()
+    async def on_member_remove(self, member: discord.Member) -> None:
+        """ Event that runs when a user leaves (or is removed from) a guild """
+        await self.pull_from_shuffle(member.guild, "ushuffle", member.name)
+
+
+    @commands.Cog.listener()
+    async def on_user_update(self, before: discord.User, after: discord.User) -> None:
+        """ Event that runs when a user changes their profile (username, avatar, etc.) """
+        if before.name == after.name:
+            return
+        for guild in after.mutual_guilds:
+            await self.rename_in_shuffle(guild, "ushuffle", before.name, after.name)
+
+
+    @commands.Cog.listener()
+    async def on_guild_role_create(self, role: discord.Role) -> None:
+        """ Event that runs when a role is created in a guild """
+        await self.add_to_shuffle(role.guild, "rshuffle", role.name)
+
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role: discord.Role) -> None:
+        """ Event that runs when a role is deleted from a guild """
+        await self.pull_from_shuffle(role.guild, "rshuffle", role.name)
+
+
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before: discord.Role, after: discord.Role) -> None:
+        """ Event that runs when a role's settings (name, color, permissions, etc.) change """
+        if before.name != after.name:
+            await self.rename_in_shuffle(after.guild, "rshuffle", before.name, after.name)
+
+
     @commands.Cog.listener()
     async def on_command_error(self, ctx: commands.Context, ex: commands.CommandError):
         """ Event that runs when a user tries a command and it raises an error """
@@ -116,7 +192,7 @@ class EventsCog(Cog, name="Events"):
         """ Event that runs when a user changes voice state (join/leaves VC, gets muted/unmuted, 
             gets deafened/undeafened, etc.) """
         guild: discord.Guild = member.guild
-        self.db_update_voice(member, guild, before, after)
+        await self.db_update_voice(member, guild, before, after)
 
         if self.bot.user and member.id == self.bot.user.id:
             if before.channel and not after.channel:
@@ -129,55 +205,170 @@ class EventsCog(Cog, name="Events"):
     #endregion
     
     #region Helper Functions
+
+    async def reply_with_llm(self, message: discord.Message) -> None:
+        """ Streams Walarus' reply to a message that mentioned him """
+        if self.bot.user is None or message.guild is None:
+            raise Exception("bot.user or message.guild is None")
+        user_mention = f"@{self.bot.user.id}"
+        msg_to_bot = message.content.replace(user_mention, "").replace("<>", "").strip()
+        prompt = f"do not indicate that you are an AI model or LLM, but respond to this: {msg_to_bot}"
+        try:
+            llm_engine = await self.llm_engine.get()
+            await stream_message(message.channel, llm_engine.stream_llm_response(
+                prompt, message.guild.id, message.channel.id))
+        except Exception as ex:
+            printlog(f"LLM reply failed in '{message.guild}': {str(ex)}")
+
+    async def add_to_shuffle(self, guild: discord.Guild, field: str, name: str) -> None:
+        """ Adds a name to one of the guild's shuffle lists, in the database and in memory """
+        await adb.add_to_shuffle(guild, field, name)
+        server = servers.get(guild)
+        if server is not None:
+            server.add_to_shuffle(field, name)
+
+    async def pull_from_shuffle(self, guild: discord.Guild, field: str, name: str) -> None:
+        """ Removes a name from one of the guild's shuffle lists, in the database and in memory """
+        await adb.pull_from_shuffle(guild, field, name)
+        server = servers.get(guild)
+        if server is not None:
+            server.pull_from_shuffle(field, name)
+
+    async def rename_in_shuffle(self, guild: discord.Guild, field: str, before: str, after: str) -> None:
+        """ Replaces a name in one of the guild's shuffle lists, in the database and in memory """
+        await adb.rename_in_shuffle(guild, field, before, after)
+        server = servers.get(guild)
+        if server is not None:
+            server.pull_from_shuffle(field, before)
+            server.add_to_shuffle(field, after)
+
+    async def flush_stats(self) -> None:
+        """ Writes buffered user stat increments without blocking the event loop """
+        try:
+            await adb.flush_user_stats()
+        except Exception as ex:
+            printlog(f"Failed to flush user stats: {str(ex)}")
+
+    async def flush_search(self) -> None:
+        """ Writes buffered messages to the search index without blocking the event loop """
+        try:
+            await asyncio.to_thread(search_index.flush)
+        except Exception as ex:
+            printlog(f"Failed to flush the search index: {str(ex)}")
+
+    async def flush_stats_periodically(self, interval: float = 1.0) -> None:
+        """ Flushes the user stat buffer (and search index buffer) once its time threshold has been reached """
+        while True:
+            await asyncio.sleep(interval)
+            if db.user_stat_buffer.is_due():
+                await self.flush_stats()
+            if search_index.is_due():
+                await self.flush_search()
     
-    def db_update_voice(self, member: discord.Member, guild: discord.Guild, before: discord.VoiceState, after: discord.VoiceState) -> None:
-        """ Analyzes before and after voice state and updates user voice status in database """
-        now: datetime = datetime.now()
+    async def db_update_voice(self, member: discord.Member, guild: discord.Guild, before: discord.VoiceState, after: discord.VoiceState) -> None:
+        """ Analyzes before and after voice state, updates the guild's in-memory voice 
+            sessions and hands any accrued time in VC to the user stat buffer """
+        if before.channel == after.channel:
+            return # muted/unmuted, deafened/undeafened, etc.
+        tracker = voice_trackers.setdefault(guild, VoiceTracker(guild))
+        if after.channel != None:
+            tracker.join(member, after.channel.id)
+        else:
+            tracker.leave(member)
+
         if before.channel == None and after.channel != None:
             # user joins a voice channel
-            db.update_user_stats(guild, member, last_connected_to_vc=now, connected_to_vc=True)
-            vc_members: list = after.channel.members
-            non_bot_count: int = 0
-            for vc_member in vc_members:
-                if not vc_member.bot:
-                    non_bot_count += 1
-            vc_timer: bool = non_bot_count > 1
-            for vc_member in vc_members:
-                db.update_user_stats(guild, vc_member, vc_timer=vc_timer)    
+            await adb.update_user_stats(guild, member, last_connected_to_vc=datetime.now(), connected_to_vc=True)
         elif before.channel != None and after.channel == None:
             # user leaves a voice channel
-            field_name: str = "last_connected_to_vc"
-            connected_time: datetime = cast(dict, db.get_user_stat(guild, member.id, field_name))[field_name]
-            session_length: int = (now - connected_time).seconds
-            vc_members: list = before.channel.members
-            vc_timer: bool = cast(dict, db.get_user_stat(guild, member.id, "vc_timer"))["vc_timer"]
-            if len(vc_members) == 1: # just one more person left in voice channel
-                # stop everyone's vc timer and update time in db
-                for vc_member in vc_members:
-                    update_time: bool = cast(dict, db.get_user_stat(guild, vc_member.id, "vc_timer"))["vc_timer"]
-                    if update_time:
-                        db.inc_user_stat(guild, vc_member, "time_in_vc", session_length)
-                        db.update_user_stats(guild, vc_member, vc_timer=False)
-            if vc_timer: # update time of the person who's leaving
-                db.inc_user_stat(guild, member, "time_in_vc", session_length)
-            db.update_user_stats(guild, member, connected_to_vc=False, vc_timer=False)
+            await adb.update_user_stats(guild, member, connected_to_vc=False)
+            self.buffer_voice_time(tracker)
+
+    def buffer_voice_time(self, tracker: VoiceTracker) -> None:
+        """ Moves accrued time in VC from the voice tracker into the user stat buffer """
+        for vc_member, seconds in tracker.drain():
+            db.buffer_user_stat(tracker.guild, vc_member, "time_in_vc", seconds)
+
+    async def checkpoint_voice_periodically(self, interval: float = 60.0) -> None:
+        """ Periodically writes time in VC for sessions that are still running """
+        while True:
+            await asyncio.sleep(interval)
+            for tracker in list(voice_trackers.values()):
+                self.buffer_voice_time(tracker)
     
 
     @staticmethod
-    def initialize_servers(bot: discord.Bot):
+    async def timed(timings: dict[str, float], phase: str, coroutine):
+        """ Awaits the coroutine and records how long it took under the given phase """
+        start = time.perf_counter()
+        try:
+            return await coroutine
+        finally:
+            timings[phase] = time.perf_counter() - start
+
+
+    @staticmethod
+    async def prepare_database():
+        """ Makes sure collections and indexes the queries rely on exist. Failures are logged
+            rather than raised so the rest of startup still runs """
+        try:
+            migrated = await adb.ensure_price_timeseries()
+            if migrated > 0:
+                printlog(f"Migrated {migrated} WSE price tick(s) to the time-series collection")
+        except Exception as ex:
+            printlog(f"Failed to prepare the WSE price time-series: {str(ex)}")
+        await EventsCog.initialize_indexes()
+        try:
+            await adb.ensure_wse_positions()
+        except Exception as ex:
+            printlog(f"Failed to prepare WSE positions: {str(ex)}")
+
+
+    @staticmethod
+    def initialize_servers(guilds_by_id: dict[int, discord.Guild], settings: dict[int, db.ServerSettings]):
+        for guild_id, guild in guilds_by_id.items():
+            servers[guild] = Server(guild, settings[guild_id])
+
+
+    @staticmethod
+    def initialize_voice_trackers(bot: discord.Bot):
+        """ Picks up anyone who was already in a voice channel when Walarus started """
         for guild in bot.guilds:
-            servers[guild] = Server(guild)
+            tracker = voice_trackers.setdefault(guild, VoiceTracker(guild))
+            for channel in guild.voice_channels:
+                for vc_member in channel.members:
+                    tracker.join(vc_member, channel.id)
+
+
+    @staticmethod
+    async def initialize_indexes():
+        """ Applies the database index registry (idempotent) """
+        try:
+            ensured = await adb.ensure_indexes()
+            printlog(f"Ensured {len(ensured)} database index(es)")
+        except Exception as ex:
+            printlog(f"Failed to ensure database indexes: {str(ex)}")
+
+
+    @staticmethod
+    async def prepare_leaderboards():
+        """ Makes sure every user has a materialized score """
+        try:
+            updated = await adb.backfill_user_scores()
+            if updated > 0:
+                printlog(f"Backfilled leaderboard score for {updated} user(s)")
+        except Exception as ex:
+            printlog(f"Failed to prepare leaderboards: {str(ex)}")
 
 
     @staticmethod
-    def initialize_wse_sessions(bot: discord.Bot):
-        db_sessions = db.get_active_wse_servers()
-        for item in db_sessions:
-            id = item["_id"]
-            user_id_to_track = item["wse_user_id"]
-            guild = utils.find(lambda guild: guild.id == id, bot.guilds)
-            if guild is None:
-                raise Exception("guild is None")
-            live_wse_sessions[guild] = WSESession(guild, user_id_to_track, "0 9 * * *")
+    async def initialize_wse_sessions(guilds_by_id: dict[int, discord.Guild], settings: dict[int, db.ServerSettings]):
+        active = [guild_settings for guild_settings in settings.values() if guild_settings.wse]
+        prices = await adb.get_current_wse_prices([guild_settings.server_id for guild_settings in active])
+        for guild_settings in active:
+            guild = guilds_by_id[guild_settings.server_id]
+            session = WSESession(guild, guild_settings.wse_user_id, "0 9 * * *", prices.get(guild.id))
+            live_wse_sessions[guild] = session
+            wse_scheduler.add(session)
 
     #endregion
\ No newline at end of file
@@ -1,7 +1,7 @@
 import discord
 from discord.ext.commands import Cog
 from discord.ext import commands
-import database as db
+from database import aio as adb
 from datetime import datetime
 from globals import servers
 from models import Server, TimeSpan
@@ -74,7 +74,10 @@ class MiscellaneousCog(Cog, name="Miscellaneous"):
         if ctx.guild is None: 
             raise Exception("ctx.guild is None")
         if ctx.author.id == ctx.guild.owner_id:
-            created_new = db.log_server(ctx.guild)
+            created_new = await adb.log_server(ctx.guild, rebuild_shuffle=True)
+            server = servers.get(ctx.guild)
+            if server is not None:
+                server.reload_settings(await adb.get_server_settings(ctx.guild))
             if created_new:
                 await ctx.send("Logged this server into the database") 
             else: 
@@ -4,20 +4,18 @@ from discord.ext import commands
 import database as db
 from typing import cast
 from utilities import printlog
-import openai
 import os
         
 class OpenAICog(Cog, name="OpenAI"):
     """ Class containing General Walarus' OpenAI commands """
     
-    def __init__(self) -> None:
-        openai.api_key = os.getenv("OPENAI_API_KEY")
-    
     #region Commands
     
     @commands.command(name="gpt", aliases=["ai", "chatgpt"])
     async def chat_gpt(self, ctx: commands.Context, *message_input) -> None:
         """ Command to chat with ChatGPT """
+        import openai # heavy import, only needed once someone chats
+        openai.api_key = os.getenv("OPENAI_API_KEY")
         WAITING_MSG = await ctx.send("ChatGPT is thinking...")
         MAX_TRIES = 3;
         try_count = 0
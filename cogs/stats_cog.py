@@ -1,7 +1,7 @@
 import discord
 from discord.ext.commands import Cog
 from discord.ext import commands
-import database as db
+from database import aio as adb
 from models import TimeSpan
 from typing import cast
 from utilities import printlog
@@ -18,7 +18,7 @@ class StatisticsCog(Cog, name="Statistics"):
             guild = ctx.guild
             user = cast(discord.User, ctx.author) if user is None else user
             if guild != None:
-                query = cast(dict, db.get_user_stat(guild, user.id, "sent_messages"))
+                query = cast(dict, await adb.get_user_stat(guild, user.id, "sent_messages"))
                 messages = int(query["sent_messages"])
                 if user.id == ctx.author.id:
                     await ctx.send(f"You've sent {messages:,} messages")
@@ -36,7 +36,7 @@ class StatisticsCog(Cog, name="Statistics"):
             guild = ctx.guild
             user = cast(discord.User, ctx.author) if user is None else user 
             if guild != None:
-                query = cast(dict, db.get_user_stat(guild, user.id, "time_in_vc"))
+                query = cast(dict, await adb.get_user_stat(guild, user.id, "time_in_vc"))
                 seconds = int(query["time_in_vc"])
                 time: TimeSpan = TimeSpan(seconds)
                 msg = f"You've spent" if user.id == ctx.author.id else f"{user.name} has spent"
@@ -59,28 +59,69 @@ class StatisticsCog(Cog, name="Statistics"):
             await ctx.send("I pooped my pants...try again")
             
     @commands.command(name="showstats", aliases=["leaderboard"])
-    async def show_stats(self, ctx: commands.Context):
+    async def show_stats(self, ctx: commands.Context, page: int = 1):
+        """ Command that sends the server's stats leaderboard, one page at a time """
         if ctx.guild == None:
             await ctx.send("Aw poop nuggets, I sharted myself...")
             return
-        leaderboard: list = db.get_user_stats(ctx.guild)
-        sort_key = lambda user: user["sent_messages"] + user["time_in_vc"] + user["mentioned"]
-        leaderboard.sort(key=sort_key, reverse=True)
-        message = "```SERVER STATS LEADERBOARD\n\n"
-        for user in leaderboard:
+        view = LeaderboardView(ctx.guild, max(page, 1) - 1, cast(discord.User, ctx.author))
+        await ctx.send(await view.render(), view=view)
+    
+    #endregion 
+
+
+class LeaderboardView(discord.ui.View):
+    """ Previous/next buttons for paging through the stats leaderboard """
+
+    PAGE_SIZE = 10
+    """ Number of users shown per page (keeps each page well under Discord's message limit) """
+
+    def __init__(self, guild: discord.Guild, page: int, author: discord.User) -> None:
+        super().__init__(timeout=300)
+        self.guild: discord.Guild = guild
+        """ Guild whose leaderboard is being shown """
+        self.page: int = page
+        """ Zero-based page currently shown """
+        self.author: discord.User = author
+        """ User who asked for the leaderboard, the only one who can turn pages """
+        self.page_count: int = 1
+        """ Number of pages as of the last render """
+
+    async def render(self) -> str:
+        users, total = await adb.get_leaderboard_page(self.guild, self.page, self.PAGE_SIZE)
+        self.page_count = max((total + self.PAGE_SIZE - 1) // self.PAGE_SIZE, 1)
+        if self.page >= self.page_count:
+            self.page = self.page_count - 1
+            users, total = await adb.get_leaderboard_page(self.guild, self.page, self.PAGE_SIZE)
+        self.previous_page.disabled = self.page <= 0
+        self.next_page.disabled = self.page >= self.page_count - 1
+
+        message = f"```SERVER STATS LEADERBOARD (page {self.page + 1}/{self.page_count})\n\n"
+        for rank, user in enumerate(users, start=self.page * self.PAGE_SIZE + 1):
             username = user["user_name"]
             mentioned = user["mentioned"]
             mentioned_units = "time" if mentioned == 1 else "times"
             sent_messages = user["sent_messages"]
             messages_unit = "message" if sent_messages == 1 else "messages"
-            vctime = TimeSpan(user["time_in_vc"])
-            message += f"{username}\n"
+            vctime = TimeSpan(int(user["time_in_vc"]))
+            message += f"{rank}. {username}\n"
             message += f"\tMentioned: {mentioned} {mentioned_units}\n"
             message += f"\tMessages sent: {sent_messages} {messages_unit}\n"
             message += (f"\tTime in VC: {vctime.days()} {vctime.days_unit()}, {vctime.hours()} "
                         f"{vctime.hours_unit()}, {vctime.minutes()} {vctime.minutes_unit()}, "
                         f"{vctime.seconds()} {vctime.seconds_unit()}\n")
         message += "```"
-        await ctx.send(message)
-    
-    #endregion 
\ No newline at end of file
+        return message
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        return interaction.user is not None and interaction.user.id == self.author.id
+
+    @discord.ui.button(label="Previous", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, button: discord.ui.Button, interaction: discord.Interaction):
+        self.page = max(self.page - 1, 0)
+        await interaction.response.edit_message(content=await self.render(), view=self)
+
+    @discord.ui.button(label="Next", style=discord.ButtonStyle.secondary)
+    async def next_page(self, button: discord.ui.Button, interaction: discord.Interaction):
+        self.page += 1
+        await interaction.response.edit_message(content=await self.render(), view=self)
@@ -7,7 +7,6 @@ import time
 from typing import List, Literal
 from globals import vc_connections, servers
 from models import VCConnection
-from pydub import AudioSegment
 from datetime import datetime
 
 
@@ -92,6 +91,7 @@ class VoiceCog(Cog, name="Voice"):
     def combine_user_audios(audio_files: List, format: Literal["wav", "mp3"], output_filepath: str, 
                             max_length_ms: int = 30000):
         """ Splices the given audio files into one """
+        from pydub import AudioSegment # heavy import, only needed once someone clips
         audio_segments = [AudioSegment.from_file(file=file, format=format) for file in audio_files]
         max_audio_length = max(audio_segments, key=lambda audio: audio.duration_seconds).duration_seconds
         max_audio_length_ms = max_audio_length * 1000  # x1000 to convert seconds to ms
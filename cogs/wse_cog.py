@@ -1,18 +1,27 @@
 import discord
-from discord import utils
 from discord.ext.commands import Cog
 from discord.ext import commands
-import database as db
-from models import WSESession
-import matplotlib
-import matplotlib.pyplot as plt
-import numpy as np
-import os
-from globals import live_wse_sessions
+from database import aio as adb
+import asyncio
+from datetime import datetime, timedelta
+from models import (WSESession, PriceChartCache, PortfolioReplay, wse_cache_stats,
+                    render_portfolio_chart, replay_portfolios)
+import io
+from globals import live_wse_sessions, wse_scheduler
+from typing import TYPE_CHECKING
+from utilities import send_message
+
+if TYPE_CHECKING:
+    import numpy as np # heavy import, only loaded by the leaderboard and history commands
 
 class WSECog(Cog, name="Walarus Stock Exchange"):
     """ Class containing commands pertaining to Walarus Stock Exchange """
 
+    def __init__(self) -> None:
+        self.charts: PriceChartCache = PriceChartCache()
+        """ Rendered price charts, invalidated whenever a new price is written """
+        self.__status_locks: dict[int, asyncio.Lock] = {}
+
     #region Commands
     
     @commands.command(name="wse", aliases=["currentstockprice", "currentprice", "price"])
@@ -21,16 +30,17 @@ class WSECog(Cog, name="Walarus Stock Exchange"):
         guild: discord.Guild | None = ctx.guild # type: ignore
         if guild is None:
             raise Exception("wse_details(): guild is None")
-        wse_status = db.get_wse_status(guild)
+        wse_status = await self.__is_open(guild)
 
         if not wse_status:
             await ctx.send("The Walarus Stock Exchange is not currently open")
             return
 
-        price = db.get_current_wse_price(guild)
-        job = live_wse_sessions[guild].job
+        price = await self.__current_price(guild)
+        session = live_wse_sessions.get(guild)
+        next_run_time = None if session is None or session.job is None else session.job.next_run_time
         await ctx.send(f"**Price**: ${round(price, 2):,.2f}\n"
-                       f"**Next Price Update**: {job.next_run_time}\n"
+                       f"**Next Price Update**: {next_run_time}\n"
                        f"**Stock Price Graph**:")
         await self.__show_graph(ctx)
 
@@ -41,21 +51,20 @@ class WSECog(Cog, name="Walarus Stock Exchange"):
         guild: discord.Guild | None = ctx.guild # type: ignore
         if guild is None:
             raise Exception("wse_buy(): guild is None")
-        wse_status = db.get_wse_status(guild)
+        wse_status = await self.__is_open(guild)
 
         if not wse_status:
             await ctx.send("The Walarus Stock Exchange is not currently open")
             return
         
         author: discord.Member = ctx.author # type: ignore
-        last_transaction = db.get_last_transaction(author)["action"]
+        curr_price = await self.__current_price(guild)
+        position = await adb.set_transaction(member=author, curr_price=curr_price, transaction_type="buy")
         
-        if last_transaction == "buy": 
+        if position is None: 
             await ctx.send("You are already bought into the WSE!")
             return
         
-        curr_price = db.get_current_wse_price(guild)
-        db.set_transaction(member=author, curr_price=curr_price, transaction_type="buy")
         await ctx.send(f"{ctx.author.name} just bought into the Walarus Stock Exchange for "
                        f"${round(curr_price, 2):,.2f}")
 
@@ -66,21 +75,20 @@ class WSECog(Cog, name="Walarus Stock Exchange"):
         guild: discord.Guild | None = ctx.guild # type: ignore
         if guild is None:
             raise Exception("wse_sell(): guild is None")
-        wse_status = db.get_wse_status(guild)
+        wse_status = await self.__is_open(guild)
 
         if not wse_status:
             await ctx.send("The Walarus Stock Exchange is not currently open")
             return
         
         author: discord.Member = ctx.author # type: ignore
-        last_transaction = db.get_last_transaction(author)["action"]
+        curr_price = await self.__current_price(guild)
+        position = await adb.set_transaction(member=author, curr_price=curr_price, transaction_type="sell")
 
-        if last_transaction == "sell":
+        if position is None:
             await ctx.send("You haven't bought into the WSE yet!")
             return
 
-        curr_price = db.get_current_wse_price(guild)
-        db.set_transaction(member=author, curr_price=curr_price, transaction_type="sell")
         await ctx.send(f"{ctx.author.name} just sold share in the Walarus Stock Exchange for "
                        f"${round(curr_price, 2):,.2f}")
 
@@ -95,20 +103,20 @@ class WSECog(Cog, name="Walarus Stock Exchange"):
         guild: discord.Guild | None = ctx.guild # type: ignore
         if guild is None:
             raise Exception("wse_start(): guild is None")
-        wse_status = db.get_wse_status(guild)
-
-        if wse_status:
-            await ctx.send("The Walarus Stock Exchange is already open!")
-            return
 
         OPENING_PRICE = 1.00
-        db.set_wse_status(guild, status=True, user_id=user_id)
-        db.set_current_wse_price(guild, OPENING_PRICE)
-        price = db.get_current_wse_price(guild)
+        # the check and the opening happen under the guild's lock so concurrent wseopens can't both open it
+        async with self.__status_lock(guild):
+            if await self.__is_open(guild):
+                await ctx.send("The Walarus Stock Exchange is already open!")
+                return
+            session = WSESession(guild, user_id, "0 9 * * *")
+            await adb.set_wse_status(guild, status=True, user_id=user_id)
+            await session.set_price(OPENING_PRICE)
+            live_wse_sessions[guild] = session
+            wse_scheduler.add(session)
         await ctx.send("@everyone The Walarus Stock Exchange is now open for business at "
-                       f"price of ${round(price, 2):,.2f}!")
-        
-        live_wse_sessions[guild] = WSESession(guild, user_id, "0 9 * * *")
+                       f"price of ${round(OPENING_PRICE, 2):,.2f}!")
 
 
     @commands.command(name="wseclose", aliases=["wsestop", "wseend"])
@@ -121,16 +129,16 @@ class WSECog(Cog, name="Walarus Stock Exchange"):
         guild: discord.Guild | None = ctx.guild # type: ignore
         if guild is None:
             raise Exception("wse_end(): guild is None")
-        wse_status = db.get_wse_status(guild)
-        
-        if not wse_status:
-            await ctx.send("The Walarus Stock Exchange is not currently open")
-            return
-        
-        db.set_wse_status(guild, status=False)
-        await ctx.send("@everyone The Walarus Stock Exchange is now closed")
 
-        del live_wse_sessions[guild]
+        async with self.__status_lock(guild):
+            if not await self.__is_open(guild):
+                await ctx.send("The Walarus Stock Exchange is not currently open")
+                return
+            await adb.set_wse_status(guild, status=False)
+            session = live_wse_sessions.pop(guild, None)
+            if session is not None:
+                wse_scheduler.remove(session)
+        await ctx.send("@everyone The Walarus Stock Exchange is now closed")
         
 
     @commands.command(name="lasttransaction")
@@ -138,8 +146,8 @@ class WSECog(Cog, name="Walarus Stock Exchange"):
         """ View details about your last WSE transaction """
         if member is None:
             member = ctx.author
-        transaction = db.get_last_transaction(member)
-        if transaction is None:
+        transaction = await adb.get_last_transaction(member)
+        if transaction["action"] is None:
             who = "You haven't" if member.id == ctx.author.id else f"{member.name} hasn't"
             await ctx.send(f"{who} made any transactions yet. Try the 'wsebuy' or 'wsesell' commands.")
             return
@@ -156,8 +164,8 @@ class WSECog(Cog, name="Walarus Stock Exchange"):
         if member is None:
             member = ctx.author
 
-        transaction = db.get_last_transaction(member)
-        curr_price = db.get_current_wse_price(ctx.guild)
+        transaction = await adb.get_last_transaction(member)
+        curr_price = await self.__current_price(ctx.guild)
         stock = curr_price if transaction["action"] == "buy" else 0
         cash = transaction["cash_value"]
         total = stock + cash
@@ -171,67 +179,138 @@ class WSECog(Cog, name="Walarus Stock Exchange"):
 
 
     @commands.command(name="wseleaderboard")
-    async def wse_leaderboard(self, ctx: commands.Context):
-        """ View the WSE leaderboard """
-        transactions = db.get_transactions(guild=ctx.guild)
-        participants = np.unique([transaction["user_id"] for transaction in transactions])
-        curr_price = db.get_current_wse_price(ctx.guild)
-        portfolios = []
-
-        for participant in participants:
-            member = utils.find(lambda m: m.id == participant, ctx.guild.members)
-            last_transaction = db.get_last_transaction(member)
-            name = last_transaction["user_name"]
-            stock = curr_price if last_transaction["action"] == "buy" else 0
-            cash = last_transaction["cash_value"]
-            portfolio = {
-                "name": name,
-                "stock_value": stock,
-                "cash_value": cash,
-                "total": stock + cash,
-                "net": (stock + cash) - 1
-            }
-            portfolios.append((last_transaction, portfolio))
-
-        message = "```WALARUS STOCK EXCHANGE LEADERBOARD\n\n"
-        portfolios = sorted(portfolios, key=lambda p: (-p[1]["total"], p[1]["name"]))
-        for item in portfolios:
-            last_transaction = item[0]
-            portfolio = item[1]
-            message += (f"{last_transaction["user_name"]}\n"
-                        f"\tStock Value: ${round(portfolio["stock_value"], 2):,.2f}\n"
-                        f"\tCash Value: ${round(portfolio["cash_value"], 2):,.2f}\n"
-                        f"\tTotal Portfolio Value: ${round(portfolio["total"], 2):,.2f}\n"
-                        f"\tOverall Net: ${round(portfolio["net"], 2):,.2f}\n")   
-        message += "```"
+    async def wse_leaderboard(self, ctx: commands.Context, date: str | None = None):
+        """ View the WSE leaderboard, optionally as of the end of a past date (YYYY-MM-DD) """
+        if date is not None:
+            await self.__historical_leaderboard(ctx, date)
+            return
+        positions = await adb.get_latest_positions(ctx.guild)
+        if len(positions) == 0:
+            await ctx.send("Nobody has made any WSE transactions yet")
+            return
+        curr_price = await self.__current_price(ctx.guild)
 
-        await ctx.send(message)
+        # value every portfolio at once
+        import numpy as np
+        names = np.array([position["user_name"] for position in positions])
+        holding = np.array([position["action"] == "buy" for position in positions])
+        cash = np.array([position["cash_value"] for position in positions], dtype=float)
+        stock = np.where(holding, curr_price, 0.0)
+        await send_message(ctx.channel, self.__leaderboard_message("WALARUS STOCK EXCHANGE LEADERBOARD", 
+                                                                   names, stock, cash))
+
+
+    @commands.command(name="wsehistory", aliases=["portfoliohistory"])
+    async def wse_history(self, ctx: commands.Context, member: discord.Member | None = None):
+        """ Chart your (or another member's) WSE portfolio value over time """
+        if member is None:
+            member = ctx.author
+        import numpy as np
+        replay = await self.__replay(ctx.guild)
+        values = replay.user_values(member.id)
+        if np.all(np.isnan(values)):
+            who = "You haven't" if member.id == ctx.author.id else f"{member.name} hasn't"
+            await ctx.send(f"{who} made any transactions yet. Try the 'wsebuy' or 'wsesell' commands.")
+            return
+        started = np.flatnonzero(~np.isnan(values))[0]
+        await self.__send_history_chart(ctx, replay.times[started:], values[started:],
+                                        f"{member.name}'s Portfolio Value")
+
+
+    @commands.command(name="wseserverhistory", aliases=["wseguildhistory"])
+    async def wse_server_history(self, ctx: commands.Context):
+        """ Chart the combined WSE portfolio value of the whole server over time """
+        replay = await self.__replay(ctx.guild)
+        if len(replay.user_ids) == 0:
+            await ctx.send("Nobody has made any WSE transactions yet")
+            return
+        await self.__send_history_chart(ctx, replay.times, replay.guild_values(),
+                                        f"{ctx.guild.name} Total Portfolio Value")
 
     # @commands.command(name="wsetest")
     # async def wse_test(self, ctx: commands.Context, member: discord.Member | None):
     #     """ Test command for the Walarus Stock Exchange """
-    #     db.get_transactions(member)
+    #     await adb.get_transactions(member)
     
     #endregion
 
     #region Helper Functions
     
+    def __status_lock(self, guild: discord.Guild) -> asyncio.Lock:
+        """ Lock that serializes opening and closing the WSE in the guild """
+        return self.__status_locks.setdefault(guild.id, asyncio.Lock())
+
+    async def __is_open(self, guild: discord.Guild) -> bool:
+        """ Whether the WSE is open in the guild, served from live_wse_sessions when the
+            guild has a live session and from the database otherwise """
+        if guild in live_wse_sessions:
+            wse_cache_stats.status_hits += 1
+            return True
+        wse_cache_stats.status_misses += 1
+        return await adb.get_wse_status(guild)
+
+    async def __current_price(self, guild: discord.Guild) -> float:
+        """ Current stock price, from memory when the guild has a live session """
+        session = live_wse_sessions.get(guild)
+        if session is None:
+            wse_cache_stats.price_misses += 1
+            return await adb.get_current_wse_price(guild)
+        return await session.current_price()
+
+    async def __replay(self, guild: discord.Guild) -> PortfolioReplay:
+        """ Replays the guild's ledger against its daily closes plus the current price """
+        transactions, (times, prices) = await asyncio.gather(adb.get_transactions(guild=guild),
+                                                             adb.get_price_series(guild, "day", max_points=None))
+        times.append(datetime.now())
+        prices.append(await self.__current_price(guild))
+        return await asyncio.to_thread(replay_portfolios, transactions, times, prices)
+
+    async def __historical_leaderboard(self, ctx: commands.Context, date: str):
+        try:
+            as_of = datetime.strptime(date, "%Y-%m-%d") + timedelta(days=1, microseconds=-1)
+        except ValueError:
+            await ctx.send("Give me a date like 2024-05-31")
+            return
+        transactions, (_, prices) = await asyncio.gather(adb.get_transactions(guild=ctx.guild),
+                                                         adb.get_price_series(ctx.guild, "tick", end=as_of, max_points=1))
+        if len(prices) == 0:
+            await ctx.send(f"The Walarus Stock Exchange wasn't open yet on {date}")
+            return
+        import numpy as np
+        replay = await asyncio.to_thread(replay_portfolios, transactions, [as_of], prices)
+        joined = ~np.isnan(replay.cash[:, 0])
+        if not np.any(joined):
+            await ctx.send(f"Nobody had made any WSE transactions by {date}")
+            return
+        names = np.array(replay.user_names)[joined]
+        stock = replay.stock_values()[joined, 0]
+        cash = replay.cash[joined, 0]
+        await send_message(ctx.channel, self.__leaderboard_message(f"WALARUS STOCK EXCHANGE LEADERBOARD AS OF {date}", 
+                                                                   names, stock, cash))
+
+    def __leaderboard_message(self, title: str, names: "np.ndarray", stock: "np.ndarray", cash: "np.ndarray") -> str:
+        import numpy as np
+        total = stock + cash
+        net = total - 1
+        order = np.lexsort((names, -total)) # highest total first, ties broken by name
+
+        message = f"```{title}\n\n"
+        for i in order:
+            message += (f"{names[i]}\n"
+                        f"\tStock Value: ${round(stock[i], 2):,.2f}\n"
+                        f"\tCash Value: ${round(cash[i], 2):,.2f}\n"
+                        f"\tTotal Portfolio Value: ${round(total[i], 2):,.2f}\n"
+                        f"\tOverall Net: ${round(net[i], 2):,.2f}\n")
+        message += "```"
+        return message
+
+    async def __send_history_chart(self, ctx: commands.Context, times: "np.ndarray", values: "np.ndarray", title: str):
+        chart = await asyncio.to_thread(render_portfolio_chart, times.astype("datetime64[s]").tolist(), 
+                                        values.tolist(), title)
+        await ctx.send(file=discord.File(io.BytesIO(chart), filename="portfolio.jpg"))
+
     async def __show_graph(self, ctx: commands.Context):
-        matplotlib.use('Agg')
-        timestamps, prices = db.get_prices(ctx.guild)
-
-        fig, ax = plt.subplots()
-        fig.set_figwidth(15)
-        ax.set_ylabel("Price", labelpad=25)
-        ax.yaxis.set_major_formatter('${x:1.2f}')
-        ax.set_xlabel("Date", labelpad=25)
-        ax.tick_params(axis='x', labelrotation=90)
-        ax.plot(timestamps, prices, marker="o")
-
-        image_name = "prices.jpg"        
-        plt.savefig(image_name, bbox_inches='tight')
-        plt.close()
-        await ctx.send(file=discord.File(image_name))
-        os.remove(image_name)
+        chart = await self.charts.get(ctx.guild)
+        await ctx.send(file=discord.File(io.BytesIO(chart), filename="prices.jpg"))
 
     #endregion
\ No newline at end of file
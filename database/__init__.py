@@ -1,8 +1,18 @@
 from .db_archive import (get_next_archive_date, 
                          get_archived_name,
-                         update_next_archive_date)
-from .db_servers import (log_server, 
+                         update_next_archive_date,
+                         set_next_archive,
+                         set_archive_schedule)
+from .server_settings import ServerSettings
+from .db_servers import (SHUFFLE_FIELDS,
+                         log_server, 
+                         add_to_shuffle,
+                         pull_from_shuffle,
+                         rename_in_shuffle,
                          remove_discord_server, 
+                         get_server_settings,
+                         get_servers_settings,
+                         invalidate_server_settings,
                          get_rshuffle, 
                          get_ushuffle,
                          get_archive_category,
@@ -14,10 +24,29 @@ from .db_user_stats import (inc_user_stat,
                             update_user_stats, 
                             get_user_stat, 
                             get_user_stats, 
-                            create_user)
-from .db_wse import (get_current_wse_price,
+                            create_user,
+                            get_leaderboard_page,
+                            backfill_user_scores)
+from .indexes import (IndexSpec,
+                      QueryShape,
+                      INDEXES,
+                      QUERY_SHAPES,
+                      ensure_indexes,
+                      explain_query_shapes)
+from .stat_buffer import (StatBuffer,
+                          user_stat_buffer,
+                          buffer_user_stat,
+                          flush_user_stats)
+from .db_wse import (on_wse_price_change,
+                     get_current_wse_price,
                      set_current_wse_price,
+                     get_current_wse_prices,
+                     set_current_wse_prices,
                      get_prices,
+                     get_price_series,
+                     ensure_price_timeseries,
                      set_transaction,
                      get_last_transaction,
+                     get_latest_positions,
+                     ensure_wse_positions,
                      get_transactions)
\ No newline at end of file
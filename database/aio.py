@@ -0,0 +1,106 @@
+""" Async facade over the database package.
+
+Every function here has the same name and signature as its blocking
+counterpart in `database`, but is awaited. Calls run on a bounded thread
+pool so slow Mongo queries never stall the gateway. Setting the
+DB_SYNC_MODE environment variable (or calling set_sync_mode) runs the calls
+inline instead, which is what the shell and tests want. """
+
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+import database as _sync
+
+_MAX_WORKERS: int = int(os.getenv("DB_MAX_WORKERS", 8))
+_executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=_MAX_WORKERS, thread_name_prefix="db")
+_sync_mode: bool = os.getenv("DB_SYNC_MODE", "").lower() in ("1", "true", "yes")
+
+def set_sync_mode(enabled: bool) -> None:
+    """ Run database calls inline on the caller's thread instead of on the executor """
+    global _sync_mode
+    _sync_mode = enabled
+
+def is_sync_mode() -> bool:
+    return _sync_mode
+
+async def run(fn: Callable, *args, **kwargs):
+    """ Runs the given blocking database callable without blocking the event loop """
+    if _sync_mode:
+        return fn(*args, **kwargs)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(fn, *args, **kwargs))
+
+def _wrap(fn: Callable):
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        return await run(fn, *args, **kwargs)
+    return wrapper
+
+#region db_archive
+
+get_next_archive_date = _wrap(_sync.get_next_archive_date)
+get_archived_name = _wrap(_sync.get_archived_name)
+update_next_archive_date = _wrap(_sync.update_next_archive_date)
+set_next_archive = _wrap(_sync.set_next_archive)
+set_archive_schedule = _wrap(_sync.set_archive_schedule)
+
+#endregion
+
+#region db_servers
+
+log_server = _wrap(_sync.log_server)
+add_to_shuffle = _wrap(_sync.add_to_shuffle)
+pull_from_shuffle = _wrap(_sync.pull_from_shuffle)
+rename_in_shuffle = _wrap(_sync.rename_in_shuffle)
+remove_discord_server = _wrap(_sync.remove_discord_server)
+get_server_settings = _wrap(_sync.get_server_settings)
+get_servers_settings = _wrap(_sync.get_servers_settings)
+invalidate_server_settings = _wrap(_sync.invalidate_server_settings)
+get_rshuffle = _wrap(_sync.get_rshuffle)
+get_ushuffle = _wrap(_sync.get_ushuffle)
+get_archive_category = _wrap(_sync.get_archive_category)
+get_chat_to_archive = _wrap(_sync.get_chat_to_archive)
+get_wse_status = _wrap(_sync.get_wse_status)
+set_wse_status = _wrap(_sync.set_wse_status)
+get_active_wse_servers = _wrap(_sync.get_active_wse_servers)
+
+#endregion
+
+#region indexes
+
+ensure_indexes = _wrap(_sync.ensure_indexes)
+explain_query_shapes = _wrap(_sync.explain_query_shapes)
+
+#endregion
+
+#region db_user_stats
+
+inc_user_stat = _wrap(_sync.inc_user_stat)
+update_user_stats = _wrap(_sync.update_user_stats)
+get_user_stat = _wrap(_sync.get_user_stat)
+get_user_stats = _wrap(_sync.get_user_stats)
+create_user = _wrap(_sync.create_user)
+get_leaderboard_page = _wrap(_sync.get_leaderboard_page)
+backfill_user_scores = _wrap(_sync.backfill_user_scores)
+flush_user_stats = _wrap(_sync.flush_user_stats)
+
+#endregion
+
+#region db_wse
+
+get_current_wse_price = _wrap(_sync.get_current_wse_price)
+set_current_wse_price = _wrap(_sync.set_current_wse_price)
+get_current_wse_prices = _wrap(_sync.get_current_wse_prices)
+set_current_wse_prices = _wrap(_sync.set_current_wse_prices)
+get_prices = _wrap(_sync.get_prices)
+get_price_series = _wrap(_sync.get_price_series)
+ensure_price_timeseries = _wrap(_sync.ensure_price_timeseries)
+set_transaction = _wrap(_sync.set_transaction)
+get_last_transaction = _wrap(_sync.get_last_transaction)
+get_latest_positions = _wrap(_sync.get_latest_positions)
+ensure_wse_positions = _wrap(_sync.ensure_wse_positions)
+get_transactions = _wrap(_sync.get_transactions)
+
+#endregion
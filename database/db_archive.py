@@ -1,7 +1,7 @@
 import discord
 from datetime import datetime, timedelta
 from .db_globals import *
-from .db_servers import get_chat_to_archive
+from .db_servers import get_chat_to_archive, invalidate_server_settings
 from pytz import timezone
 
 def get_next_archive_date() -> datetime:
@@ -15,8 +15,10 @@ def get_next_archive_date() -> datetime:
     )
     return next_archive_date
 
-def get_archived_name(channel_name: str) -> str:
-    date = get_next_archive_date()
+def get_archived_name(channel_name: str, date: datetime | None = None) -> str:
+    """ Name general chat gets once it's archived on the given date (defaults to the global archive date) """
+    if date is None:
+        date = get_next_archive_date()
     month = str(date.month)
     day = str(date.day)
     year = str(date.year)
@@ -34,4 +36,22 @@ def update_next_archive_date(archive_freq: timedelta) -> None:
         "second": new_date.second
     }
     collection = db.next_archive_date
-    collection.update_one({"_id": DATE_ID}, {"$set": new_date_fields}, upsert=True)
\ No newline at end of file
+    collection.update_one({"_id": DATE_ID}, {"$set": new_date_fields}, upsert=True)
+
+def set_next_archive(guild: discord.Guild, when: datetime) -> None:
+    """ Persists when the guild's general chat gets archived next """
+    connected_servers = db.connected_servers
+    connected_servers.update_one({ "_id": guild.id }, { "$set": { "next_archive": when } })
+    invalidate_server_settings(guild)
+
+def set_archive_schedule(guild: discord.Guild, archive_int: int, tz: str, next_archive: datetime) -> None:
+    """ Persists the guild's archive interval (in weeks), timezone and next archive date """
+    connected_servers = db.connected_servers
+    connected_servers.update_one({ "_id": guild.id }, 
+                                 { "$set": { 
+                                        "archive_int": archive_int, 
+                                        "timezone": tz, 
+                                        "next_archive": next_archive 
+                                    } 
+                                 })
+    invalidate_server_settings(guild)
\ No newline at end of file
@@ -1,26 +1,73 @@
 import discord
 from datetime import datetime
 from .db_globals import *
+from .server_settings import ServerSettings
+from .ttl_cache import TTLCache
+import os
+from pymongo import UpdateOne
 from typing import cast
 
-def log_server(discord_server: discord.Guild) -> bool:
+_settings_cache: TTLCache[ServerSettings] = TTLCache(ttl=float(os.getenv("SERVER_SETTINGS_TTL", 300)))
+""" Cached ServerSettings keyed by server ID """
+
+SHUFFLE_FIELDS = ("rshuffle", "ushuffle")
+""" Fields holding the names involved in role change """
+
+def log_server(discord_server: discord.Guild, rebuild_shuffle: bool = False) -> bool:
+    """ Upserts the server's metadata, returns whether a new document was created.\n
+        The shuffle lists are only written in full when the document is created or when
+        rebuild_shuffle is set, otherwise they're kept up to date by the shuffle deltas """
     connected_servers = db.connected_servers
-    server_exists = bool(connected_servers.find_one({"_id": discord_server.id}))
     icon_url = "" if discord_server.icon is None else discord_server.icon.url
     description_exists = bool(discord_server.description)
     server_data = {
-        "_id": discord_server.id,
         "name": str(discord_server.name),
         "description": str(discord_server.description) if description_exists else "",
         "icon_url": icon_url,
         "creation_at": discord_server.created_at,
-        "last_updated": datetime.now(),
-        "rshuffle": list(map(_role_name, discord_server.roles)),
-        "ushuffle": list(map(_member_name, discord_server.members))
+        "last_updated": datetime.now()
     }
-    if not server_exists:
-        server_data["joined"] = datetime.now()
-    return log(discord_server, connected_servers, server_data)
+    query = connected_servers.update_one({ "_id": discord_server.id },
+                                         { "$set": server_data, "$setOnInsert": { "joined": datetime.now() } },
+                                         upsert=True)
+    created = query.upserted_id is not None
+    if created or rebuild_shuffle:
+        connected_servers.update_one({ "_id": discord_server.id },
+                                     { "$set": {
+                                            "rshuffle": list(map(_role_name, discord_server.roles)),
+                                            "ushuffle": list(map(_member_name, discord_server.members))
+                                        }
+                                     })
+    _settings_cache.invalidate(discord_server.id)
+    return created
+
+def add_to_shuffle(guild: discord.Guild, field: str, name: str) -> None:
+    """ Adds a name to one of the guild's shuffle lists (no-op if it's already there) """
+    _check_shuffle_field(field)
+    db.connected_servers.update_one({ "_id": guild.id }, { "$addToSet": { field: name } })
+    _settings_cache.invalidate(guild.id)
+
+def pull_from_shuffle(guild: discord.Guild, field: str, name: str) -> None:
+    """ Removes a name from one of the guild's shuffle lists """
+    _check_shuffle_field(field)
+    db.connected_servers.update_one({ "_id": guild.id }, { "$pull": { field: name } })
+    _settings_cache.invalidate(guild.id)
+
+def rename_in_shuffle(guild: discord.Guild, field: str, before: str, after: str) -> None:
+    """ Replaces a name in one of the guild's shuffle lists (a $pull and an $addToSet
+        can't target the same field in one update, so they go out as one ordered bulk write) """
+    _check_shuffle_field(field)
+    if before == after:
+        return
+    db.connected_servers.bulk_write([
+        UpdateOne({ "_id": guild.id, field: before }, { "$pull": { field: before } }),
+        UpdateOne({ "_id": guild.id }, { "$addToSet": { field: after } })
+    ])
+    _settings_cache.invalidate(guild.id)
+
+def _check_shuffle_field(field: str) -> None:
+    if field not in SHUFFLE_FIELDS:
+        raise Exception(f"'{field}' is not a shuffle list, must be one of {SHUFFLE_FIELDS}")
 
 def _role_name(role: discord.Role) -> str:
     return role.name
@@ -33,51 +80,51 @@ def remove_discord_server(guild: discord.Guild) -> int:
     connected_servers = db.connected_servers
     user_stats = db.user_stats
     total = connected_servers.delete_many({"_id": guild.id}).deleted_count
+    _settings_cache.invalidate(guild.id)
     return total
 
-def get_rshuffle(guild: discord.Guild) -> list[str]:
+def get_server_settings(guild: discord.Guild) -> ServerSettings:
+    """ Returns the guild's settings, fetched with one projected find_one and 
+        then served from memory until they expire or are invalidated """
+    settings = _settings_cache.get(guild.id)
+    if settings is None:
+        connected_servers = db.connected_servers
+        query = connected_servers.find_one({ "_id": guild.id }, ServerSettings.PROJECTION)
+        settings = ServerSettings(guild.id, query)
+        _settings_cache.set(guild.id, settings)
+    return settings
+
+def get_servers_settings(guild_ids: list[int]) -> dict[int, ServerSettings]:
+    """ Fetches the settings of many guilds with a single $in query and caches them,
+        returns the settings keyed by server ID (guilds without a document get defaults) """
     connected_servers = db.connected_servers
-    query = connected_servers.find_one({
-                                            "_id": guild.id
-                                       },
-                                       {
-                                            "rshuffle": 1
-                                       })
-    if query is None:
-        return []
-    query_dict: dict = cast(dict, query)
-    return [] if query_dict.get("rshuffle") == None else query_dict["rshuffle"]
+    query = connected_servers.find({ "_id": { "$in": guild_ids } }, ServerSettings.PROJECTION)
+    documents = { document["_id"]: document for document in query }
+    result = {}
+    for guild_id in guild_ids:
+        settings = ServerSettings(guild_id, documents.get(guild_id))
+        _settings_cache.set(guild_id, settings)
+        result[guild_id] = settings
+    return result
+
+def invalidate_server_settings(guild: discord.Guild) -> None:
+    """ Drops the guild's cached settings so that the next read goes to the database """
+    _settings_cache.invalidate(guild.id)
+
+def get_rshuffle(guild: discord.Guild) -> list[str]:
+    return get_server_settings(guild).rshuffle
 
 def get_ushuffle(guild: discord.Guild) -> list[str]:
-    connected_servers = db.connected_servers
-    query = connected_servers.find_one({ "_id": guild.id },
-                                       { "ushuffle": 1 })
-    if query is None:
-        return []
-    query_dict: dict = cast(dict, query)
-    return [] if query_dict.get("ushuffle") == None else query_dict["ushuffle"]
-
-def get_archive_category(guild: discord.Guild) -> str:
-    connected_servers = db.connected_servers
-    query = connected_servers.find_one({ "_id": guild.id },
-                                       { "archive_category": 1 })
-    query_dict: dict = cast(dict, query)
-    return str(query_dict["archive_category"])
+    return get_server_settings(guild).ushuffle
 
-def get_chat_to_archive(guild: discord.Guild) -> str:
-    connected_servers = db.connected_servers
-    query = connected_servers.find_one({ "_id": guild.id },
-                                       { "chat_to_archive": 1 })
-    query_dict: dict = cast(dict, query)
-    return str(query_dict["chat_to_archive"])
+def get_archive_category(guild: discord.Guild) -> str | None:
+    return get_server_settings(guild).archive_category
+
+def get_chat_to_archive(guild: discord.Guild) -> str | None:
+    return get_server_settings(guild).chat_to_archive
 
 def get_wse_status(guild: discord.Guild) -> bool:
-    connected_servers = db.connected_servers
-    query = connected_servers.find_one({ "_id": guild.id },
-                                       { "wse": 1 } )
-    query_dict = cast(dict, query)
-    status = bool(query_dict["wse"])
-    return status
+    return get_server_settings(guild).wse
 
 def set_wse_status(guild: discord.Guild, status: bool, user_id: int | None = None):
     if status and user_id is None:
@@ -90,6 +137,7 @@ def set_wse_status(guild: discord.Guild, status: bool, user_id: int | None = Non
                                                 "wse_user_id": -1 if user_id is None else user_id
                                             } 
                                          })
+    _settings_cache.invalidate(guild.id)
 
 def get_active_wse_servers():
     connected_servers = db.connected_servers
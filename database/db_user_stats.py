@@ -1,6 +1,11 @@
 import discord
 from .db_globals import *
+from .ttl_cache import TTLCache
 from datetime import datetime
+import os
+
+_leaderboard_pages: TTLCache[tuple[list[dict], int]] = TTLCache(ttl=float(os.getenv("LEADERBOARD_TTL", 30)))
+""" Cached leaderboard pages keyed by (server_id, page, page_size) """
 
 def inc_user_stat(discord_server: discord.Guild, user, field: str, inc = 1) -> bool:
     user_stats = db.user_stats
@@ -11,6 +16,7 @@ def inc_user_stat(discord_server: discord.Guild, user, field: str, inc = 1) -> b
             stats_data[stat] = inc
         else:
             stats_data[stat] = 0
+    stats_data["score"] = inc
     return user_stats.update_one({
                                     "_id": {
                                         "server_id": discord_server.id, 
@@ -82,6 +88,7 @@ def create_user(discord_server: discord.Guild, user) -> bool:
                                     "$set": {
                                         "mentioned": 0,
                                         "sent_messages": 0,
+                                        "score": 0,
                                         "server_name": discord_server.name,
                                         "time_in_vc": 0,
                                         "user_name": user.name,
@@ -90,4 +97,45 @@ def create_user(discord_server: discord.Guild, user) -> bool:
                                         "last_connected_to_vc": datetime.min,
                                         "bot": user.bot
                                     }
-                                 }, upsert=True).upserted_id != None
\ No newline at end of file
+                                 }, upsert=True).upserted_id != None
+
+def get_leaderboard_page(discord_server: discord.Guild, page: int, page_size: int = 10) -> tuple[list[dict], int]:
+    """ Returns one page of the guild's stats leaderboard (ranked by score, highest first) 
+        and the total number of users. Pages are cached for a short time per guild """
+    key = (discord_server.id, page, page_size)
+    cached = _leaderboard_pages.get(key)
+    if cached is not None:
+        return cached
+
+    user_stats = db.user_stats
+    # $match + $sort are served by the (_id.server_id, score, _id.user_id) index, so only
+    # the page is read. The user ID breaks ties so users with the same score don't move between pages
+    users = list(user_stats.aggregate([
+        { "$match": { "_id.server_id": discord_server.id } },
+        { "$sort": { "score": -1, "_id.user_id": 1 } },
+        { "$skip": page * page_size },
+        { "$limit": page_size },
+        { "$project": {
+            "_id": 0,
+            "user_name": 1,
+            "mentioned": { "$ifNull": ["$mentioned", 0] },
+            "sent_messages": { "$ifNull": ["$sent_messages", 0] },
+            "time_in_vc": { "$ifNull": ["$time_in_vc", 0] },
+            "score": 1
+        } }
+    ]))
+    total = user_stats.count_documents({ "_id.server_id": discord_server.id })
+    result = (users, total)
+    _leaderboard_pages.set(key, result)
+    return result
+
+def backfill_user_scores() -> int:
+    """ Computes the materialized score of user documents written before it existed, 
+        returns the number of documents updated """
+    user_stats = db.user_stats
+    return user_stats.update_many({ "score": { "$exists": False } },
+                                  [{ "$set": { "score": { "$add": [
+                                      { "$ifNull": ["$mentioned", 0] },
+                                      { "$ifNull": ["$sent_messages", 0] },
+                                      { "$ifNull": ["$time_in_vc", 0] }
+                                  ] } } }]).modified_count
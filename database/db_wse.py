@@ -1,61 +1,222 @@
 import discord
 from .db_globals import *
-from datetime import datetime
-from typing import cast, Literal
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+from typing import Callable, cast, Literal
 from bson.timestamp import Timestamp
 
+_price_listeners: list[Callable[[int], None]] = []
+""" Callbacks run with the server ID whenever a new price tick is written """
+
+def on_wse_price_change(listener: Callable[[int], None]) -> None:
+    """ Registers a callback that runs (with the server ID) whenever a new WSE price is written """
+    _price_listeners.append(listener)
+
+PRICE_RESOLUTIONS = ["tick", "day", "week"]
+""" Resolutions price history can be read at, finest first """
+
+MAX_PRICE_POINTS = 120
+""" Default upper bound on the number of points get_prices returns """
+
 def get_current_wse_price(discord_server: discord.Guild) -> float:
-    price_log = db.wse_price_log
-    query = price_log.find_one({ "_id.server_id": discord_server.id }, { "_id": 0, "price": 1 }, 
-                                    sort=[("_id.timestamp", -1)])
+    price_ticks = db.wse_price_ticks
+    query = price_ticks.find_one({ "server_id": discord_server.id }, { "_id": 0, "price": 1 }, 
+                                 sort=[("timestamp", -1)])
     query_dict = cast(dict, query) 
     price = float(query_dict["price"])
     return price
 
 
+def get_current_wse_prices(server_ids: list[int]) -> dict[int, float]:
+    """ Returns the latest price of each of the given servers in a single round trip """
+    price_ticks = db.wse_price_ticks
+    query = price_ticks.aggregate([
+        { "$match": { "server_id": { "$in": server_ids } } },
+        { "$sort": { "server_id": 1, "timestamp": 1 } },
+        { "$group": { "_id": "$server_id", "price": { "$last": "$price" } } }
+    ])
+    return { result["_id"]: float(result["price"]) for result in query }
+
+
 def set_current_wse_price(discord_server: discord.Guild, new_price: float) -> bool:
-    price_log = db.wse_price_log
+    return set_current_wse_prices({ discord_server.id: new_price }) == 1
+
+
+def set_current_wse_prices(new_prices: dict[int, float]) -> int:
+    """ Writes a new price tick for each server (keyed by server ID) with one bulk insert,
+        returns the number of ticks written """
+    if len(new_prices) == 0:
+        return 0
+    price_ticks = db.wse_price_ticks
     timestamp = datetime.now()
-    return price_log.insert_one({
-                                    "_id": {
-                                        "server_id": discord_server.id,
-                                        "timestamp": timestamp
-                                    },
-                                    "price": new_price,
-                                }).acknowledged
+    inserted = price_ticks.insert_many([{
+                                            "server_id": server_id,
+                                            "timestamp": timestamp,
+                                            "price": new_price,
+                                        } for server_id, new_price in new_prices.items()]).inserted_ids
+    rollups = []
+    for server_id, new_price in new_prices.items():
+        rollups.extend(_rollup_updates(server_id, timestamp, new_price))
+    db.wse_price_rollups.bulk_write(rollups, ordered=False)
+    for server_id in new_prices.keys():
+        for listener in _price_listeners:
+            listener(server_id)
+    return len(inserted)
+
 
+def get_prices(discord_server: discord.Guild, resolution: str = "auto", start: datetime | None = None,
+               end: datetime | None = None, max_points: int = MAX_PRICE_POINTS):
+    """ Returns (dates, prices) for the guild's price history between start and end. 
+        Resolution is 'tick', 'day' (daily close), 'week' (weekly close) or 'auto', which picks 
+        the finest resolution that fits in max_points. At most the latest max_points are returned """
+    times, prices = get_price_series(discord_server, resolution, start, end, max_points)
+    timestamps = [str(time.date()) for time in times]
+    return (timestamps, prices)
 
-def get_prices(discord_server: discord.Guild):
-    timestamps = []
-    prices = []
 
-    price_log = db.wse_price_log
-    results = price_log.find({ "_id.server_id": discord_server.id }, { "_id.timestamp": 1, "price": 1 }, sort=[("_id.timestamp", 1)])
+def get_price_series(discord_server: discord.Guild, resolution: str = "auto", start: datetime | None = None,
+                     end: datetime | None = None, max_points: int | None = MAX_PRICE_POINTS) -> tuple[list[datetime], list[float]]:
+    """ Same as get_prices but returns the time of each point (the tick, or the bucket's
+        closing tick) instead of a date label. max_points=None returns the whole range """
+    if resolution == "auto":
+        resolution = "tick" if max_points is None else _pick_resolution(discord_server.id, start, end, max_points)
+    if resolution not in PRICE_RESOLUTIONS:
+        raise Exception(f"Unknown price resolution '{resolution}'")
+    limit = 0 if max_points is None else max_points
 
-    for result in results:
-        timestamps.append(str(result["_id"]["timestamp"].date()))
-        prices.append(result["price"])
+    if resolution == "tick":
+        results = db.wse_price_ticks.find({ "server_id": discord_server.id, **_time_range("timestamp", start, end) },
+                                          { "_id": 0, "timestamp": 1, "price": 1 },
+                                          sort=[("timestamp", -1)], limit=limit)
+        points = [(result["timestamp"], result["price"]) for result in results]
+    else:
+        results = db.wse_price_rollups.find({ "_id.server_id": discord_server.id, "_id.resolution": resolution,
+                                              **_time_range("_id.start", start, end) },
+                                            { "close_time": 1, "close": 1 },
+                                            sort=[("_id.start", -1)], limit=limit)
+        points = [(result["close_time"], result["close"]) for result in results]
 
-    return (timestamps, prices)
+    points.reverse()
+    return ([time for time, _ in points], [float(price) for _, price in points])
 
 
-def set_transaction(member: discord.Member, curr_price: float, transaction_type: Literal["buy", "sell"]) -> bool:
-    transaction_log = db.wse_transaction_log
-    timestamp = datetime.now()
+PRICE_TIMESERIES_MIGRATION = "wse_price_timeseries"
+""" ID of the migrations document marking the price tick backfill as finished """
+
+def ensure_price_timeseries() -> int:
+    """ Creates the price tick time-series collection and its rollups, backfilling them from the
+        legacy wse_price_log, unless the backfill is marked as finished. An interrupted backfill
+        starts over (ticks written since the legacy log stopped are kept). Returns the number of
+        ticks migrated """
+    if db.migrations.find_one({ "_id": PRICE_TIMESERIES_MIGRATION }) is not None:
+        return 0
+
+    # ticks newer than the legacy log were written live (e.g. after an earlier attempt failed)
+    last_legacy = db.wse_price_log.find_one({}, { "_id.timestamp": 1 }, sort=[("_id.timestamp", -1)])
+    live_query = {} if last_legacy is None else { "timestamp": { "$gt": last_legacy["_id"]["timestamp"] } }
+    live = []
+    if "wse_price_ticks" in db.list_collection_names():
+        live = [{ "server_id": tick["server_id"], "timestamp": tick["timestamp"], "price": tick["price"] }
+                for tick in db.wse_price_ticks.find(live_query, sort=[("timestamp", 1)])]
+    db.drop_collection("wse_price_ticks")
+    db.drop_collection("wse_price_rollups")
+    db.create_collection("wse_price_ticks", timeseries={
+        "timeField": "timestamp",
+        "metaField": "server_id",
+        "granularity": "hours"
+    })
+
+    migrated = 0
+    batch = []
+    for tick in db.wse_price_log.find({}, sort=[("_id.timestamp", 1)], allow_disk_use=True):
+        batch.append({ "server_id": tick["_id"]["server_id"], "timestamp": tick["_id"]["timestamp"], "price": tick["price"] })
+        if len(batch) >= 1000:
+            migrated += _backfill_ticks(batch)
+            batch = []
+    if len(batch) > 0:
+        migrated += _backfill_ticks(batch)
+    if len(live) > 0:
+        _backfill_ticks(live)
+    db.migrations.insert_one({ "_id": PRICE_TIMESERIES_MIGRATION, "finished": datetime.now(), "ticks": migrated })
+    return migrated
+
+
+def _backfill_ticks(ticks: list[dict]) -> int:
+    """ Inserts ticks (in timestamp order) and folds them into the rollups, returns the number inserted """
+    rollups = []
+    for tick in ticks:
+        rollups.extend(_rollup_updates(tick["server_id"], tick["timestamp"], tick["price"]))
+    inserted = len(db.wse_price_ticks.insert_many(ticks).inserted_ids)
+    db.wse_price_rollups.bulk_write(rollups, ordered=True)
+    return inserted
+
+
+def _rollup_updates(server_id: int, timestamp: datetime, price: float) -> list[UpdateOne]:
+    """ OHLC upserts for the daily and weekly buckets a tick falls in """
+    day = datetime(timestamp.year, timestamp.month, timestamp.day)
+    week = day - timedelta(days=day.weekday())
+    return [UpdateOne({ "_id": { "server_id": server_id, "resolution": resolution, "start": bucket } },
+                      {
+                          "$setOnInsert": { "open": price },
+                          "$max": { "high": price },
+                          "$min": { "low": price },
+                          "$set": { "close": price, "close_time": timestamp },
+                          "$inc": { "ticks": 1 }
+                      }, upsert=True)
+            for resolution, bucket in [("day", day), ("week", week)]]
+
+
+def _pick_resolution(server_id: int, start: datetime | None, end: datetime | None, max_points: int) -> str:
+    tick_count = db.wse_price_ticks.count_documents({ "server_id": server_id, **_time_range("timestamp", start, end) },
+                                                    limit=max_points + 1)
+    if tick_count <= max_points:
+        return "tick"
+    day_count = db.wse_price_rollups.count_documents({ "_id.server_id": server_id, "_id.resolution": "day",
+                                                       **_time_range("_id.start", start, end) },
+                                                     limit=max_points + 1)
+    return "day" if day_count <= max_points else "week"
+
+
+def _time_range(field: str, start: datetime | None, end: datetime | None) -> dict:
+    bounds = {}
+    if start is not None:
+        bounds["$gte"] = start
+    if end is not None:
+        bounds["$lte"] = end
+    return { field: bounds } if len(bounds) > 0 else {}
+
+
+def set_transaction(member: discord.Member, curr_price: float, transaction_type: Literal["buy", "sell"]) -> dict | None:
+    """ Atomically applies a buy or sell to the member's position and appends it to the ledger.
+        Returns the updated position, or None if the member is already bought in (buy) 
+        or not bought in (sell) """
     guild = member.guild
-    last_transaction = get_last_transaction(member)
-    stock_value = 1
-    cash_value = 0
-
-    if last_transaction["action"] is not None:
-        if transaction_type == "buy":
-            stock_value = curr_price
-            cash_value = last_transaction["cash_value"] - curr_price
-        elif transaction_type == "sell":
-            stock_value = 0
-            cash_value = last_transaction["cash_value"] + curr_price
-
-    return transaction_log.insert_one({ 
+    timestamp = datetime.now()
+    holding = transaction_type == "buy"
+    first_transaction = { "$eq": [{ "$type": "$action" }, "missing"] }
+    cash_change = "$subtract" if holding else "$add"
+
+    # the filter only matches a position in the opposite state, so when it doesn't match the
+    # upsert collides with the existing _id and the trade is rejected without a prior read
+    try:
+        position = db.wse_positions.find_one_and_update(
+            { "_id": { "server_id": guild.id, "user_id": member.id }, "holding": { "$ne": holding } },
+            [{ "$set": {
+                "server_name": { "$literal": guild.name },
+                "user_name": { "$literal": member.name },
+                "holding": holding,
+                "action": transaction_type,
+                "price": curr_price,
+                "timestamp": timestamp,
+                "cash_value": { "$cond": [first_transaction, 0, { cash_change: ["$cash_value", curr_price] }] },
+                "stock_value": { "$cond": [first_transaction, 1, curr_price if holding else 0] }
+            } }],
+            upsert=True, return_document=ReturnDocument.AFTER)
+    except DuplicateKeyError:
+        return None
+
+    db.wse_transaction_log.insert_one({ 
                                         "server_id": guild.id,
                                         "server_name": guild.name,
                                         "user_id": member.id,
@@ -63,19 +224,58 @@ def set_transaction(member: discord.Member, curr_price: float, transaction_type:
                                         "timestamp": timestamp, 
                                         "action": transaction_type,
                                         "price": curr_price,
-                                        "cash_value": cash_value,
-                                        "stock_value": stock_value
-                                      }).acknowledged
+                                        "cash_value": position["cash_value"],
+                                        "stock_value": position["stock_value"]
+                                      })
+    return position
 
 
 def get_last_transaction(member: discord.Member):
-    transaction_log = db.wse_transaction_log
+    """ Returns the member's current position (i.e. the result of their last transaction) with a point read """
+    positions = db.wse_positions
     guild = member.guild
-    query = transaction_log.find_one({ "server_id": guild.id, "user_id": member.id }, sort=[("timestamp", -1)])
+    query = positions.find_one({ "_id": { "server_id": guild.id, "user_id": member.id } })
     query_dict = { "action": None } if query is None else cast(dict, query)
     return query_dict
 
 
+def get_latest_positions(discord_server: discord.Guild) -> list[dict]:
+    """ Returns every participant's current position in the guild """
+    positions = db.wse_positions
+    query = positions.find({ "_id.server_id": discord_server.id })
+    return [{ "user_id": position["_id"]["user_id"], **position } for position in query]
+
+
+WSE_POSITIONS_MIGRATION = "wse_positions"
+""" ID of the migrations document marking the positions backfill as finished """
+
+def ensure_wse_positions() -> int:
+    """ Builds wse_positions from the transaction ledger unless the backfill is marked as finished,
+        returns the number of positions in the collection. Positions written live in the meantime
+        are newer than the ledger's, so they're kept, which also makes an interrupted backfill safe to rerun """
+    positions = db.wse_positions
+    if db.migrations.find_one({ "_id": WSE_POSITIONS_MIGRATION }) is not None:
+        return 0
+    db.wse_transaction_log.aggregate([
+        { "$sort": { "server_id": 1, "user_id": 1, "timestamp": 1 } },
+        { "$group": {
+            "_id": { "server_id": "$server_id", "user_id": "$user_id" },
+            "server_name": { "$last": "$server_name" },
+            "user_name": { "$last": "$user_name" },
+            "action": { "$last": "$action" },
+            "price": { "$last": "$price" },
+            "timestamp": { "$last": "$timestamp" },
+            "cash_value": { "$last": "$cash_value" },
+            "stock_value": { "$last": "$stock_value" }
+        } },
+        { "$set": { "holding": { "$eq": ["$action", "buy"] } } },
+        { "$merge": { "into": "wse_positions", "whenMatched": "keepExisting", "whenNotMatched": "insert" } }
+    ])
+    built = positions.estimated_document_count()
+    db.migrations.insert_one({ "_id": WSE_POSITIONS_MIGRATION, "finished": datetime.now(), "positions": built })
+    return built
+
+
 def get_transactions(member: discord.Member | None = None, guild: discord.Guild | None = None):
     transaction_log = db.wse_transaction_log
     result = None
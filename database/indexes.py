@@ -0,0 +1,100 @@
+from .db_globals import *
+from typing import Any
+
+class IndexSpec:
+    """ An index that the code relies on """
+
+    def __init__(self, collection: str, keys: list[tuple[str, int]], name: str, **options) -> None:
+        self.collection: str = collection
+        """ Name of the collection the index belongs to """
+        self.keys: list[tuple[str, int]] = keys
+        """ Indexed fields and their directions """
+        self.name: str = name
+        """ Name of the index (keeps create_index idempotent across key order changes) """
+        self.options: dict = options
+        """ Extra create_index options (unique, partialFilterExpression, ...) """
+
+    def __str__(self) -> str:
+        keys = ", ".join([f"{field}: {direction}" for field, direction in self.keys])
+        return f"{self.collection}.{self.name} {{{keys}}}"
+
+class QueryShape:
+    """ The shape of a query the code issues, used to check that it's served by an index """
+
+    def __init__(self, name: str, collection: str, filter: dict, sort: list[tuple[str, int]] | None = None) -> None:
+        self.name: str = name
+        """ Short description of where the query comes from """
+        self.collection: str = collection
+        """ Name of the collection that's queried """
+        self.filter: dict = filter
+        """ Query filter with placeholder values """
+        self.sort: list[tuple[str, int]] | None = sort
+        """ Sort order, if any """
+
+INDEXES: list[IndexSpec] = [
+    IndexSpec("user_stats", [("_id.server_id", 1), ("score", -1), ("_id.user_id", 1)], "server_score_user"),
+    IndexSpec("connected_servers", [("wse", 1)], "wse"),
+    IndexSpec("wse_price_ticks", [("server_id", 1), ("timestamp", -1)], "server_timestamp"),
+    IndexSpec("wse_price_rollups", [("_id.server_id", 1), ("_id.resolution", 1), ("_id.start", -1)], "server_resolution_start"),
+    IndexSpec("wse_transaction_log", [("server_id", 1), ("user_id", 1), ("timestamp", 1)], "server_user_timestamp"),
+    IndexSpec("wse_transaction_log", [("server_id", 1), ("timestamp", 1)], "server_timestamp"),
+    IndexSpec("wse_positions", [("_id.server_id", 1)], "server"),
+]
+""" Every index the code relies on, applied at startup by ensure_indexes """
+
+RETIRED_INDEXES: list[tuple[str, str]] = [
+    ("user_stats", "server_score"),
+    ("wse_price_log", "server_timestamp"),
+]
+""" (collection, name) of indexes the code no longer relies on, dropped by ensure_indexes """
+
+QUERY_SHAPES: list[QueryShape] = [
+    QueryShape("get_user_stats", "user_stats", { "_id.server_id": 0 }),
+    QueryShape("get_leaderboard_page", "user_stats", { "_id.server_id": 0 }, [("score", -1), ("_id.user_id", 1)]),
+    QueryShape("get_active_wse_servers", "connected_servers", { "wse": True }),
+    QueryShape("get_current_wse_price", "wse_price_ticks", { "server_id": 0 }, [("timestamp", -1)]),
+    QueryShape("get_prices (rollups)", "wse_price_rollups", { "_id.server_id": 0, "_id.resolution": "day" }, [("_id.start", -1)]),
+    QueryShape("get_last_transaction", "wse_positions", { "_id": { "server_id": 0, "user_id": 0 } }),
+    QueryShape("get_latest_positions", "wse_positions", { "_id.server_id": 0 }),
+    QueryShape("ensure_wse_positions", "wse_transaction_log", {}, [("server_id", 1), ("user_id", 1), ("timestamp", 1)]),
+    QueryShape("get_transactions (guild)", "wse_transaction_log", { "server_id": 0 }, [("timestamp", 1)]),
+]
+""" Query shapes checked by explain_query_shapes """
+
+def ensure_indexes() -> list[str]:
+    """ Creates every registered index that doesn't exist yet (create_index is a no-op
+        for existing indexes) and drops retired ones, returns the names of the indexes ensured """
+    for collection, name in RETIRED_INDEXES:
+        if name in db[collection].index_information():
+            db[collection].drop_index(name)
+    ensured = []
+    for spec in INDEXES:
+        ensured.append(f"{spec.collection}.{db[spec.collection].create_index(spec.keys, name=spec.name, **spec.options)}")
+    return ensured
+
+def explain_query_shapes() -> list[tuple[QueryShape, bool, list[str]]]:
+    """ Explains every registered query shape. Returns each shape with whether it
+        needs a collection scan and the names of the indexes its winning plan uses """
+    results = []
+    for shape in QUERY_SHAPES:
+        cursor = db[shape.collection].find(shape.filter)
+        if shape.sort is not None:
+            cursor = cursor.sort(shape.sort)
+        plan = cursor.explain().get("queryPlanner", {})
+        stages = list(_plan_stages(plan))
+        collscan = any(stage.get("stage") == "COLLSCAN" for stage in stages)
+        index_names = sorted({str(stage["indexName"]) for stage in stages if "indexName" in stage})
+        results.append((shape, collscan, index_names))
+    return results
+
+def _plan_stages(plan: Any):
+    """ Walks every stage of a winning plan (rejected plans are skipped) """
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan
+        for key, value in plan.items():
+            if key != "rejectedPlans":
+                yield from _plan_stages(value)
+    elif isinstance(plan, list):
+        for item in plan:
+            yield from _plan_stages(item)
@@ -0,0 +1,49 @@
+from datetime import datetime, UTC
+
+class ServerSettings:
+    """ Typed view of the settings stored on a guild's connected_servers document """
+
+    PROJECTION = {
+        "rshuffle": 1,
+        "ushuffle": 1,
+        "archive_category": 1,
+        "chat_to_archive": 1,
+        "wse": 1,
+        "wse_user_id": 1,
+        "archive_int": 1,
+        "timezone": 1,
+        "next_archive": 1
+    }
+    """ Fields fetched from connected_servers (everything but the bulky server metadata) """
+
+    def __init__(self, server_id: int, document: dict | None) -> None:
+        document = {} if document is None else document
+        self.server_id: int = server_id
+        """ ID of the guild the settings belong to """
+        self.exists: bool = len(document) > 0
+        """ Whether the guild has a connected_servers document at all """
+        self.rshuffle: list[str] = document.get("rshuffle") or []
+        """ String list of roles involved in role change """
+        self.ushuffle: list[str] = document.get("ushuffle") or []
+        """ List of users involved in role change """
+        self.archive_category: str | None = document.get("archive_category")
+        """ Name of the channel category archived chats get moved into """
+        self.chat_to_archive: str | None = document.get("chat_to_archive")
+        """ Name of the text channel that gets archived """
+        self.wse: bool = bool(document.get("wse", False))
+        """ Whether the Walarus Stock Exchange is open """
+        self.wse_user_id: int = int(document.get("wse_user_id", -1))
+        """ User ID that crashes the WSE when they join (-1 if none) """
+        self.archive_int: int = int(document.get("archive_int", 2))
+        """ General chat archive interval (in weeks) """
+        self.timezone: str = str(document.get("timezone", "US/Eastern"))
+        """ Timezone the guild's archive schedule (and times shown to it) follow """
+        next_archive = document.get("next_archive")
+        self.next_archive: datetime | None = None if next_archive is None else next_archive.replace(tzinfo=UTC)
+        """ When general chat gets archived next (UTC, None if it's never been scheduled) """
+
+    def __str__(self) -> str:
+        return (f"ServerSettings: id={self.server_id}, archive_category='{self.archive_category}', "
+                f"chat_to_archive='{self.chat_to_archive}', wse={self.wse}, "
+                f"archive every {self.archive_int} week(s) ({self.timezone}), "
+                f"{len(self.rshuffle)} roles, {len(self.ushuffle)} members")
@@ -0,0 +1,150 @@
+import discord
+import os
+import threading
+import time
+from .db_globals import *
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+USER_STATS = ["mentioned", "sent_messages", "time_in_vc"]
+""" Counter fields kept on every user_stats document """
+
+class StatBuffer:
+    """ Write-behind buffer that coalesces user stat increments per
+        (server_id, user_id, field) and writes them in one unordered bulk_write """
+
+    def __init__(self, max_keys: int = 500, max_age: float = 5.0) -> None:
+        self.max_keys: int = max_keys
+        """ Number of buffered (server, user) documents that forces a flush """
+        self.max_age: float = max_age
+        """ Seconds the oldest buffered increment may wait before a flush is due """
+        self.__lock = threading.Lock()
+        self.__deltas: dict[tuple[int, int], dict[str, int]] = {}
+        self.__names: dict[tuple[int, int], tuple[str, str]] = {}
+        self.__oldest: float | None = None
+        self.flushes: int = 0
+        """ Number of bulk writes issued """
+        self.flushed_ops: int = 0
+        """ Number of documents updated across all flushes """
+        self.buffered_incs: int = 0
+        """ Number of increments accepted into the buffer """
+        self.last_flush_ms: float = 0.0
+        """ Latency of the most recent flush (in milliseconds) """
+        self.total_flush_ms: float = 0.0
+        """ Cumulative flush latency (in milliseconds) """
+
+    def __str__(self) -> str:
+        avg_ms = self.total_flush_ms / self.flushes if self.flushes > 0 else 0.0
+        return (f"StatBuffer: depth={self.depth()} documents, accepted={self.buffered_incs} increments, "
+                f"flushes={self.flushes} ({self.flushed_ops} documents), "
+                f"last_flush={self.last_flush_ms:.1f}ms, avg_flush={avg_ms:.1f}ms")
+
+    def depth(self) -> int:
+        """ Number of (server, user) documents currently waiting to be written """
+        with self.__lock:
+            return len(self.__deltas)
+
+    def add(self, discord_server: discord.Guild, user, field: str, inc: int = 1) -> bool:
+        """ Buffers an increment of the given user stat, returns whether a flush is now due """
+        if field not in USER_STATS:
+            raise Exception(f"'{field}' is not a user stat")
+        key = (discord_server.id, user.id)
+        with self.__lock:
+            deltas = self.__deltas.setdefault(key, {})
+            deltas[field] = deltas.get(field, 0) + inc
+            self.__names[key] = (discord_server.name, user.name)
+            self.buffered_incs += 1
+            if self.__oldest is None:
+                self.__oldest = time.monotonic()
+        return self.is_due()
+
+    def is_due(self) -> bool:
+        """ Whether the size or time threshold has been reached """
+        with self.__lock:
+            if len(self.__deltas) >= self.max_keys:
+                return True
+            return self.__oldest is not None and time.monotonic() - self.__oldest >= self.max_age
+
+    def flush(self) -> int:
+        """ Writes all buffered increments in a single unordered bulk_write,
+            returns the number of documents written """
+        with self.__lock:
+            deltas = self.__deltas
+            names = self.__names
+            self.__deltas = {}
+            self.__names = {}
+            self.__oldest = None
+        if len(deltas) == 0:
+            return 0
+
+        keys = list(deltas.keys())
+        requests = []
+        for key in keys:
+            fields = deltas[key]
+            server_id, user_id = key
+            server_name, user_name = names[key]
+            # every stat gets $inc'd so that newly upserted users have all counters
+            stats_data = {stat: fields.get(stat, 0) for stat in USER_STATS}
+            stats_data["score"] = sum(fields.values())
+            requests.append(UpdateOne({
+                                        "_id": {
+                                            "server_id": server_id,
+                                            "user_id": user_id
+                                        }
+                                      },
+                                      {
+                                        "$set": {
+                                            "server_name": server_name,
+                                            "user_name": user_name
+                                        },
+                                        "$inc": stats_data
+                                      }, upsert=True))
+
+        start = time.perf_counter()
+        try:
+            db.user_stats.bulk_write(requests, ordered=False)
+        except BulkWriteError as ex:
+            # the write is unordered, so every op that didn't fail has been applied.
+            # Only the failed ones are put back, otherwise the next flush counts the rest twice
+            failed = [keys[error["index"]] for error in ex.details.get("writeErrors", [])]
+            self.__restore({ key: deltas[key] for key in failed }, names)
+            raise
+        except Exception:
+            # put the deltas back so a failed flush doesn't lose stats
+            self.__restore(deltas, names)
+            raise
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        with self.__lock:
+            self.flushes += 1
+            self.flushed_ops += len(requests)
+            self.last_flush_ms = elapsed_ms
+            self.total_flush_ms += elapsed_ms
+        return len(requests)
+
+    def __restore(self, deltas: dict[tuple[int, int], dict[str, int]],
+                  names: dict[tuple[int, int], tuple[str, str]]) -> None:
+        if len(deltas) == 0:
+            return
+        with self.__lock:
+            for key, fields in deltas.items():
+                current = self.__deltas.setdefault(key, {})
+                for field, inc in fields.items():
+                    current[field] = current.get(field, 0) + inc
+                self.__names.setdefault(key, names[key])
+            if self.__oldest is None:
+                self.__oldest = time.monotonic()
+
+
+user_stat_buffer = StatBuffer(max_keys=int(os.getenv("STAT_BUFFER_MAX_KEYS", 500)),
+                              max_age=float(os.getenv("STAT_BUFFER_MAX_AGE", 5.0)))
+""" Process-wide buffer for per-message user stat increments """
+
+def buffer_user_stat(discord_server: discord.Guild, user, field: str, inc = 1) -> bool:
+    """ Buffered alternative to inc_user_stat, increments are written in batches.
+        Returns whether the buffer is due for a flush """
+    return user_stat_buffer.add(discord_server, user, field, inc)
+
+def flush_user_stats() -> int:
+    """ Forces all buffered user stat increments to be written now """
+    return user_stat_buffer.flush()
@@ -0,0 +1,59 @@
+import threading
+import time
+from typing import Generic, Hashable, TypeVar
+
+T = TypeVar("T")
+
+class TTLCache(Generic[T]):
+    """ Small thread-safe cache whose entries expire ttl seconds after being set """
+
+    def __init__(self, ttl: float, max_entries: int = 1024) -> None:
+        self.ttl: float = ttl
+        """ Seconds an entry stays valid """
+        self.max_entries: int = max_entries
+        """ Most entries kept at once, the oldest are dropped first """
+        self.hits: int = 0
+        """ Number of lookups served from the cache """
+        self.misses: int = 0
+        """ Number of lookups that found nothing (or an expired entry) """
+        self.__entries: dict[Hashable, tuple[float, T]] = {}
+        self.__lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def __str__(self) -> str:
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups * 100 if lookups > 0 else 0.0
+        return f"{len(self.__entries)} entries, hits={self.hits}, misses={self.misses}, hit_rate={hit_rate:.1f}%"
+
+    def get(self, key: Hashable) -> T | None:
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.__entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: Hashable, value: T) -> None:
+        with self.__lock:
+            self.__entries.pop(key, None)
+            self.__entries[key] = (time.monotonic() + self.ttl, value)
+            while len(self.__entries) > self.max_entries:
+                del self.__entries[next(iter(self.__entries))]
+
+    def invalidate(self, key: Hashable) -> None:
+        with self.__lock:
+            self.__entries.pop(key, None)
+
+    def invalidate_where(self, predicate) -> None:
+        """ Drops every entry whose key satisfies the predicate """
+        with self.__lock:
+            for key in [key for key in self.__entries if predicate(key)]:
+                del self.__entries[key]
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__entries.clear()
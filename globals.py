@@ -1,4 +1,4 @@
-from models import VCConnection, Election, Server, WSESession
+from models import VCConnection, Election, Server, WSESession, VoiceTracker, WSEScheduler
 from discord import Guild
 import threading
 
@@ -14,5 +14,11 @@ elections: dict[Guild, Election] = {}
 live_wse_sessions: dict[Guild, WSESession] = {}
 """Contains servers with active WSE sessions """
 
+wse_scheduler: WSEScheduler = WSEScheduler()
+""" Single scheduler that changes the price of every live WSE session """
+
+voice_trackers: dict[Guild, VoiceTracker] = {}
+""" Contains in-memory voice sessions per server """
+
 start_mutex: threading.Semaphore = threading.Semaphore(0)
 """ Mutex used to synchronize GW on_ready and shell start """
\ No newline at end of file
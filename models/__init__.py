@@ -2,4 +2,10 @@ from models.election import Election
 from models.server import Server
 from models.vc_connection import VCConnection
 from models.time_span import TimeSpan
-from models.wse_session import WSESession
\ No newline at end of file
+from models.wse_session import WSESession, wse_cache_stats
+from models.voice_tracker import VoiceTracker
+from models.price_chart import PriceChartCache, render_portfolio_chart
+from models.wse_scheduler import WSEScheduler
+from models.portfolio_replay import PortfolioReplay, replay_portfolios
+from models.archive_run import ArchiveResult, ArchiveRun
+from models.archive_schedule import ArchiveSchedule
@@ -0,0 +1,69 @@
+from datetime import datetime
+import discord
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from archive.attachments import AttachmentReport
+
+class ArchiveResult:
+    """ Class that records how archiving general chat went in a single guild """
+
+    def __init__(self, guild: discord.Guild) -> None:
+        self.guild: discord.Guild = guild
+        """ Pycord Guild object that was archived """
+        self.success: bool = False
+        """ Whether general chat was archived """
+        self.attempts: int = 0
+        """ Number of attempts made (including the first) """
+        self.seconds: float = 0.0
+        """ Time spent archiving, including backoff between attempts """
+        self.error: str | None = None
+        """ Why the last attempt failed (None if it didn't) """
+        self.exported: int | None = None
+        """ Number of messages in the channel's history export (None if it wasn't exported) """
+        self.export_error: str | None = None
+        """ Why exporting, indexing or storing the attachments of the channel's history failed
+            (None if it didn't), the channel isn't archived until they succeed """
+        self.attachments: "AttachmentReport | None" = None
+        """ What archiving the channel's attachments stored and saved (None if they weren't archived) """
+
+    def __str__(self) -> str:
+        outcome = "archived" if self.success else f"failed ({self.error})"
+        if self.exported is not None:
+            outcome += f", {self.exported} message(s) exported"
+        if self.export_error is not None:
+            outcome += f", export failed ({self.export_error})"
+        return (f"'{self.guild.name}' (id: {self.guild.id}): {outcome} after "
+                f"{self.attempts} attempt(s) in {self.seconds:.1f}s")
+
+class ArchiveRun:
+    """ Class that records an archive run across guilds """
+
+    def __init__(self, concurrency: int) -> None:
+        self.started: datetime = datetime.now()
+        """ When the run started """
+        self.concurrency: int = concurrency
+        """ Most guilds archived at once """
+        self.results: list[ArchiveResult] = []
+        """ Outcome of each guild, in the order they finished """
+        self.seconds: float = 0.0
+        """ Wall time of the whole run """
+
+    def __str__(self) -> str:
+        failed = len(self.failures())
+        slowest = max(self.results, key=lambda result: result.seconds, default=None)
+        slowest_str = "" if slowest is None else f", slowest '{slowest.guild.name}' ({slowest.seconds:.1f}s)"
+        stored, storage_saved = self.attachment_savings()
+        return (f"ArchiveRun: {len(self.results)} guild(s) in {self.seconds:.1f}s "
+                f"(concurrency {self.concurrency}), {failed} failed{slowest_str}, attachments stored "
+                f"{stored / 1024 / 1024:.1f} MiB, saved {storage_saved / 1024 / 1024:.1f} MiB of storage")
+
+    def attachment_savings(self) -> tuple[int, int]:
+        """ Bytes of attachments stored and storage saved by deduplication, across the run """
+        reports = [result.attachments for result in self.results if result.attachments is not None]
+        stored = sum([report.stored_bytes for report in reports])
+        storage_saved = sum([report.deduplicated_bytes for report in reports])
+        return stored, storage_saved
+
+    def failures(self) -> list[ArchiveResult]:
+        return [result for result in self.results if not result.success]
@@ -0,0 +1,64 @@
+from datetime import datetime, timedelta
+import heapq
+from pytz import timezone
+
+class ArchiveSchedule:
+    """ Class that keeps every guild's next archive date in a min-heap so the archive loop
+        can sleep until the earliest one. Rescheduled or removed guilds leave stale heap
+        entries behind, which are skipped (and dropped) when they reach the top """
+
+    def __init__(self) -> None:
+        self.next_runs: dict[int, datetime] = {}
+        """ Next archive date (UTC) of every scheduled guild, keyed by server ID """
+        self.__heap: list[tuple[datetime, int]] = []
+
+    def __str__(self) -> str:
+        earliest = self.peek()
+        earliest_str = "nothing scheduled" if earliest is None else f"next run {earliest[0]} (id: {earliest[1]})"
+        return f"ArchiveSchedule: {len(self.next_runs)} guild(s), {earliest_str}"
+
+    def __len__(self) -> int:
+        return len(self.next_runs)
+
+    def set(self, server_id: int, when: datetime) -> None:
+        """ Schedules (or reschedules) a guild's next archive """
+        self.next_runs[server_id] = when
+        heapq.heappush(self.__heap, (when, server_id))
+
+    def remove(self, server_id: int) -> None:
+        """ Unschedules a guild """
+        self.next_runs.pop(server_id, None)
+
+    def peek(self) -> tuple[datetime, int] | None:
+        """ Earliest (date, server ID) pair, None if nothing is scheduled """
+        while len(self.__heap) > 0:
+            when, server_id = self.__heap[0]
+            if self.next_runs.get(server_id) == when:
+                return when, server_id
+            heapq.heappop(self.__heap)
+        return None
+
+    def pop_due(self, now: datetime) -> list[tuple[int, datetime]]:
+        """ Unschedules and returns every (server ID, date) pair that's due at the given time """
+        due = []
+        earliest = self.peek()
+        while earliest is not None and earliest[0] <= now:
+            when, server_id = heapq.heappop(self.__heap)
+            del self.next_runs[server_id]
+            due.append((server_id, when))
+            earliest = self.peek()
+        return due
+
+    @staticmethod
+    def following(when: datetime, weeks: int, tz: str, now: datetime) -> datetime:
+        """ First archive date after now, stepping from the given one in whole intervals.
+            Steps are taken on the guild's wall clock so archives stay at the same local
+            time across daylight saving changes """
+        zone = timezone(tz)
+        local = when.astimezone(zone).replace(tzinfo=None)
+        step = timedelta(weeks=max(weeks, 1))
+        result = when
+        while result <= now:
+            local += step
+            result = zone.localize(local).astimezone(now.tzinfo)
+        return result
@@ -0,0 +1,88 @@
+from datetime import datetime
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import numpy as np # heavy import, only loaded once a replay is run
+
+class PortfolioReplay:
+    """ Class that holds every WSE participant's portfolio at each point in time of a replay """
+
+    def __init__(self, user_ids: "np.ndarray", user_names: list[str], times: "np.ndarray",
+                 prices: "np.ndarray", holding: "np.ndarray", cash: "np.ndarray") -> None:
+        self.user_ids: "np.ndarray" = user_ids
+        """ Participant user IDs, one per row """
+        self.user_names: list[str] = user_names
+        """ Participant names (as of their latest transaction), one per row """
+        self.times: "np.ndarray" = times
+        """ Replayed points in time (datetime64[s]), one per column """
+        self.prices: "np.ndarray" = prices
+        """ Stock price at each point in time """
+        self.holding: "np.ndarray" = holding
+        """ users x times, whether the participant held the stock """
+        self.cash: "np.ndarray" = cash
+        """ users x times, the participant's cash (NaN before their first transaction) """
+
+    def stock_values(self) -> "np.ndarray":
+        """ users x times, value of the stock each participant held """
+        import numpy as np
+        return np.where(np.isnan(self.cash), np.nan, self.holding * self.prices[np.newaxis, :])
+
+    def values(self) -> "np.ndarray":
+        """ users x times, total portfolio value (NaN before the participant's first transaction) """
+        return self.stock_values() + self.cash
+
+    def user_values(self, user_id: int) -> "np.ndarray":
+        """ Portfolio value of a single participant over time """
+        import numpy as np
+        rows = np.flatnonzero(self.user_ids == user_id)
+        if len(rows) == 0:
+            return np.full(len(self.times), np.nan)
+        return self.values()[rows[0]]
+
+    def guild_values(self) -> "np.ndarray":
+        """ Combined portfolio value of every participant over time """
+        import numpy as np
+        return np.nansum(self.values(), axis=0)
+
+
+def replay_portfolios(transactions: list[dict], times: list[datetime], prices: list[float]) -> PortfolioReplay:
+    """ Replays the transaction ledger against a price series. Each participant's state
+        at each point is the state after their last transaction at or before that point,
+        found for every (participant, point) pair with a single searchsorted """
+    import numpy as np
+    query_times = np.array(times, dtype="datetime64[s]")
+    query_prices = np.array(prices, dtype=float)
+    if len(transactions) == 0:
+        empty = np.zeros((0, len(query_times)))
+        return PortfolioReplay(np.array([], dtype=np.int64), [], query_times, query_prices, empty.astype(bool), empty)
+
+    tx_users = np.array([transaction["user_id"] for transaction in transactions], dtype=np.int64)
+    tx_times = np.array([transaction["timestamp"] for transaction in transactions], dtype="datetime64[s]").astype(np.int64)
+    tx_holding = np.array([transaction["action"] == "buy" for transaction in transactions])
+    tx_cash = np.array([transaction["cash_value"] for transaction in transactions], dtype=float)
+
+    user_ids, user_rows = np.unique(tx_users, return_inverse=True)
+    order = np.lexsort((tx_times, user_rows))
+    user_rows, tx_times = user_rows[order], tx_times[order]
+    tx_holding, tx_cash = tx_holding[order], tx_cash[order]
+
+    # flatten (participant, time) into one sorted key so a single searchsorted handles everyone
+    point_times = query_times.astype(np.int64)
+    origin = min(tx_times.min(), point_times.min()) if len(point_times) > 0 else tx_times.min()
+    span = max(tx_times.max(), point_times.max() if len(point_times) > 0 else 0) - origin + 1
+    tx_keys = user_rows * span + (tx_times - origin)
+    rows = np.arange(len(user_ids))[:, np.newaxis]
+    query_keys = rows * span + (point_times - origin)[np.newaxis, :]
+
+    last = np.searchsorted(tx_keys, query_keys, side="right") - 1
+    clipped = np.clip(last, 0, None)
+    valid = (last >= 0) & (user_rows[clipped] == rows)
+    holding = np.where(valid, tx_holding[clipped], False)
+    cash = np.where(valid, tx_cash[clipped], np.nan)
+
+    latest = np.r_[np.flatnonzero(np.diff(user_rows)), len(user_rows) - 1]
+    names_by_row = [""] * len(user_ids)
+    for position in latest:
+        names_by_row[user_rows[position]] = transactions[order[position]]["user_name"]
+
+    return PortfolioReplay(user_ids, names_by_row, query_times, query_prices, holding, cash)
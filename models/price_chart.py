@@ -0,0 +1,81 @@
+import asyncio
+import database as db
+from database import aio as adb
+from discord import Guild
+import io
+
+def render_price_chart(timestamps: list[str], prices: list[float]) -> bytes:
+    """ Renders the WSE price chart to JPEG bytes. Uses the object-oriented
+        matplotlib API (no pyplot state), so it's safe to call off the event loop """
+    from matplotlib.figure import Figure # heavy import, only needed once a chart is drawn
+    fig = Figure()
+    ax = fig.subplots()
+    fig.set_figwidth(15)
+    ax.set_ylabel("Price", labelpad=25)
+    ax.yaxis.set_major_formatter('${x:1.2f}')
+    ax.set_xlabel("Date", labelpad=25)
+    ax.tick_params(axis='x', labelrotation=90)
+    ax.plot(timestamps, prices, marker="o")
+
+    output = io.BytesIO()
+    fig.savefig(output, format="jpg", bbox_inches='tight')
+    return output.getvalue()
+
+def render_portfolio_chart(times: list, values: list[float], title: str) -> bytes:
+    """ Renders a portfolio value history to JPEG bytes (safe to call off the event loop) """
+    from matplotlib.figure import Figure
+    fig = Figure()
+    ax = fig.subplots()
+    fig.set_figwidth(15)
+    ax.set_title(title)
+    ax.set_ylabel("Portfolio Value", labelpad=25)
+    ax.yaxis.set_major_formatter('${x:1.2f}')
+    ax.set_xlabel("Date", labelpad=25)
+    ax.tick_params(axis='x', labelrotation=90)
+    ax.plot(times, values, marker="o" if len(times) <= 120 else None)
+
+    output = io.BytesIO()
+    fig.savefig(output, format="jpg", bbox_inches='tight')
+    return output.getvalue()
+
+class PriceChartCache:
+    """ Class that keeps each guild's rendered WSE price chart in memory until a new price tick is written """
+
+    def __init__(self) -> None:
+        self.__charts: dict[int, bytes] = {}
+        self.__generations: dict[int, int] = {}
+        self.__locks: dict[int, asyncio.Lock] = {}
+        self.hits: int = 0
+        """ Number of charts served from memory """
+        self.renders: int = 0
+        """ Number of charts rendered """
+        db.on_wse_price_change(self.invalidate)
+
+    def __str__(self) -> str:
+        return f"PriceChartCache: {len(self.__charts)} charts cached, hits={self.hits}, renders={self.renders}"
+
+    def invalidate(self, server_id: int) -> None:
+        """ Drops the guild's cached chart (called whenever a new price is written) """
+        self.__generations[server_id] = self.__generations.get(server_id, 0) + 1
+        self.__charts.pop(server_id, None)
+
+    async def get(self, guild: Guild) -> bytes:
+        """ Returns the guild's chart as JPEG bytes, rendering it off the event loop if needed """
+        chart = self.__charts.get(guild.id)
+        if chart is not None:
+            self.hits += 1
+            return chart
+
+        # one render per guild at a time, later callers wait for it and reuse the result
+        async with self.__locks.setdefault(guild.id, asyncio.Lock()):
+            chart = self.__charts.get(guild.id)
+            if chart is not None:
+                self.hits += 1
+                return chart
+            generation = self.__generations.get(guild.id, 0)
+            timestamps, prices = await adb.get_prices(guild)
+            chart = await asyncio.to_thread(render_price_chart, timestamps, prices)
+            self.renders += 1
+            if self.__generations.get(guild.id, 0) == generation:
+                self.__charts[guild.id] = chart
+            return chart
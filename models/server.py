@@ -1,22 +1,49 @@
 from discord import Guild, User
 import database as db
+from database import ServerSettings
 
 class Server:
     """ Class that encapsulates a Guild object and additional info about a server """
     
-    def __init__(self, guild: Guild) -> None:
+    def __init__(self, guild: Guild, settings: ServerSettings | None = None) -> None:
         self.guild: Guild = guild
         """ Pycord Guild object associated with this server """
-        self.rshuffle: list[str] = db.get_rshuffle(guild)
+        self.settings: ServerSettings = db.get_server_settings(guild) if settings is None else settings
+        """ Settings stored in the database (fetched in a single projected read) """
+        self.rshuffle: list[str] = self.settings.rshuffle
         """ String list of roles involved in role change """
-        self.ushuffle: list[str] = db.get_ushuffle(guild)
+        self.ushuffle: list[str] = self.settings.ushuffle
         """ List of users involved in role change """
-        self.archive_int: int = 2
+        self.archive_int: int = self.settings.archive_int
         """ General chat archive interval (in weeks) """
         self.rc_int: int = 1
         """ Role change interval (in minutes) """
-        self.timezone: str = "US/Eastern"
+        self.timezone: str = self.settings.timezone
         """ Timezone of server """
         
+    def add_to_shuffle(self, field: str, name: str) -> None:
+        """ Mirrors db.add_to_shuffle on the in-memory shuffle list """
+        names = self.__shuffle(field)
+        if name not in names:
+            names.append(name)
+
+    def pull_from_shuffle(self, field: str, name: str) -> None:
+        """ Mirrors db.pull_from_shuffle on the in-memory shuffle list """
+        names = self.__shuffle(field)
+        names[:] = [item for item in names if item != name]
+
+    def reload_settings(self, settings: ServerSettings) -> None:
+        """ Picks up settings that were rewritten in the database (e.g. a full shuffle rebuild) """
+        self.settings = settings
+        self.rshuffle = settings.rshuffle
+        self.ushuffle = settings.ushuffle
+        self.archive_int = settings.archive_int
+        self.timezone = settings.timezone
+
+    def __shuffle(self, field: str) -> list[str]:
+        if field not in db.SHUFFLE_FIELDS:
+            raise Exception(f"'{field}' is not a shuffle list, must be one of {db.SHUFFLE_FIELDS}")
+        return self.rshuffle if field == "rshuffle" else self.ushuffle
+        
     def __str__(self) -> str:
         return f"'{self.guild.name}': {self.guild.member_count} members (id: {self.guild.id})"
\ No newline at end of file
@@ -0,0 +1,91 @@
+import discord
+import threading
+import time
+
+class VoiceTracker:
+    """ Class that keeps a guild's voice sessions in memory and accrues each member's
+        time in VC while they share a channel with at least one other person. Thread-safe,
+        since the shell drains it from its own thread """
+
+    def __init__(self, guild: discord.Guild) -> None:
+        self.guild: discord.Guild = guild
+        """ Pycord Guild object that the sessions belong to """
+        self.members: dict[int, discord.Member] = {}
+        """ Members currently in a voice channel, keyed by member ID """
+        self.channels: dict[int, set[int]] = {}
+        """ IDs of the (non-bot) members in each voice channel, keyed by channel ID """
+        self.member_channel: dict[int, int] = {}
+        """ Voice channel each member is in, keyed by member ID """
+        self.timer_start: dict[int, float] = {}
+        """ Monotonic time each eligible member's VC timer started, keyed by member ID """
+        self.pending: dict[int, float] = {}
+        """ Accrued seconds not yet handed off to the database, keyed by member ID """
+        self.__lock = threading.RLock()
+
+    def __str__(self) -> str:
+        return (f"VoiceTracker: '{self.guild.name}', {len(self.member_channel)} in VC, "
+                f"{len(self.timer_start)} timers running, {len(self.pending)} pending writes")
+
+    def join(self, member: discord.Member, channel_id: int, now: float | None = None) -> None:
+        """ Records a member joining a voice channel """
+        if member.bot:
+            return
+        now = time.monotonic() if now is None else now
+        with self.__lock:
+            self.leave(member, now)
+            self.members[member.id] = member
+            self.member_channel[member.id] = channel_id
+            self.channels.setdefault(channel_id, set()).add(member.id)
+            self.__refresh(channel_id, now)
+
+    def leave(self, member: discord.Member, now: float | None = None) -> None:
+        """ Records a member leaving their voice channel """
+        with self.__lock:
+            channel_id = self.member_channel.pop(member.id, None)
+            if channel_id is None:
+                return
+            now = time.monotonic() if now is None else now
+            self.__stop_timer(member.id, now)
+            if member.id not in self.pending:
+                del self.members[member.id]
+            self.channels[channel_id].discard(member.id)
+            if len(self.channels[channel_id]) == 0:
+                del self.channels[channel_id]
+            else:
+                self.__refresh(channel_id, now)
+
+    def drain(self, now: float | None = None) -> list[tuple[discord.Member, int]]:
+        """ Checkpoints running timers and returns the whole seconds each member
+            has accrued since the last drain. Fractions of a second are carried over """
+        now = time.monotonic() if now is None else now
+        with self.__lock:
+            for member_id in list(self.timer_start.keys()):
+                self.__stop_timer(member_id, now)
+                self.timer_start[member_id] = now
+
+            result = []
+            for member_id, seconds in list(self.pending.items()):
+                whole = int(seconds)
+                if whole > 0:
+                    result.append((self.members[member_id], whole))
+                if member_id in self.member_channel:
+                    self.pending[member_id] = seconds - whole
+                else:
+                    del self.pending[member_id]
+                    del self.members[member_id]
+        return result
+
+    def __refresh(self, channel_id: int, now: float) -> None:
+        """ Starts or stops the timers in a channel depending on whether it has more than one person """
+        member_ids = self.channels.get(channel_id, set())
+        eligible = len(member_ids) > 1
+        for member_id in member_ids:
+            if eligible and member_id not in self.timer_start:
+                self.timer_start[member_id] = now
+            elif not eligible:
+                self.__stop_timer(member_id, now)
+
+    def __stop_timer(self, member_id: int, now: float) -> None:
+        start = self.timer_start.pop(member_id, None)
+        if start is not None:
+            self.pending[member_id] = self.pending.get(member_id, 0.0) + (now - start)
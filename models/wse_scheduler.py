@@ -0,0 +1,86 @@
+import asyncio
+from apscheduler.job import Job
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.triggers.cron import CronTrigger
+from database import aio as adb
+from models.wse_session import WSESession
+from typing import TYPE_CHECKING
+from utilities import printlog
+
+if TYPE_CHECKING:
+    import numpy as np
+
+class WSEScheduler:
+    """ Class that drives every WSE session's price changes from a single scheduler on the bot's
+        event loop. Sessions sharing a crontab expression share one job, and each tick computes
+        all of their new prices at once and writes them in one bulk insert """
+
+    def __init__(self) -> None:
+        self.sessions: dict[str, dict[int, WSESession]] = {}
+        """ Live sessions grouped by crontab expression, then keyed by server ID """
+        self.__jobs: dict[str, Job] = {}
+        self.__scheduler: AsyncIOScheduler | None = None
+        self.__rng: "np.random.Generator | None" = None # created on the first tick, so numpy isn't loaded at startup
+
+    def __str__(self) -> str:
+        jobs = ", ".join([f"'{cron_exp}': {len(self.sessions[cron_exp])} session(s), next run {job.next_run_time}"
+                          for cron_exp, job in self.__jobs.items()])
+        return f"WSEScheduler: {jobs if len(jobs) > 0 else 'no jobs'}"
+
+    def add(self, session: WSESession) -> None:
+        """ Starts changing the session's price on its schedule. Must be called from the bot's event loop """
+        scheduler = self.__get_scheduler()
+        group = self.sessions.setdefault(session.cron_exp, {})
+        group[session.guild.id] = session
+        job = self.__jobs.get(session.cron_exp)
+        if job is None:
+            job = scheduler.add_job(self.__tick, CronTrigger.from_crontab(session.cron_exp), args=[session.cron_exp])
+            self.__jobs[session.cron_exp] = job
+        session.job = job
+
+    def remove(self, session: WSESession) -> None:
+        """ Stops changing the session's price, removing the job once no session uses it """
+        group = self.sessions.get(session.cron_exp, {})
+        group.pop(session.guild.id, None)
+        session.job = None
+        if len(group) == 0 and session.cron_exp in self.__jobs:
+            self.__jobs.pop(session.cron_exp).remove()
+            del self.sessions[session.cron_exp]
+
+    async def __tick(self, cron_exp: str) -> None:
+        server_ids = list(self.sessions.get(cron_exp, {}).keys())
+        if len(server_ids) == 0:
+            return
+        try:
+            import numpy as np
+            current = await adb.get_current_wse_prices(server_ids)
+            server_ids = [server_id for server_id in server_ids if server_id in current]
+            old_prices = np.array([current[server_id] for server_id in server_ids], dtype=float)
+            new_prices = self.new_prices(old_prices)
+            changed = new_prices != old_prices
+            changed_prices = { server_id: float(price) for server_id, price, is_changed
+                               in zip(server_ids, new_prices, changed) if is_changed }
+            await adb.set_current_wse_prices(changed_prices)
+            # write-through to the live sessions
+            group = self.sessions.get(cron_exp, {})
+            for server_id, price in zip(server_ids, new_prices):
+                if server_id in group:
+                    group[server_id].price = float(price)
+        except Exception as ex:
+            printlog(f"WSE price tick for '{cron_exp}' failed: {str(ex)}")
+
+    def new_prices(self, old_prices: "np.ndarray") -> "np.ndarray":
+        """ Moves every price by a random rate between -2% and +7%,
+            leaving prices alone when the change would be under a cent """
+        import numpy as np
+        if self.__rng is None:
+            self.__rng = np.random.default_rng()
+        rates = self.__rng.integers(-200, 700, size=old_prices.shape, endpoint=True) / 10000
+        deltas = old_prices * rates
+        return np.where(np.abs(deltas) < 0.01, old_prices, old_prices + deltas)
+
+    def __get_scheduler(self) -> AsyncIOScheduler:
+        if self.__scheduler is None:
+            self.__scheduler = AsyncIOScheduler(event_loop=asyncio.get_running_loop())
+            self.__scheduler.start()
+        return self.__scheduler
@@ -1,37 +1,61 @@
 from discord import Guild, User
 import database as db
+from database import aio as adb
 from apscheduler.job import Job
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.cron import CronTrigger
-import random
+
+class WSECacheStats:
+    """ Counters for WSE state served from memory instead of the database """
+
+    def __init__(self) -> None:
+        self.status_hits: int = 0
+        """ Open/closed checks answered from live_wse_sessions """
+        self.status_misses: int = 0
+        """ Open/closed checks that had to go to the database (no live session) """
+        self.price_hits: int = 0
+        """ Current price lookups answered from memory """
+        self.price_misses: int = 0
+        """ Current price lookups that had to go to the database """
+
+    def __str__(self) -> str:
+        lookups = self.price_hits + self.price_misses
+        hit_rate = self.price_hits / lookups * 100 if lookups > 0 else 0.0
+        return (f"WSECacheStats: status_hits={self.status_hits}, status_misses={self.status_misses}, "
+                f"price_hits={self.price_hits}, "
+                f"price_misses={self.price_misses}, price_hit_rate={hit_rate:.1f}%")
+
+wse_cache_stats = WSECacheStats()
+""" Hit/miss counters shared by every WSE session """
 
 class WSESession:
     """ Class that encapsulates a details about a Walarus Stock Exchange session """
-    
-    def __init__(self, guild: Guild, user_id: int, cron_exp: str) -> None:
-        self.guild: Guild = guild 
+
+    def __init__(self, guild: Guild, user_id: int, cron_exp: str, price: float | None = None) -> None:
+        self.guild: Guild = guild
         """ Server that the session is running in """
         self.user_id = user_id
         """ User ID of the user we're tracking """
-        cron_trigger = CronTrigger.from_crontab(cron_exp)
-        scheduler = BackgroundScheduler()
-        self.job: Job = scheduler.add_job(self.__get_new_wse_price, cron_trigger, args=[True])
-        """ APScheduler job used for fetching next price change timestamp """
-        scheduler.start()
+        self.cron_exp: str = cron_exp
+        """ Crontab expression for when the price changes """
+        self.job: Job | None = None
+        """ Shared APScheduler job that changes this session's price (set by WSEScheduler) """
+        self.price: float | None = price
+        """ Current stock price, kept in sync write-through by whoever writes a new price """
 
     def __str__(self) -> str:
-        curr_price = db.get_current_wse_price(self.guild)
-        return (f"'{self.guild.name}' ({self.user_id}): ${curr_price} (next price change: {self.job.next_run_time})")
-    
-    def __get_new_wse_price(self, write: bool = False) -> float:
-        old_price = db.get_current_wse_price(self.guild)
-        rate = random.randint(-200, 700) / 10000
-        delta = old_price * rate
-        
-        if abs(delta) < 0.01:
-            return old_price
-        
-        new_price = old_price + delta
-        if write:
-            db.set_current_wse_price(self.guild, new_price)
-        return new_price
\ No newline at end of file
+        curr_price = self.price if self.price is not None else db.get_current_wse_price(self.guild)
+        next_run_time = None if self.job is None else self.job.next_run_time
+        return (f"'{self.guild.name}' ({self.user_id}): ${curr_price} (next price change: {next_run_time})")
+
+    async def current_price(self) -> float:
+        """ Returns the current price from memory, loading it from the database the first time """
+        if self.price is None:
+            wse_cache_stats.price_misses += 1
+            self.price = await adb.get_current_wse_price(self.guild)
+        else:
+            wse_cache_stats.price_hits += 1
+        return self.price
+
+    async def set_price(self, price: float) -> None:
+        """ Writes a new price to the database and to memory """
+        await adb.set_current_wse_price(self.guild, price)
+        self.price = price
@@ -1,16 +1,19 @@
-import asyncio
+from startup import startup_report
 import os
 import discord
 from discord.ext import commands
 import discord.utils
+for module in ["database", "models", "cogs.archive_cog", "cogs.election_cog", "cogs.events_cog",
+               "cogs.miscellaneous_cog", "cogs.voice_cog", "cogs.stats_cog", "cogs.openai_cog", "cogs.wse_cog"]:
+    startup_report.import_module(module)
 from cogs import (ArchiveCog, ElectionCog, EventsCog, 
     MiscellaneousCog, StatisticsCog, VoiceCog, OpenAICog,
     WSECog)
 from globals import start_mutex
-from ai import LLMEngine, VisionEngine
+from ai import llm_engine, vision_engine
 import shell as sh
 from threading import Thread
-from utilities import get_server_prefix
+from utilities import get_server_prefix, printlog
 
 def run_bot(bot: commands.Bot):
     bot.run(os.getenv("BOT_TOKEN"))
@@ -22,21 +25,24 @@ def main():
     intents.members = True
     intents.voice_states = True
 
-    bot: commands.Bot = commands.Bot(command_prefix=get_server_prefix(), intents=intents)
-    llm_engine: LLMEngine = LLMEngine()
-    vision_engine: VisionEngine = VisionEngine()
+    with startup_report.timed("add cogs"):
+        bot: commands.Bot = commands.Bot(command_prefix=get_server_prefix(), intents=intents)
 
-    bot.add_cog(EventsCog(bot, llm_engine, vision_engine))
-    bot.add_cog(ArchiveCog(bot))
-    bot.add_cog(ElectionCog())
-    bot.add_cog(MiscellaneousCog())
-    bot.add_cog(StatisticsCog())
-    bot.add_cog(VoiceCog())
-    bot.add_cog(OpenAICog())
-    bot.add_cog(WSECog())
+        # the engines are created on first use (see ai.engines)
+        bot.add_cog(EventsCog(bot, llm_engine, vision_engine))
+        bot.add_cog(ArchiveCog(bot))
+        bot.add_cog(ElectionCog())
+        bot.add_cog(MiscellaneousCog())
+        bot.add_cog(StatisticsCog())
+        bot.add_cog(VoiceCog())
+        bot.add_cog(OpenAICog())
+        bot.add_cog(WSECog())
     
     Thread(target=run_bot, name="cmd", args=[bot]).start()
     start_mutex.acquire()
+    print(str(startup_report))
+    if startup_report.total() > startup_report.budget:
+        printlog(f"Cold start over budget: {str(startup_report)}")
     sh.run_walarus_shell()
 
 if __name__ == "__main__":
@@ -1,5 +1,11 @@
-from globals import servers, vc_connections, elections, live_wse_sessions
+from globals import servers, vc_connections, elections, live_wse_sessions, voice_trackers, wse_scheduler
+from ai import engines
+from ai.verdict_cache import nsfw_verdict_cache
+from archive import attachment_store, search_index
+from models import wse_cache_stats
+import database as db
 import os
+from startup import startup_report
     
 class _Command:
     """ A class that represents a Walarus Shell command """
@@ -21,8 +27,64 @@ def show_globals() -> None:
     print(f"live_wse_sessions:")
     for guild in live_wse_sessions.values():
         print(f"\t{str(guild)}")
+    print(f"wse_scheduler:")
+    print(f"\t{str(wse_scheduler)}")
+    print(f"voice_trackers:")
+    for tracker in voice_trackers.values():
+        print(f"\t{str(tracker)}")
+
+def show_stat_buffer() -> None:
+    print(f"\t{str(db.user_stat_buffer)}")
+
+def show_vision_cache() -> None:
+    print(f"\t{str(nsfw_verdict_cache)}")
+
+def show_wse_cache() -> None:
+    print(f"\t{str(wse_cache_stats)}")
+
+def show_engines() -> None:
+    for engine in engines:
+        print(f"\t{str(engine)}")
+
+def show_startup() -> None:
+    print(f"\t{str(startup_report)}")
+    for line in startup_report.lines():
+        print(f"\t{line}")
+
+def show_attachment_store() -> None:
+    print(f"\t{str(attachment_store)}")
+
+def show_search_index() -> None:
+    print(f"\t{str(search_index)}")
+
+def explain_queries() -> None:
+    for shape, collscan, index_names in db.explain_query_shapes():
+        verdict = "COLLSCAN" if collscan else "ok"
+        indexes = ", ".join(index_names) if len(index_names) > 0 else "no index"
+        print(f"\t[{verdict}] {shape.name} on '{shape.collection}' ({indexes})")
+
+def show_indexes() -> None:
+    for spec in db.INDEXES:
+        print(f"\t{str(spec)}")
+    print(f"\tEnsured {len(db.ensure_indexes())} index(es)")
 
 def exit_walarus() -> None:
+    # time in VC of members still connected is only buffered at checkpoints, so drain it first
+    for tracker in list(voice_trackers.values()):
+        try:
+            for member, seconds in tracker.drain():
+                db.buffer_user_stat(tracker.guild, member, "time_in_vc", seconds)
+        except Exception as ex:
+            print(f"Failed to drain voice time in '{tracker.guild.name}': {str(ex)}")
+    try:
+        written = db.flush_user_stats()
+        print(f"Flushed {written} buffered user stat document(s)")
+    except Exception as ex:
+        print(f"Failed to flush user stats: {str(ex)}")
+    try:
+        print(f"Indexed {search_index.flush()} buffered message(s) for search")
+    except Exception as ex:
+        print(f"Failed to flush the search index: {str(ex)}")
     try:
         os._exit(0)
     except Exception as ex:
@@ -37,6 +99,15 @@ cmd_map: dict = {
     "exit": _Command("exit", "Close shell and terminate General Walarus", exit_walarus),
     "globals": _Command("globals", "Display current value of global variables", show_globals),
     "help": _Command("help", "List out all the Walarus Shell commands", help),
+    "visioncache": _Command("visioncache", "Display NSFW verdict cache hit rate and saved calls", show_vision_cache),
+    "wsecache": _Command("wsecache", "Display WSE state cache hit rate", show_wse_cache),
+    "explain": _Command("explain", "Explain every registered query shape and flag collection scans", explain_queries),
+    "indexes": _Command("indexes", "List the index registry and apply it", show_indexes),
+    "engines": _Command("engines", "Display whether the LLM and vision engines have been initialized", show_engines),
+    "startup": _Command("startup", "Display the cold start timing report (imports and init per module)", show_startup),
+    "attachments": _Command("attachments", "Display archived attachment blobs and the download budget", show_attachment_store),
+    "searchindex": _Command("searchindex", "Display search index size and last query latency", show_search_index),
+    "statbuffer": _Command("statbuffer", "Display user stat buffer depth and flush latency", show_stat_buffer),
 }    
 
 def run_walarus_shell():
@@ -0,0 +1,58 @@
+from contextlib import contextmanager
+import importlib
+import os
+import time
+from types import ModuleType
+
+class StartupReport:
+    """ Class that records how long each part of General Walarus' cold start takes """
+
+    def __init__(self, budget: float) -> None:
+        self.budget: float = budget
+        """ Seconds the cold start is allowed to take before the report flags it """
+        self.phases: list[tuple[str, float]] = []
+        """ (phase, seconds) in the order they finished """
+        self.started: float = time.perf_counter()
+        """ perf_counter() reading when the report was created (i.e. process start) """
+        self.last_end: float | None = None
+        """ perf_counter() reading when the last phase was recorded """
+
+    def __str__(self) -> str:
+        total = self.total()
+        verdict = "within" if total <= self.budget else "OVER"
+        return f"StartupReport: {total:.2f}s total, {verdict} the {self.budget:.2f}s budget"
+
+    def record(self, phase: str, seconds: float, in_total: bool = True) -> None:
+        """ Adds a phase that was timed elsewhere. Phases outside the total (e.g. engines
+            initialized on first use, long after startup) are listed but don't extend it """
+        self.phases.append((phase, seconds))
+        if in_total:
+            self.last_end = time.perf_counter()
+
+    @contextmanager
+    def timed(self, phase: str):
+        """ Times the body of the with statement as the given phase """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(phase, time.perf_counter() - start)
+
+    def import_module(self, name: str) -> ModuleType:
+        """ Imports a module and records how long it took. Dependencies that were already
+            imported are free, so shared dependencies are charged to the first importer """
+        with self.timed(f"import {name}"):
+            return importlib.import_module(name)
+
+    def total(self) -> float:
+        """ Seconds between process start and the last recorded phase """
+        return 0.0 if self.last_end is None else self.last_end - self.started
+
+    def lines(self) -> list[str]:
+        """ One line per phase, slowest first """
+        return [f"{seconds * 1000:8.1f}ms  {phase}"
+                for phase, seconds in sorted(self.phases, key=lambda item: item[1], reverse=True)]
+
+
+startup_report: StartupReport = StartupReport(budget=float(os.getenv("STARTUP_BUDGET", 5.0)))
+""" Timing report for the running process """
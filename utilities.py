@@ -1,5 +1,7 @@
 from datetime import datetime
 import discord
+import time
+from typing import AsyncIterator
 from discord.abc import Messageable
 from io import BytesIO
 from models.server import Server
@@ -44,12 +46,40 @@ async def send_message(channel: Messageable, msg: str | None):
         await channel.send(msg)
         return
     
-    # otherwise put message in a file and send file
-    OUTPUT_FILE = "message.md"
-    with open(OUTPUT_FILE, "x") as f:
-        f.write(msg)
-    with open(OUTPUT_FILE, "rb") as f:
-        msg_file = discord.File(fp=f, filename=OUTPUT_FILE)
-        await channel.send(file=msg_file)
-
-    os.remove(OUTPUT_FILE)
+    # otherwise send the message as a file (built in memory, nothing touches the disk)
+    msg_file = discord.File(fp=BytesIO(msg.encode()), filename="message.md")
+    await channel.send(file=msg_file)
+
+async def stream_message(channel: Messageable, chunks: AsyncIterator[str], edit_interval: float = 1.0):
+    """ Sends text as it streams in, editing a single reply progressively.
+        Edits are throttled to edit_interval seconds to stay clear of rate limits """
+    DISCORD_MSG_LIMIT = 2000
+    content = ""
+    reply: discord.Message | None = None
+    last_edit = 0.0
+    overflowed = False
+
+    async with channel.typing():
+        async for chunk in chunks:
+            content += chunk
+            if overflowed or len(content.strip()) == 0:
+                continue
+            if len(content) >= DISCORD_MSG_LIMIT:
+                # too long to keep editing, send the whole thing once it's done
+                overflowed = True
+                continue
+            if reply is None:
+                reply = await channel.send(content)
+                last_edit = time.monotonic()
+            elif time.monotonic() - last_edit >= edit_interval:
+                await reply.edit(content=content)
+                last_edit = time.monotonic()
+
+    if overflowed:
+        if reply is not None:
+            await reply.delete()
+        await send_message(channel, content)
+    elif reply is None:
+        await send_message(channel, content if len(content.strip()) > 0 else None)
+    elif reply.content != content:
+        await reply.edit(content=content)